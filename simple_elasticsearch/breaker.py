@@ -0,0 +1,227 @@
+import collections
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from elasticsearch import ConnectionError, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+from . import settings as es_settings
+from .registry import registry
+from .utils import get_partition_alias
+
+
+def is_unavailable_error(e):
+    # errors meaning the cluster can't take writes right now, as opposed to
+    # errors about the request itself (eg. a 404 or a mapping conflict)
+    if isinstance(e, ConnectionError):
+        return True
+    return isinstance(e, TransportError) and isinstance(e.status_code, int) and (e.status_code == 429 or e.status_code >= 500)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failed requests, after which
+    `allow()` refuses requests for `reset_timeout` seconds; then a single
+    request is let through, closing the breaker again if it succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.time() - self.opened_at >= self.reset_timeout:
+                self.trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.trial = False
+
+    def record_error(self):
+        # a request failing for reasons that say nothing about the cluster
+        # (eg. a serialization error) lets the next one be the trial instead
+        with self.lock:
+            self.trial = False
+
+
+class WriteSpool(object):
+    """
+    An append-only SQLite file of the single document writes that couldn't be
+    sent, for `replay_spool` to send once the cluster is back. Index writes
+    only record the object's pk (the document is rebuilt from the database
+    when replayed); deletes record their document id, request params and
+    partition. Nothing is looked up in the cluster until the replay.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS spool ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, index_alias TEXT, type_name TEXT, index_name TEXT, '
+                'document_id TEXT, operation TEXT, pk TEXT, action TEXT, created REAL)'
+            )
+
+    @contextlib.contextmanager
+    def connect(self):
+        # a connection per use, so the spool can be written from any thread
+        # (or process)
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def append(self, type_class, obj, operation, index_name=''):
+        action = None
+        if operation == 'delete':
+            data = {'_type': type_class.get_type_name(), '_id': type_class.get_document_id(obj)}
+            data.update(type_class.get_request_params(obj))
+            action = JSONSerializer().dumps({'delete': data, 'partition': type_class.get_partition(obj)})
+
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT INTO spool (index_alias, type_name, index_name, document_id, operation, pk, action, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (type_class.get_index_name(), type_class.get_type_name(), index_name,
+                 str(type_class.get_document_id(obj)), operation, str(obj.pk), action, time.time())
+            )
+
+    def read(self, limit=1000, after=0):
+        with self.connect() as connection:
+            return connection.execute(
+                'SELECT id, index_alias, type_name, index_name, document_id, operation, pk, action '
+                'FROM spool WHERE id > ? ORDER BY id LIMIT ?', (after, limit)
+            ).fetchall()
+
+    def remove(self, ids):
+        with self.connect() as connection:
+            connection.executemany('DELETE FROM spool WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def __len__(self):
+        with self.connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+
+_lock = threading.Lock()
+_breaker = None
+_spool = None
+
+
+def get_circuit_breaker():
+    # the process' breaker for single document writes, or None if disabled
+    global _breaker
+    if es_settings.ELASTICSEARCH_CIRCUIT_BREAKER is None:
+        return None
+    with _lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(**es_settings.ELASTICSEARCH_CIRCUIT_BREAKER)
+        return _breaker
+
+
+def get_spool():
+    global _spool
+    if not es_settings.ELASTICSEARCH_SPOOL_PATH:
+        return None
+    with _lock:
+        if _spool is None or _spool.path != es_settings.ELASTICSEARCH_SPOOL_PATH:
+            _spool = WriteSpool(es_settings.ELASTICSEARCH_SPOOL_PATH)
+        return _spool
+
+
+def reset():
+    global _breaker, _spool
+    with _lock:
+        _breaker = None
+        _spool = None
+
+
+def replay_spool(spool=None, chunksize=1000):
+    # sends the spooled writes in bulk, oldest first, removing them from the
+    # spool once the cluster accepted them; only the last write of each
+    # document is sent, and those that failed stay for the next replay
+    spool = spool or get_spool()
+    stats = {'indexed': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
+    if spool is None:
+        return stats
+
+    last_id = 0
+    while True:
+        rows = spool.read(chunksize, last_id)
+        if not rows:
+            return stats
+
+        latest = collections.OrderedDict()
+        for row in rows:
+            key = row[1:5]
+            latest.pop(key, None)
+            latest[key] = row
+        stats['skipped'] += len(rows) - len(latest)
+
+        pks = collections.OrderedDict()
+        actions = collections.OrderedDict()
+        for (index_alias, type_name, index_name, document_id), row in latest.items():
+            type_class = registry.get_type_class(index_alias, type_name)
+            if type_class is None:
+                stats['skipped'] += 1
+            elif row[5] == 'delete':
+                action = json.loads(row[7])
+                partition = action.pop('partition', None)
+                action['delete']['_index'] = index_name or (get_partition_alias(index_alias, partition) if partition else index_alias)
+                actions.setdefault(type_class, []).append((action, row[0]))
+            else:
+                pks.setdefault((type_class, index_name), {})[row[6]] = row[0]
+
+        keep = set()
+        for (type_class, index_name), type_pks in pks.items():
+            # objects deleted since are left to their spooled delete
+            failed = []
+            result = type_class.bulk_index(
+                index_name=index_name, queryset=type_class.get_queryset().filter(pk__in=list(type_pks.keys())), failed=failed
+            )
+            stats['indexed'] += result['indexed']
+            stats['deleted'] += result['deleted']
+            stats['failed'] += result['failed']
+            stats['skipped'] += len(type_pks) - result['indexed'] - result['deleted'] - result['failed']
+            keep.update(type_pks[str(obj.pk)] for obj in failed)
+
+        for type_class, type_actions in actions.items():
+            # like any other deletes, these clear fingerprints and go to mirrors
+            failed = []
+            result = type_class.index_delete_many([action for action, row_id in type_actions], failed=failed)
+            stats['deleted'] += result['deleted'] + result['missing']
+            stats['failed'] += result['failed']
+            failed = set(id(action) for action in failed)
+            keep.update(row_id for action, row_id in type_actions if id(action) in failed)
+
+        spool.remove(row[0] for row in rows if row[0] not in keep)
+        last_id = rows[-1][0]
@@ -0,0 +1,36 @@
+import threading
+
+from . import settings as es_settings
+from .instrumentation import get_elasticsearch
+
+# the kinds of requests that can each have their own connection settings
+CONNECTION_PROFILES = ('search', 'suggest', 'get', 'write', 'bulk', 'admin')
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def get_connection_params(profile=None, params=None):
+    # `params` (by default `ELASTICSEARCH_CONNECTION_PARAMS`) updated with the
+    # settings of the `profile` in `ELASTICSEARCH_CONNECTION_PROFILES`
+    result = dict(es_settings.ELASTICSEARCH_CONNECTION_PARAMS if params is None else params)
+    if profile is not None:
+        result.update(es_settings.ELASTICSEARCH_CONNECTION_PROFILES.get(profile, {}))
+    return result
+
+
+def get_connection(profile=None):
+    # a client for `profile`'s requests, shared by all the profiles with the
+    # same settings (so there's just one without any profiles configured)
+    params = get_connection_params(profile)
+    key = repr(sorted(params.items()))
+    if key not in _connections:
+        with _lock:
+            if key not in _connections:
+                _connections[key] = get_elasticsearch(**params)
+    return _connections[key]
+
+
+def reset_connections():
+    with _lock:
+        _connections.clear()
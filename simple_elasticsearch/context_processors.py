@@ -0,0 +1,5 @@
+def elasticsearch_calls(request):
+    # the `CallCollector` of `ElasticsearchCallsMiddleware`, with the `count`,
+    # `duration`, `size` and `duplicates` of the request's Elasticsearch calls
+    # (so far)
+    return {'elasticsearch_calls': getattr(request, 'elasticsearch_calls', None)}
@@ -1,3 +1,19 @@
 
 class MissingObjectError(Exception):
     pass
+
+
+class IndexHealthError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TaskError(Exception):
+    pass
+
+
+class ReindexError(TaskError):
+    pass
@@ -1,11 +1,21 @@
+import collections
+import json
+import logging
+import time
 from django import forms
 from django.core.paginator import Paginator, Page
-from elasticsearch import Elasticsearch
+from django.utils import six
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.result import Response
 from elasticsearch_dsl.utils import AttrDict
 
 from . import settings as es_settings
+from .connections import get_connection
+from .registry import registry
+from .signals import post_search
+from .utils import get_partitioned_index_names, get_django_cache, normalize_query
+
+logger = logging.getLogger('simple_elasticsearch.search')
 
 
 class DSEPaginator(Paginator):
@@ -25,13 +35,15 @@ class DSEPaginator(Paginator):
 
 
 class DSEResponse(Response):
-    def __init__(self, d, page=None, page_size=None):
+    def __init__(self, d, page=None, page_size=None, search_stats=None):
         super(DSEResponse, self).__init__(d)
 
         # __setattr__ is overridden in parent class; assign these values
         # manually to prevent the new __setattr__ from firing
         super(AttrDict, self).__setattr__('_page_num', page)
         super(AttrDict, self).__setattr__('_page_size', page_size)
+        # see `ElasticsearchProcessor.get_search_stats`
+        super(AttrDict, self).__setattr__('search_stats', search_stats)
 
     def __len__(self):
         return len(self.hits)
@@ -44,6 +56,71 @@ class DSEResponse(Response):
             super(AttrDict, self).__setattr__('_page', paginator.page(self._page_num))
         return self._page
 
+    def hydrate(self, missing='drop'):
+        # returns the model instances of the hits, in hit order, loaded with
+        # one `in_bulk` query per type class (through its `get_queryset()`);
+        # hits without a row (or a type class) are left out, or returned as
+        # None with `missing='none'`. Each instance is also set as its hit's
+        # `meta.object`.
+        cache = get_django_cache(es_settings.ELASTICSEARCH_HYDRATION_CACHE) if es_settings.ELASTICSEARCH_HYDRATION_CACHE else None
+
+        ids = collections.OrderedDict()
+        for hit in self.hits:
+            type_class = registry.get_type_class_for_index(hit.meta.index, hit.meta.doc_type)
+            if type_class is not None:
+                ids.setdefault(type_class, []).append(hit.meta.id)
+
+        objects = {}
+        for type_class, type_ids in ids.items():
+            keys = dict(
+                ('simple_elasticsearch:object:{0}:{1}:{2}'.format(type_class.get_index_name(), type_class.get_type_name(), id), id)
+                for id in type_ids
+            )
+            found = {}
+            if cache:
+                for key, obj in cache.get_many(list(keys.keys())).items():
+                    found[keys[key]] = obj
+
+            remaining = [id for id in type_ids if id not in found]
+            if remaining:
+                # document ids are expected to be the primary keys (the default
+                # `get_document_id`)
+                loaded = dict((str(pk), obj) for pk, obj in type_class.get_queryset().in_bulk(remaining).items())
+                found.update(loaded)
+                if cache and loaded:
+                    cache.set_many(
+                        dict((key, loaded[id]) for key, id in keys.items() if id in loaded),
+                        es_settings.ELASTICSEARCH_HYDRATION_CACHE_TIMEOUT
+                    )
+
+            for id, obj in found.items():
+                objects[(type_class, id)] = obj
+
+        result = []
+        for hit in self.hits:
+            type_class = registry.get_type_class_for_index(hit.meta.index, hit.meta.doc_type)
+            obj = objects.get((type_class, hit.meta.id))
+            hit.meta.object = obj
+            if obj is not None or missing == 'none':
+                result.append(obj)
+        return result
+
+
+class DSESummaryResponse(object):
+    """
+    The result of a `count_only` or `aggs_only` search: the total number of hits
+    and any aggregations, without the hits themselves or pagination.
+    """
+    def __init__(self, d, search_stats=None):
+        self.total = d.get('hits', {}).get('total', 0)
+        self.aggregations = AttrDict(d.get('aggregations', {}))
+        self.took = d.get('took')
+        self.timed_out = d.get('timed_out', False)
+        self.search_stats = search_stats
+
+    def __len__(self):
+        return 0
+
 
 class ElasticsearchForm(forms.Form):
 
@@ -63,12 +140,29 @@ class ElasticsearchForm(forms.Form):
         # target, or '' if you don't want to target a type
         return ''
 
+    def get_source(self):
+        # return the list of `_source` fields to fetch for each hit, or None
+        # to fetch the whole `_source`
+        return None
+
+    def get_response_paths(self):
+        # return the list of response paths (`filter_path` syntax, eg.
+        # ['hits.hits._source', 'aggregations.*.buckets']) the form uses, or
+        # None to get the whole response
+        return None
+
+    def get_date_range(self):
+        # return a (start, end) tuple of dates to only search the partitions
+        # of partitioned indices covering them, or None to search them all
+        return None
+
     def prepare_query(self):
         raise NotImplementedError
 
-    def search(self, page=1, page_size=20):
+    def search(self, page=1, page_size=20, **kwargs):
+        # `kwargs` are passed on to `add_search`, eg. `count_only=True`
         esp = ElasticsearchProcessor(self.es)
-        esp.add_search(self, page, page_size)
+        esp.add_search(self, page, page_size, **kwargs)
         responses = esp.search()
 
         # there will only be a single response from a ElasticsearchForm
@@ -77,20 +171,50 @@ class ElasticsearchForm(forms.Form):
 
 class ElasticsearchProcessor(object):
 
+    # the parts of a query that `count_only` and `aggs_only` searches don't need
+    COUNT_ONLY_EXCLUDED_KEYS = ('aggs', 'aggregations', 'sort', 'highlight', '_source', 'fields', 'suggest', 'rescore')
+    AGGS_ONLY_EXCLUDED_KEYS = ('sort', 'highlight', '_source', 'fields', 'suggest', 'rescore')
+
+    # response paths that are always kept when responses are filtered: the
+    # paginator needs `hits.total`, and `DSEResponse` the hits' metadata. They
+    # also make sure that no response is filtered out of the `_msearch`
+    # responses completely, which would misalign them with the searches
+    REQUIRED_RESPONSE_PATHS = (
+        'hits.total', 'hits.hits._index', 'hits.hits._type', 'hits.hits._id', 'error', 'took', 'timed_out', '_shards'
+    )
+    SUMMARY_RESPONSE_PATHS = ('aggregations', 'took', 'timed_out')
+
     def __init__(self, es=None):
-        self.es = es or Elasticsearch(es_settings.ELASTICSEARCH_SERVER)
+        self.es = es or get_connection('search')
         self.bulk_search_data = []
         self.page_ranges = []
+        self.summaries = []
+        self.response_paths = []
+        self.search_names = []
 
     def reset(self):
         self.bulk_search_data = []
         self.page_ranges = []
-
-    def add_search(self, query, page=1, page_size=20, index='', doc_type='', query_params={}):
+        self.summaries = []
+        self.response_paths = []
+        self.search_names = []
+
+    def add_search(self, query, page=1, page_size=20, index='', doc_type='', query_params={}, date_range=None,
+                   count_only=False, aggs_only=False, source=None, response_paths=None, profile=False):
+        # `count_only` and `aggs_only` searches don't fetch any hits and return
+        # a `DSESummaryResponse` rather than a `DSEResponse`. `source` limits
+        # the `_source` fields fetched, and `response_paths` the parts of the
+        # response returned (see `ElasticsearchForm.get_response_paths`).
+        # With `profile` (or `ELASTICSEARCH_SEARCH_PROFILE`), the search's
+        # profile is captured into its response's `search_stats`
         if isinstance(query, ElasticsearchForm):
             form = query
+            name = form.__class__.__name__
             index = index or form.get_index()
             doc_type = doc_type or form.get_type()
+            date_range = date_range or form.get_date_range()
+            source = source or form.get_source()
+            response_paths = response_paths or form.get_response_paths()
 
             qp = form.query_params.copy()
             qp.update(query_params)
@@ -99,6 +223,7 @@ class ElasticsearchProcessor(object):
             query = form.prepare_query()
         elif isinstance(query, Search):
             dsl_search = query
+            name = dsl_search.__class__.__name__
             index = index or dsl_search._index
             doc_type = doc_type or dsl_search._doc_type
 
@@ -108,7 +233,7 @@ class ElasticsearchProcessor(object):
 
             query = dsl_search.to_dict()
         elif isinstance(query, dict):
-            pass
+            name = ''
         else:
             # we don't support any other type of object
             return
@@ -123,13 +248,38 @@ class ElasticsearchProcessor(object):
         except ValueError:
             page_size = 20
 
-        query['from'] = (page - 1) * page_size
-        query['size'] = page_size
+        data = query_params.copy()
+
+        if count_only or aggs_only:
+            excluded = self.COUNT_ONLY_EXCLUDED_KEYS if count_only else self.AGGS_ONLY_EXCLUDED_KEYS
+            query = dict((k, v) for k, v in query.items() if k not in excluded)
+            query['size'] = 0
+            # hit-less results can be served from the shard request cache
+            data.setdefault('request_cache', True)
+            if response_paths is None:
+                response_paths = self.SUMMARY_RESPONSE_PATHS
+        else:
+            query['from'] = (page - 1) * page_size
+            query['size'] = page_size
+            if source is not None:
+                query['_source'] = source
+
+        if profile or es_settings.ELASTICSEARCH_SEARCH_PROFILE:
+            query['profile'] = True
+            if response_paths is not None:
+                response_paths = list(response_paths) + ['profile']
 
         # save these here so we can attach the info the the responses below
         self.page_ranges.append((page, page_size))
-
-        data = query_params.copy()
+        self.summaries.append(count_only or aggs_only)
+        self.response_paths.append(response_paths)
+        self.search_names.append(name)
+        if index and date_range:
+            if not isinstance(index, six.string_types):
+                index = ','.join(index)
+            index = get_partitioned_index_names(index, *date_range)
+            # partitions without any documents have no index
+            data.setdefault('ignore_unavailable', True)
         if index:
             data['index'] = index
         if doc_type:
@@ -138,14 +288,71 @@ class ElasticsearchProcessor(object):
         self.bulk_search_data.append(data)
         self.bulk_search_data.append(query)
 
+    def get_filter_path(self):
+        # the responses can only be filtered if every search declared the
+        # paths it needs
+        if not self.response_paths or any(paths is None for paths in self.response_paths):
+            return None
+
+        paths = set(self.REQUIRED_RESPONSE_PATHS)
+        for tmp in self.response_paths:
+            paths.update(tmp)
+        return ','.join(sorted('responses.{0}'.format(path) for path in paths))
+
+    def get_search_stats(self, i, response, round_trip):
+        # all searches share the `_msearch` request's round trip time
+        header, query = self.bulk_search_data[i * 2:i * 2 + 2]
+        return {
+            'name': self.search_names[i],
+            'index': header.get('index', ''),
+            'query': query,
+            'round_trip': round_trip,
+            'took': response.get('took', 0) / 1000.0,
+            'timed_out': response.get('timed_out', False),
+            'shards': response.get('_shards', {}),
+            'profile': response.get('profile'),
+        }
+
+    def log_slow_searches(self, search_stats):
+        threshold = es_settings.ELASTICSEARCH_SLOW_SEARCH_THRESHOLD
+        if threshold is None:
+            return
+
+        for stats in search_stats:
+            if max(stats['took'], stats['round_trip']) >= threshold:
+                logger.warning(
+                    'Slow search (%.3fs took, %.3fs round trip) by %s on %s: %s',
+                    stats['took'], stats['round_trip'], stats['name'] or 'query', stats['index'] or '_all',
+                    json.dumps(normalize_query(stats['query']), sort_keys=True)
+                )
+
     def search(self):
         responses = []
 
         if self.bulk_search_data:
-            data = self.es.msearch(self.bulk_search_data)
+            filter_path = self.get_filter_path()
+            start = time.time()
+            if filter_path:
+                data = self.es.msearch(self.bulk_search_data, filter_path=filter_path)
+            else:
+                data = self.es.msearch(self.bulk_search_data)
+            round_trip = time.time() - start
+
             if data:
+                search_stats = []
                 for i, tmp in enumerate(data.get('responses', [])):
-                    responses.append(DSEResponse(tmp, *self.page_ranges[i]))
+                    stats = self.get_search_stats(i, tmp, round_trip)
+                    search_stats.append(stats)
+                    if filter_path:
+                        # empty hit lists are filtered out
+                        tmp.setdefault('hits', {}).setdefault('hits', [])
+                    if self.summaries[i]:
+                        responses.append(DSESummaryResponse(tmp, stats))
+                    else:
+                        responses.append(DSEResponse(tmp, *self.page_ranges[i], search_stats=stats))
+
+                self.log_slow_searches(search_stats)
+                post_search.send(self.__class__, searches=search_stats)
 
         self.reset()
 
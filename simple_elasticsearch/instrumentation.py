@@ -0,0 +1,116 @@
+import hashlib
+import threading
+import time
+from elasticsearch import Elasticsearch
+from elasticsearch.transport import Transport
+
+_state = threading.local()
+
+
+class CallCollector(object):
+    """
+    Records every Elasticsearch request made (through a client from
+    `get_elasticsearch`) on the current thread between `start()` and `stop()`,
+    or within a `with` block. Collectors can be nested; each records all calls
+    made while it's active.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def start(self):
+        if not hasattr(_state, 'collectors'):
+            _state.collectors = []
+        _state.collectors.append(self)
+        return self
+
+    def stop(self):
+        collectors = getattr(_state, 'collectors', [])
+        if self in collectors:
+            collectors.remove(self)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record(self, operation, index, duration, size, signature=None):
+        self.calls.append({
+            'operation': operation,
+            'index': index,
+            'duration': duration,
+            'size': size,
+            'signature': signature,
+        })
+
+    @property
+    def count(self):
+        return len(self.calls)
+
+    @property
+    def duration(self):
+        return sum(call['duration'] for call in self.calls)
+
+    @property
+    def size(self):
+        return sum(call['size'] for call in self.calls)
+
+    @property
+    def duplicates(self):
+        # the number of calls repeating an earlier, identical request
+        signatures = [call['signature'] for call in self.calls if call['signature']]
+        return len(signatures) - len(set(signatures))
+
+    def get_server_timing(self):
+        return 'es;dur={0:.1f};desc="{1} Elasticsearch call{2}"'.format(
+            self.duration * 1000, self.count, '' if self.count == 1 else 's'
+        )
+
+
+def get_call_collectors():
+    return getattr(_state, 'collectors', [])
+
+
+def get_operation(method, url):
+    # eg. ('search', 'blog') for '/blog/posts/_search', ('get', 'blog') for
+    # GET '/blog/posts/1'
+    parts = [part for part in url.split('/') if part]
+    index = parts[0] if parts and not parts[0].startswith('_') else ''
+
+    for part in reversed(parts):
+        if part.startswith('_'):
+            return part[1:], index
+
+    if len(parts) >= 3:
+        return {'GET': 'get', 'HEAD': 'exists', 'DELETE': 'delete'}.get(method, 'index'), index
+    return method.lower(), index
+
+
+class InstrumentedTransport(Transport):
+    # only does any extra work while a `CallCollector` is active
+
+    def perform_request(self, method, url, params=None, body=None):
+        collectors = get_call_collectors()
+        if not collectors:
+            return super(InstrumentedTransport, self).perform_request(method, url, params, body)
+
+        data = self.serializer.dumps(body) if body is not None else ''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        start = time.time()
+        try:
+            return super(InstrumentedTransport, self).perform_request(method, url, params, body)
+        finally:
+            duration = time.time() - start
+            operation, index = get_operation(method, url)
+            signature = hashlib.sha1(method.encode('utf-8') + url.encode('utf-8') + data).hexdigest()
+            for collector in collectors:
+                collector.record(operation, index, duration, len(data), signature)
+
+
+def get_elasticsearch(*args, **kwargs):
+    # an `Elasticsearch` client whose requests can be recorded with a `CallCollector`
+    kwargs.setdefault('transport_class', InstrumentedTransport)
+    return Elasticsearch(*args, **kwargs)
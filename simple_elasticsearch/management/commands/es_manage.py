@@ -3,7 +3,9 @@ from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from ...utils import get_indices, create_indices, rebuild_indices
+from ...breaker import get_spool, replay_spool
+from ...utils import get_indices, create_indices, rebuild_indices, export_indices, import_indices, measure_queryset_iterator, verify_index, \
+    rebuild_indices_from_index
 
 try:
     raw_input
@@ -47,6 +49,12 @@ class Command(BaseCommand):
             dest='rebuild',
             default=False
         ),
+        make_option(
+            '--reindex',
+            action='store_true',
+            dest='reindex',
+            default=False
+        ),
         make_option(
             '--no_input',
             action='store_true',
@@ -58,6 +66,67 @@ class Command(BaseCommand):
             action='store',
             dest='indexes',
             default=''
+        ),
+        make_option(
+            '--export',
+            action='store',
+            dest='export_dir',
+            default=''
+        ),
+        make_option(
+            '--import',
+            action='store',
+            dest='import_dir',
+            default=''
+        ),
+        make_option(
+            '--measure-iteration',
+            action='store_true',
+            dest='measure_iteration',
+            default=False
+        ),
+        make_option(
+            '--alias-each',
+            action='store_true',
+            dest='alias_each',
+            default=False
+        ),
+        make_option(
+            '--from-index',
+            action='store_true',
+            dest='from_index',
+            default=False
+        ),
+        make_option(
+            '--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1
+        ),
+        make_option(
+            '--replay-spool',
+            action='store_true',
+            dest='replay_spool',
+            default=False
+        ),
+        make_option(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False
+        ),
+        make_option(
+            '--repair',
+            action='store_true',
+            dest='repair',
+            default=False
+        ),
+        make_option(
+            '--stale',
+            action='store_true',
+            dest='stale',
+            default=False
         )
     )
 
@@ -73,7 +142,19 @@ class Command(BaseCommand):
         elif options.get('initialize'):
             self.subcommand_initialize(requested_indexes, no_input)
         elif options.get('rebuild'):
-            self.subcommand_rebuild(requested_indexes, no_input)
+            self.subcommand_rebuild(requested_indexes, no_input, options.get('workers') or 1, options.get('alias_each'), options.get('from_index'))
+        elif options.get('reindex'):
+            self.subcommand_reindex(requested_indexes, no_input)
+        elif options.get('measure_iteration'):
+            self.subcommand_measure_iteration(requested_indexes)
+        elif options.get('export_dir'):
+            self.subcommand_export(options['export_dir'], requested_indexes)
+        elif options.get('import_dir'):
+            self.subcommand_import(options['import_dir'], requested_indexes, no_input, options.get('workers') or 1)
+        elif options.get('replay_spool'):
+            self.subcommand_replay_spool()
+        elif options.get('verify'):
+            self.subcommand_verify(requested_indexes, options.get('repair'), options.get('stale'), options.get('workers') or 1)
 
     def subcommand_list(self):
         print("Available ES indexes:")
@@ -96,7 +177,7 @@ class Command(BaseCommand):
             for alias, index in aliases:
                 print("'{0}' aliased to '{1}'".format(alias, index))
 
-    def subcommand_rebuild(self, indexes, no_input=False):
+    def subcommand_rebuild(self, indexes, no_input=False, workers=1, alias_each=False, from_index=False):
         if getattr(settings, 'DEBUG', False):
             import warnings
             warnings.warn('Rebuilding with `settings.DEBUG = True` can result in out of memory crashes. See https://docs.djangoproject.com/en/stable/ref/settings/#debug', stacklevel=2)
@@ -107,12 +188,26 @@ class Command(BaseCommand):
             if user_input in ['n', '']:
                 break
 
-        if user_input == 'y':
+        if user_input == 'y' and from_index:
+            # documents are copied by the cluster from the current indices
+            sys.stdout.write("Rebuilding ES indexes from the current indexes: ")
+            stats = {}
+            results, aliases = rebuild_indices_from_index(indices=indexes, stats=stats)
+            sys.stdout.write("complete.\n")
+            for alias, index in aliases:
+                print("'{0}' rebuilt and aliased to '{1}'".format(alias, index))
+            for (source, index), response in sorted(stats.items()):
+                print("'{0}' copied to '{1}': {2} documents in {3:.1f}s".format(
+                    source, index, response.get('created', 0), response.get('took', 0) / 1000.0
+                ))
+        elif user_input == 'y':
             sys.stdout.write("Rebuilding ES indexes: ")
-            results, aliases = rebuild_indices(indices=indexes)
+            stats = {}
+            results, aliases = rebuild_indices(indices=indexes, workers=workers, alias_each=alias_each, stats=stats)
             sys.stdout.write("complete.\n")
             for alias, index in aliases:
                 print("'{0}' rebuilt and aliased to '{1}'".format(alias, index))
+            self.print_stats(stats)
 
         # TODO: need to offer choice to delete old de-aliased indexes
         # while user_input != 'y':
@@ -128,3 +223,109 @@ class Command(BaseCommand):
         #         print "'{0}' rebuilt and aliased to '{1}'".format(alias, index)
         else:
             print("You chose not to rebuild indices.")
+
+    def subcommand_reindex(self, indexes, no_input=False):
+        if getattr(settings, 'DEBUG', False):
+            import warnings
+            warnings.warn('Reindexing with `settings.DEBUG = True` can result in out of memory crashes. See https://docs.djangoproject.com/en/stable/ref/settings/#debug', stacklevel=2)
+
+        user_input = 'y' if no_input else ''
+        while user_input != 'y':
+            user_input = raw_input('Are you sure you want to reindex {0} index(es) in place? [y/N]: '.format('the ' + ', '.join(indexes) if indexes else '**ALL**')).lower()
+            if user_input in ['n', '']:
+                break
+
+        if user_input == 'y':
+            # unlike a rebuild, this writes into the existing (aliased) indices,
+            # so unchanged documents are skipped when fingerprinting is enabled
+            sys.stdout.write("Reindexing ES indexes: ")
+            stats = {}
+            for index_name, type_classes in get_indices(indexes).items():
+                for type_class in type_classes:
+                    stats[(index_name, type_class.get_type_name())] = type_class.bulk_index()
+            sys.stdout.write("complete.\n")
+            self.print_stats(stats)
+        else:
+            print("You chose not to reindex indices.")
+
+    def print_stats(self, stats):
+        for (alias, type_name), result in sorted(stats.items()):
+            print("'{0}' type '{1}': {2} indexed, {3} deleted, {4} skipped as unchanged, {5} failed".format(
+                alias, type_name, result['indexed'], result['deleted'], result['skipped'], result['failed']
+            ))
+            if 'batch_sizes' in result:
+                print("  - {0} bulk requests of {1} to {2} documents (mean {3:.0f}), last batch size {4}".format(
+                    result['batch_sizes']['batches'], result['batch_sizes']['min'], result['batch_sizes']['max'],
+                    result['batch_sizes']['mean'], result['batch_sizes']['last']
+                ))
+
+    def subcommand_measure_iteration(self, indexes):
+        print("Queryset iteration (sliced vs. streaming):")
+        for index_name, type_classes in get_indices(indexes).items():
+            print(" - index '{0}':".format(index_name))
+            for type_class in type_classes:
+                for streaming in (False, True):
+                    result = measure_queryset_iterator(type_class.get_queryset(), type_class.get_query_limit(), streaming)
+                    print("  - type '{0}' ({1}): {2} rows in {3:.2f}s ({4:.0f} rows/s), peak RSS {5}".format(
+                        type_class.get_type_name(),
+                        'streaming' if streaming else 'sliced',
+                        result['rows'],
+                        result['seconds'],
+                        result['rows_per_second'],
+                        '{0:.1f}MB'.format(result['peak_rss'] / 1024.0 / 1024) if result['peak_rss'] is not None else 'unknown'
+                    ))
+
+    def subcommand_export(self, directory, indexes):
+        if getattr(settings, 'DEBUG', False):
+            import warnings
+            warnings.warn('Exporting with `settings.DEBUG = True` can result in out of memory crashes. See https://docs.djangoproject.com/en/stable/ref/settings/#debug', stacklevel=2)
+
+        sys.stdout.write("Exporting ES documents: ")
+        results = export_indices(directory, indexes)
+        sys.stdout.write("complete.\n")
+        for alias, type_name, path in results:
+            print("'{0}' type '{1}' exported to '{2}'".format(alias, type_name, path))
+
+    def subcommand_import(self, directory, indexes, no_input=False, workers=1):
+        user_input = 'y' if no_input else ''
+        while user_input != 'y':
+            user_input = raw_input('Are you sure you want to import {0} index(es) from \'{1}\'? [y/N]: '.format('the ' + ', '.join(indexes) if indexes else '**ALL**', directory)).lower()
+            if user_input in ['n', '']:
+                break
+
+        if user_input == 'y':
+            sys.stdout.write("Importing ES indexes: ")
+            results, aliases = import_indices(directory, indices=indexes, workers=workers)
+            sys.stdout.write("complete.\n")
+            for alias, index in aliases:
+                print("'{0}' imported and aliased to '{1}'".format(alias, index))
+        else:
+            print("You chose not to import indices.")
+
+    def subcommand_replay_spool(self):
+        spool = get_spool()
+        if spool is None:
+            raise ESCommandError('`ELASTICSEARCH_SPOOL_PATH` is not set.')
+
+        sys.stdout.write("Replaying {0} spooled writes: ".format(len(spool)))
+        stats = replay_spool(spool)
+        sys.stdout.write("complete.\n")
+        print("{0} indexed, {1} deleted, {2} skipped, {3} failed".format(
+            stats['indexed'], stats['deleted'], stats['skipped'], stats['failed']
+        ))
+
+    def subcommand_verify(self, indexes, repair=False, stale=False, workers=1):
+        print("Index vs. database drift{0}:".format(' (repairing)' if repair else ''))
+        for index_name, type_classes in get_indices(indexes).items():
+            print(" - index '{0}':".format(index_name))
+            for type_class in type_classes:
+                result = verify_index(type_class, repair=repair, stale=stale, slices=workers)
+                print("  - type '{0}': {1} indexed, {2} in the database; {3} missing, {4} extra{5}".format(
+                    type_class.get_type_name(), result['indexed'], result['expected'],
+                    result['missing'], result['extra'],
+                    ', {0} stale'.format(result['stale']) if stale else ''
+                ))
+                for key in ('missing', 'extra', 'stale'):
+                    samples = result['samples'][key]
+                    if samples:
+                        print("    {0}: {1}{2}".format(key, ', '.join(str(id) for id in samples), ', ...' if result[key] > len(samples) else ''))
@@ -0,0 +1,48 @@
+import logging
+
+from .instrumentation import CallCollector
+
+logger = logging.getLogger('simple_elasticsearch.calls')
+
+
+class ElasticsearchCallsMiddleware(object):
+    """
+    Records the Elasticsearch calls made while handling each request into
+    `request.elasticsearch_calls` (a `CallCollector`), adds their totals to the
+    response's `Server-Timing` header and logs them (at DEBUG level, or as a
+    warning when identical requests were repeated).
+    """
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        self.process_request(request)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            request.elasticsearch_calls.stop()
+            raise
+        return self.process_response(request, response)
+
+    def process_request(self, request):
+        request.elasticsearch_calls = CallCollector().start()
+
+    def process_response(self, request, response):
+        collector = getattr(request, 'elasticsearch_calls', None)
+        if collector is None:
+            return response
+        collector.stop()
+
+        if collector.count:
+            server_timing = collector.get_server_timing()
+            if response.has_header('Server-Timing'):
+                server_timing = '{0}, {1}'.format(response['Server-Timing'], server_timing)
+            response['Server-Timing'] = server_timing
+
+            logger.log(
+                logging.WARNING if collector.duplicates else logging.DEBUG,
+                '%s %s: %d Elasticsearch calls (%d repeated), %.1fms, %d bytes sent',
+                request.method, request.path, collector.count, collector.duplicates, collector.duration * 1000, collector.size
+            )
+
+        return response
@@ -0,0 +1,91 @@
+import sys
+import threading
+
+from . import settings as es_settings
+from .instrumentation import get_elasticsearch
+from .utils import BackgroundWorker
+
+
+class Mirror(object):
+    """
+    A secondary cluster that writes are copied to. Requests are queued and
+    sent from the mirror's own background thread, so a slow or failing mirror
+    never holds up writes to the primary cluster; requests that don't fit in
+    the queue are dropped (unless sent with `block`, eg. a rebuild's, which
+    wait for room instead) and counted, as are the ones that fail. Requests
+    are only handed plain data, as they run on the mirror's thread.
+    """
+    def __init__(self, name, es, queue_size=10000):
+        self.name = name
+        self.es = es
+        self.worker = BackgroundWorker(queue_size)
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_error = None
+
+    def send(self, request, block=False):
+        # queues `request`, a callable taking the mirror's client
+        if block:
+            self.worker.put(self.call, request)
+        elif not self.worker.put_nowait(self.call, request):
+            with self.lock:
+                self.dropped += 1
+
+    def call(self, request):
+        try:
+            response = request(self.es)
+        except Exception as e:
+            self.record_failure(e)
+            return
+
+        if isinstance(response, dict) and response.get('errors'):
+            # a bulk request with failed items
+            self.record_failure('bulk request with errors')
+        else:
+            with self.lock:
+                self.sent += 1
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failed += 1
+            self.last_error = repr(error)
+        sys.stderr.write('Elasticsearch mirror `{0}` request failed: {1!r}\n'.format(self.name, error))
+
+    def join(self):
+        # blocks until everything queued so far has been sent
+        self.worker.join()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'pending': self.worker.queue.qsize(),
+                'last_error': self.last_error,
+            }
+
+
+_lock = threading.Lock()
+_mirrors = None
+
+
+def get_mirrors():
+    # the `Mirror` of every cluster in `ELASTICSEARCH_MIRRORS`
+    global _mirrors
+    with _lock:
+        if _mirrors is None:
+            _mirrors = []
+            for name, params in sorted(es_settings.ELASTICSEARCH_MIRRORS.items()):
+                params = dict(params)
+                queue_size = params.pop('queue_size', es_settings.ELASTICSEARCH_MIRROR_QUEUE_SIZE)
+                _mirrors.append(Mirror(name, get_elasticsearch(**params), queue_size))
+        return _mirrors
+
+
+def reset_mirrors():
+    global _mirrors
+    with _lock:
+        _mirrors = None
@@ -1,16 +1,78 @@
-from elasticsearch import Elasticsearch, TransportError
+import contextlib
+import datetime
+import threading
+import weakref
+from django.conf import settings
+from django.db import models
+from django.utils import six, timezone
+from elasticsearch import TransportError
 
 from . import settings as es_settings
-from .exceptions import MissingObjectError
-from .utils import queryset_iterator
+from .breaker import get_circuit_breaker, get_spool, is_unavailable_error
+from .exceptions import MissingObjectError, CircuitOpenError
+from .connections import get_connection_params
+from .instrumentation import get_elasticsearch
+from .mirrors import get_mirrors
+from .registry import registry
+from .utils import queryset_iterator, get_django_cache, get_document_fingerprint, chunked, run_after_commit, background, \
+    AdaptiveBulkController, get_partition_name, get_partition_alias, get_partition_range, create_partition_index, \
+    wait_for_task, get_bulk_body, get_fingerprint_generation, reset_fingerprints, UNDATED_PARTITION
+
+_signal_state = threading.local()
+
+# the partition aliases known to exist, so each is only checked once per process
+_partition_aliases = set()
+# and those known to exist on each mirror, by the mirror's client
+_mirror_partition_aliases = weakref.WeakKeyDictionary()
+_mirror_partition_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def suppress_signal_indexing(type_classes=None):
+    # `save_handler` and `delete_handler` do nothing within this block (in the
+    # current thread) for `type_classes`, or all type classes if not given;
+    # used where the affected objects are indexed in bulk instead
+    suppressed = getattr(_signal_state, 'suppressed', 0)
+    suppressed_classes = getattr(_signal_state, 'suppressed_classes', ())
+    if type_classes is None:
+        _signal_state.suppressed = suppressed + 1
+    else:
+        _signal_state.suppressed_classes = tuple(suppressed_classes) + tuple(type_classes)
+    try:
+        yield
+    finally:
+        _signal_state.suppressed = suppressed
+        _signal_state.suppressed_classes = suppressed_classes
+
+
+def signal_indexing_suppressed(type_class=None):
+    if getattr(_signal_state, 'suppressed', 0):
+        return True
+    return type_class is not None and type_class in getattr(_signal_state, 'suppressed_classes', ())
+
+
+def get_concrete_fields(model):
+    # `_meta.concrete_fields` is Django 1.6+; `model` can be an instance too
+    return getattr(model._meta, 'concrete_fields', model._meta.fields)
 
 
 class ElasticsearchIndexMixin(object):
 
     @classmethod
-    def get_es(cls):
+    def get_es(cls, profile=None):
+        # `profile` is one of `connections.CONNECTION_PROFILES`; profiles
+        # without settings of their own use the default client
+        if profile is not None and profile in es_settings.ELASTICSEARCH_CONNECTION_PROFILES:
+            if not hasattr(cls, '_es_profiles'):
+                cls._es_profiles = {}
+            if profile not in cls._es_profiles:
+                cls._es_profiles[profile] = get_elasticsearch(
+                    **get_connection_params(profile, cls.get_es_connection_settings())
+                )
+            return cls._es_profiles[profile]
+
         if not hasattr(cls, '_es'):
-            cls._es = Elasticsearch(**cls.get_es_connection_settings())
+            cls._es = get_elasticsearch(**cls.get_es_connection_settings())
         return cls._es
 
     @classmethod
@@ -47,6 +109,16 @@ class ElasticsearchIndexMixin(object):
     def get_queryset(cls):
         raise NotImplementedError
 
+    @classmethod
+    def get_model(cls):
+        # the Django model whose saves/deletes this type class indexes
+        if issubclass(cls, models.Model):
+            return cls
+        try:
+            return cls.get_queryset().model
+        except NotImplementedError:
+            return None
+
     @classmethod
     def get_bulk_index_limit(cls):
         return 100
@@ -55,74 +127,662 @@ class ElasticsearchIndexMixin(object):
     def get_query_limit(cls):
         return 100
 
+    @classmethod
+    def get_bulk_controller(cls):
+        # returns a new `AdaptiveBulkController` for a `bulk_index` run, or None
+        # to always send batches of `get_bulk_index_limit()` documents
+        if es_settings.ELASTICSEARCH_ADAPTIVE_BULK is None:
+            return None
+
+        options = {'batch_size': cls.get_bulk_index_limit()}
+        options.update(es_settings.ELASTICSEARCH_ADAPTIVE_BULK)
+        return AdaptiveBulkController(**options)
+
     @classmethod
     def should_index(cls, obj):
         return True
 
     @classmethod
-    def bulk_index(cls, es=None, index_name='', queryset=None):
-        es = es or cls.get_es()
+    def get_partition_field(cls):
+        # the date(time) field (eg. 'created_at') to partition documents by:
+        # each partition is a separate index, all of them searchable through
+        # the `get_index_name()` alias; None keeps everything in one index
+        return None
+
+    @classmethod
+    def get_partition_interval(cls):
+        # 'year', 'month' or 'day'
+        return 'month'
+
+    @classmethod
+    def get_partition(cls, obj):
+        # by UTC date; objects without one are in the 'undated' partition
+        field = cls.get_partition_field()
+        if field is None:
+            return None
+        return get_partition_name(getattr(obj, field), cls.get_partition_interval())
+
+    @classmethod
+    def get_loaded_partition(cls, instance):
+        # the partition `instance` was in when it was loaded (see
+        # `init_handler`), or None if that isn't known
+        field = cls.get_partition_field()
+        loaded = getattr(instance, '_es_loaded_values', None)
+        if field is None or loaded is None:
+            return None
+
+        attname = instance._meta.get_field(field).attname
+        if attname not in loaded:
+            return None
+        return get_partition_name(loaded[attname], cls.get_partition_interval())
+
+    @classmethod
+    def get_partitions(cls):
+        # the partitions `create_indices` creates an index for: those of all
+        # the objects in the queryset, or the current one if there are none
+        field = cls.get_partition_field()
+        if field is None:
+            return []
+
+        interval = cls.get_partition_interval()
+        queryset = cls.get_queryset()
+        if isinstance(queryset.model._meta.get_field(field), models.DateTimeField) and hasattr(queryset, 'datetimes'):
+            values = queryset.datetimes(field, interval, tzinfo=timezone.utc)
+        else:
+            # before Django 1.6, `dates()` truncates datetimes too (as stored, in UTC)
+            values = queryset.dates(field, interval)
+        partitions = set(get_partition_name(value, interval) for value in values)
+        if queryset.filter(**{'{0}__isnull'.format(field): True}).exists():
+            partitions.add(UNDATED_PARTITION)
+        return sorted(partitions) or [get_partition_name(timezone.now(), interval)]
+
+    @classmethod
+    def get_partition_queryset(cls, partition):
+        field = cls.get_partition_field()
+        queryset = cls.get_queryset()
+        if field is None:
+            return queryset
+        if partition == UNDATED_PARTITION:
+            return queryset.filter(**{'{0}__isnull'.format(field): True})
+
+        start, end = get_partition_range(partition, cls.get_partition_interval())
+        if isinstance(queryset.model._meta.get_field(field), models.DateTimeField):
+            # from midnight UTC, like `get_partition`
+            start, end = [datetime.datetime.combine(day, datetime.time()) for day in (start, end)]
+            if settings.USE_TZ:
+                start, end = [timezone.make_aware(value, timezone.utc) for value in (start, end)]
+        return queryset.filter(**{
+            '{0}__gte'.format(field): start,
+            '{0}__lt'.format(field): end
+        })
+
+    @classmethod
+    def get_write_index_name(cls, obj, create=True):
+        # the index alias `obj` is written to: its partition's, for a
+        # partitioned type class, creating that partition's index if needed
+        # (and `create` is set)
+        partition = cls.get_partition(obj)
+        if partition is None:
+            return cls.get_index_name()
+
+        index_name = get_partition_alias(cls.get_index_name(), partition)
+        if create and index_name not in _partition_aliases:
+            if create_partition_index(cls.get_es('admin'), cls.get_index_name(), partition) is not None:
+                # a partition that was deleted may have had documents fingerprinted
+                reset_fingerprints(cls.get_index_name())
+            _partition_aliases.add(index_name)
+        return index_name
+
+    @classmethod
+    def get_mirror_request(cls, request, partitions):
+        # wraps the mirror `request` of writes to `partitions` so that it first
+        # creates their indices on the mirror, as `get_write_index_name` does
+        # on the primary; a mirror would otherwise create a bare index, with
+        # no mappings or aliases, on the first write to a new partition
+        partitions = sorted(set(partition for partition in partitions if partition is not None))
+        if not partitions:
+            return request
+        index_alias = cls.get_index_name()
+
+        def mirror_request(es):
+            with _mirror_partition_lock:
+                known = _mirror_partition_aliases.setdefault(es, set())
+            for partition in partitions:
+                partition_alias = get_partition_alias(index_alias, partition)
+                if partition_alias not in known:
+                    create_partition_index(es, index_alias, partition)
+                    known.add(partition_alias)
+            return request(es)
+        return mirror_request
+
+    @classmethod
+    def get_document_dependencies(cls):
+        # maps model field names to the (top level) document fields built from
+        # them, eg. {'title': ['title', 'title_suggest'], 'view_count': []};
+        # saves that only change mapped fields send a partial update, any other
+        # change falls back to indexing the whole document
+        return {}
+
+    @classmethod
+    def get_partial_document(cls, obj, fields):
+        document = cls.get_document(obj)
+        return dict((field, document[field]) for field in fields if field in document)
+
+    @classmethod
+    def get_document_fields(cls, model_fields):
+        # the document fields affected by changes to `model_fields`, or None if
+        # any of them isn't in `get_document_dependencies()`
+        dependencies = cls.get_document_dependencies()
+        if not dependencies:
+            return None
+
+        model = cls.get_model()
+        attnames = {}
+        if model is not None:
+            attnames = dict((field.attname, field.name) for field in get_concrete_fields(model))
+
+        result = set()
+        for name in model_fields:
+            name = attnames.get(name, name)
+            if name not in dependencies:
+                return None
+            result.update(dependencies[name])
+        return result
+
+    @classmethod
+    def get_related_dependencies(cls):
+        # other models whose data the documents embed, eg.
+        # [{'model': Blog, 'lookup': 'blog_id', 'fields': ['name', 'description']}];
+        # `model` can also be an 'app_label.ModelName' string, `lookup` selects
+        # this type class's objects by the related object's pk and the optional
+        # `fields` limits reindexing to saves that update those fields
+        return []
+
+    @classmethod
+    def get_dependency_model(cls, dependency):
+        model = dependency['model']
+        if isinstance(model, six.string_types):
+            try:
+                from django.apps import apps
+                model = apps.get_model(model)
+            except ImportError:
+                # Django < 1.7
+                model = models.get_model(*model.split('.', 1))
+        return model
+
+    @classmethod
+    def get_related_update(cls, dependency, related_pks):
+        # return an `_update_by_query` body (eg. a query on the embedded id and a
+        # script setting the embedded fields) to update the dependent documents
+        # in Elasticsearch instead of reindexing them from the database
+        return None
+
+    @classmethod
+    def reindex_related(cls, dependency, related_pks, es=None):
+        es = es or cls.get_es('bulk')
+
+        body = cls.get_related_update(dependency, related_pks)
+        if body is not None:
+            def request(es):
+                return es.transport.perform_request(
+                    'POST',
+                    '/{0}/{1}/_update_by_query'.format(cls.get_index_name(), cls.get_type_name()),
+                    params={'conflicts': 'proceed', 'wait_for_completion': 'false'},
+                    body=body
+                )
+
+            request(es)
+            cls.mirror_write(request)
+            # the updated documents' fingerprints are stale now, and which
+            # documents those are isn't known here
+            reset_fingerprints(cls.get_index_name())
+            return
+
+        queryset = cls.get_queryset().filter(**{'{0}__in'.format(dependency['lookup']): related_pks})
+        pks = queryset.values_list('pk', flat=True).order_by('pk').iterator()
+
+        # each chunk is a separate, small query and `_bulk` batch
+        for chunk in chunked(pks, cls.get_query_limit()):
+            cls.bulk_index(es, queryset=cls.get_queryset().filter(pk__in=chunk))
+
+    @classmethod
+    def get_loaded_values(cls, instance):
+        return dict(
+            (field.attname, instance.__dict__[field.attname])
+            for field in get_concrete_fields(instance)
+            if field.attname in instance.__dict__
+        )
+
+    @classmethod
+    def get_changed_fields(cls, instance):
+        # the names of the fields changed since `instance` was loaded (see
+        # `init_handler`), or None if that isn't known
+        loaded = getattr(instance, '_es_loaded_values', None)
+        if loaded is None:
+            return None
+
+        current = cls.get_loaded_values(instance)
+        return set(
+            field.name
+            for field in get_concrete_fields(instance)
+            if field.attname in loaded and current.get(field.attname) != loaded[field.attname]
+        )
+
+    @classmethod
+    def get_bulk_operation(cls, obj, index_name='', delete=None, fields=None):
+        # returns the list of bulk API lines for `obj`: the operation
+        # instructions/details, followed by the document for index operations
+        # (or the partial document of `fields` for update operations)
+        if delete is None:
+            delete = not cls.should_index(obj)
+
+        data = {
+            # deleting from a partition whose index doesn't exist mustn't create it
+            '_index': index_name or cls.get_write_index_name(obj, create=not delete),
+            '_type': cls.get_type_name(),
+            '_id': cls.get_document_id(obj)
+        }
+        data.update(cls.get_request_params(obj))
+
+        # only append bulk operation data if it's not a delete operation
+        if delete:
+            return [{'delete': data}]
+        if fields:
+            return [{'update': data}, {'doc': cls.get_partial_document(obj, fields)}]
+        return [{'index': data}, cls.get_document(obj)]
+
+    @classmethod
+    def get_fingerprint_cache(cls, index_name=''):
+        # the Django cache holding the fingerprints of indexed documents, or None
+        # if fingerprinting is disabled; writes to any index other than this
+        # type class's own (eg. a rebuild's new index) are never fingerprinted
+        if not es_settings.ELASTICSEARCH_FINGERPRINT_CACHE or index_name not in ('', cls.get_index_name()):
+            return None
+        return get_django_cache(es_settings.ELASTICSEARCH_FINGERPRINT_CACHE)
+
+    @classmethod
+    def get_fingerprint_key(cls, document_id, generation=None):
+        # keys include the index alias' generation (see `reset_fingerprints`);
+        # pass it in when building many keys, to look it up just once
+        if generation is None:
+            generation = get_fingerprint_generation(cls.get_index_name())
+        return 'simple_elasticsearch:fingerprint:{0}:{1}:{2}:{3}'.format(
+            cls.get_index_name(), generation, cls.get_type_name(), document_id
+        )
+
+    @classmethod
+    def get_document_fingerprint(cls, document):
+        return get_document_fingerprint(document)
+
+    @classmethod
+    def bulk_index(cls, es=None, index_name='', queryset=None, fields=None, failed=None):
+        # with `fields`, only those document fields are sent, as partial updates;
+        # the objects whose documents failed are appended to the `failed` list
+        es = es or cls.get_es('bulk')
 
         tmp = []
+        stats = {'indexed': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
+        controller = cls.get_bulk_controller()
 
         if queryset is None:
             queryset = cls.get_queryset()
 
         # this requires that `get_queryset` is implemented
         for i, obj in enumerate(queryset_iterator(queryset, cls.get_query_limit())):
-            delete = not cls.should_index(obj)
+            tmp.append(obj)
+
+            if controller and len(tmp) >= controller.batch_size or not controller and not i % cls.get_bulk_index_limit():
+                cls.bulk_index_objects(tmp, es, index_name, stats, fields, controller, failed=failed)
+                tmp = []
 
-            data = {
-                '_index': index_name or cls.get_index_name(),
-                '_type': cls.get_type_name(),
-                '_id': cls.get_document_id(obj)
-            }
-            data.update(cls.get_request_params(obj))
-            data = {'delete' if delete else 'index': data}
+        if tmp:
+            cls.bulk_index_objects(tmp, es, index_name, stats, fields, controller, failed=failed)
 
-            # bulk operation instructions/details
-            tmp.append(data)
+        if controller:
+            stats['batch_sizes'] = controller.get_stats()
 
-            # only append bulk operation data if it's not a delete operation
-            if not delete:
-                tmp.append(cls.get_document(obj))
+        return stats
 
-            if not i % cls.get_bulk_index_limit():
-                es.bulk(tmp)
-                tmp = []
+    @classmethod
+    def bulk_index_objects(cls, objs, es=None, index_name='', stats=None, fields=None, controller=None, retries=0, failed=None):
+        # indexes (or deletes, see `should_index`) `objs` in a single `_bulk`
+        # request, leaving out the documents whose fingerprint hasn't changed
+        es = es or cls.get_es('bulk')
+        if stats is None:
+            stats = {'indexed': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
+
+        cache = cls.get_fingerprint_cache(index_name)
+        generation = get_fingerprint_generation(cls.get_index_name()) if cache else None
+
+        operations = []
+        fingerprints = {}
+        deleted_keys = []
+        for obj in objs:
+            operation = cls.get_bulk_operation(obj, index_name, fields=fields)
+            key = None
+            if cache:
+                key = cls.get_fingerprint_key(cls.get_document_id(obj), generation)
+                if 'index' in operation[0]:
+                    fingerprints[key] = cls.get_document_fingerprint(operation[1])
+                else:
+                    # a partial update makes the full document's fingerprint stale
+                    deleted_keys.append(key)
+            operations.append((key, operation))
 
+        current = cache.get_many(list(fingerprints.keys())) if fingerprints else {}
+
+        tmp = []
+        sent = []
+        for obj, (key, operation) in zip(objs, operations):
+            if key in fingerprints and current.get(key) == fingerprints[key]:
+                del fingerprints[key]
+                stats['skipped'] += 1
+                continue
+
+            tmp.extend(operation)
+            sent.append((obj, key, 'indexed' if len(operation) > 1 else 'deleted'))
+
+        response = None
         if tmp:
-            es.bulk(tmp)
+            # serialized just once when it's sent to mirrors too
+            body = get_bulk_body(tmp) if cls.get_mirrors() else tmp
+            response = controller.send(es, body, len(sent)) if controller else es.bulk(body)
+            # a new index being loaded (eg. by a rebuild) must get everything
+            partitions = [] if index_name else [cls.get_partition(obj) for obj, key, stat in sent if stat == 'indexed']
+            cls.mirror_write(
+                cls.get_mirror_request(lambda mirror_es: mirror_es.bulk(body), partitions),
+                block=index_name not in ('', cls.get_index_name())
+            )
+
+        items = (response or {}).get('items')
+        if not items:
+            # without per item results, everything sent is taken as written
+            items = [{'index': {'status': 200}}] * len(sent)
+
+        accepted = {}
+        rejected = []
+        missing = []
+        for (obj, key, stat), item in zip(sent, items):
+            action, result = list(item.items())[0]
+            status = result.get('status', 500)
+            if status < 300 or (action == 'delete' and status == 404):
+                stats[stat] += 1
+                if key in fingerprints:
+                    accepted[key] = fingerprints[key]
+            elif status == 429 and controller and retries < controller.max_retries:
+                # the cluster was too busy for it; the controller has backed off already
+                rejected.append(obj)
+            elif action == 'update' and status == 404:
+                # a document that wasn't in the index can't be partially updated
+                missing.append(obj)
+            else:
+                stats['failed'] += 1
+                if failed is not None:
+                    failed.append(obj)
+
+        # only the documents the cluster accepted are fingerprinted
+        if accepted:
+            cache.set_many(accepted, es_settings.ELASTICSEARCH_FINGERPRINT_TIMEOUT)
+        if deleted_keys:
+            cache.delete_many(deleted_keys)
+
+        if rejected:
+            cls.bulk_index_objects(rejected, es, index_name, stats, fields, controller, retries + 1, failed)
+        if missing:
+            # index them in full instead
+            cls.bulk_index_objects(missing, es, index_name, stats, controller=controller, failed=failed)
+
+        return stats
+
+    @classmethod
+    def bulk_delete(cls, objs, es=None, index_name=''):
+        return cls.index_delete_many(objs, es, index_name)
+
+    @classmethod
+    def get_delete_operation(cls, obj_or_id, index_name=''):
+        # the bulk delete line for an object or, without one, a document id
+        # (or a bulk delete line already); ids can't have request params (eg.
+        # routing) or a partition, so the index alias is used for them
+        if isinstance(obj_or_id, dict):
+            return obj_or_id
+        if isinstance(obj_or_id, models.Model):
+            return cls.get_bulk_operation(obj_or_id, index_name, delete=True)[0]
+        if not index_name and cls.get_partition_field():
+            # the alias covers every partition's index, which Elasticsearch
+            # won't write through
+            raise ValueError('Documents of partitioned type `{0}` can only be deleted by object, not id `{1}`.'.format(
+                cls.get_type_name(), obj_or_id
+            ))
+        return {'delete': {
+            '_index': index_name or cls.get_index_name(),
+            '_type': cls.get_type_name(),
+            '_id': obj_or_id
+        }}
+
+    @classmethod
+    def index_delete_many(cls, objs_or_ids, es=None, index_name='', failed=None):
+        # deletes the documents of `objs_or_ids` (objects or document ids) with
+        # a `_bulk` request per `get_bulk_index_limit()` documents; documents
+        # already gone count as `missing` rather than as failures, and the
+        # items that did fail are appended to the `failed` list
+        es = es or cls.get_es('bulk')
+        cache = cls.get_fingerprint_cache(index_name)
+        stats = {'deleted': 0, 'missing': 0, 'failed': 0}
+
+        for chunk in chunked(objs_or_ids, cls.get_bulk_index_limit()):
+            operations = [cls.get_delete_operation(item, index_name) for item in chunk]
+            body = get_bulk_body(operations) if cls.get_mirrors() else operations
+            response = es.bulk(body)
+            # `body` is bound now; the request is sent after the loop moves on
+            cls.mirror_write(lambda mirror_es, body=body: mirror_es.bulk(body))
+
+            for obj_or_id, item in zip(chunk, (response or {}).get('items', [])):
+                status = item.get('delete', {}).get('status', 200)
+                if status == 404:
+                    stats['missing'] += 1
+                elif status >= 300:
+                    stats['failed'] += 1
+                    if failed is not None:
+                        failed.append(obj_or_id)
+                else:
+                    stats['deleted'] += 1
+
+            if cache:
+                generation = get_fingerprint_generation(cls.get_index_name())
+                cache.delete_many([cls.get_fingerprint_key(operation['delete']['_id'], generation) for operation in operations])
+
+        return stats
+
+    @classmethod
+    def delete_queryset(cls, queryset, es=None, index_name=''):
+        # deletes the documents of the objects in `queryset` (which should
+        # still exist; see `ElasticsearchQuerySetMixin.delete()` otherwise)
+        return cls.index_delete_many(queryset_iterator(queryset, cls.get_query_limit()), es, index_name)
+
+    @classmethod
+    def delete_where(cls, query, es=None, slices=None, requests_per_second=None):
+        # deletes the type's documents matching `query` (the query DSL's
+        # `query` part) in the cluster with `_delete_by_query`, split into
+        # `slices` and throttled to `requests_per_second` if given; blocks
+        # until complete and returns the task's response
+        es = es or cls.get_es('bulk')
+        index_alias = cls.get_index_name()
+
+        # the deleted documents' fingerprints have to be forgotten; rather
+        # than fetching all their ids, the whole index's are
+        reset_fingerprints(index_alias)
+
+        params = {'wait_for_completion': 'false', 'conflicts': 'proceed'}
+        if slices is None:
+            slices = es_settings.ELASTICSEARCH_REINDEX_SLICES
+        if slices and slices != 1:
+            params['slices'] = slices
+        if requests_per_second:
+            params['requests_per_second'] = requests_per_second
+
+        def request(es):
+            return es.transport.perform_request(
+                'POST', '/{0}/{1}/_delete_by_query'.format(index_alias, cls.get_type_name()), params=params, body={'query': query}
+            )
+
+        response = request(es)
+        # mirrors run their own task, which isn't waited for
+        cls.mirror_write(request)
+        return wait_for_task(es, response['task'])
+
+    @classmethod
+    def get_mirrors(cls):
+        # the `mirrors.Mirror`s of the clusters this type's writes are copied to
+        return get_mirrors()
+
+    @classmethod
+    def mirror_write(cls, request, block=False):
+        # queues `request` (a callable taking a client) for every mirror; with
+        # `block`, waits for room in their queues rather than dropping it
+        for mirror in cls.get_mirrors():
+            mirror.send(request, block)
+
+    @classmethod
+    def send_write(cls, obj, operation, request, index_name=''):
+        # calls `request` (a single document write) through the circuit
+        # breaker, if enabled; returns False if the write was spooled instead
+        breaker = get_circuit_breaker()
+        if breaker is None:
+            request()
+            return True
+
+        if breaker.allow():
+            try:
+                request()
+            except TransportError as e:
+                if not is_unavailable_error(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                error = e
+            except Exception:
+                breaker.record_error()
+                raise
+            else:
+                breaker.record_success()
+                return True
+        else:
+            error = CircuitOpenError('Elasticsearch writes are failing; not sending any for now.')
+
+        spool = get_spool()
+        if spool is None:
+            raise error
+        spool.append(cls, obj, operation, index_name)
+        return False
 
     @classmethod
     def index_add(cls, obj, index_name=''):
         if obj and cls.should_index(obj):
-            cls.get_es().index(
-                index_name or cls.get_index_name(),
-                cls.get_type_name(),
-                cls.get_document(obj),
-                cls.get_document_id(obj),
-                **cls.get_request_params(obj)
-            )
+            document = cls.get_document(obj)
+            document_id = cls.get_document_id(obj)
+
+            cache = cls.get_fingerprint_cache(index_name)
+            if cache:
+                key = cls.get_fingerprint_key(document_id)
+                fingerprint = cls.get_document_fingerprint(document)
+                if cache.get(key) == fingerprint:
+                    # unchanged since it was last indexed
+                    return False
+
+            # the request only uses plain data, as mirrors send it from their own thread
+            index = index_name or cls.get_write_index_name(obj, create=False)
+            params = cls.get_request_params(obj)
+
+            def request(es):
+                return es.index(index, cls.get_type_name(), document, document_id, **params)
+
+            def write():
+                if not index_name:
+                    # creates the index of a new partition
+                    cls.get_write_index_name(obj)
+                return request(cls.get_es('write'))
+
+            sent = cls.send_write(obj, 'index', write, index_name)
+            if not sent:
+                return False
+            cls.mirror_write(cls.get_mirror_request(request, [None if index_name else cls.get_partition(obj)]))
+
+            if cache:
+                cache.set(key, fingerprint, es_settings.ELASTICSEARCH_FINGERPRINT_TIMEOUT)
             return True
         return False
 
     @classmethod
     def index_delete(cls, obj, index_name=''):
         if obj:
+            # taken now, while the object still has its pk
+            index = index_name or cls.get_write_index_name(obj, create=False)
+            document_id = cls.get_document_id(obj)
+            params = cls.get_request_params(obj)
+
+            def request(es, **kwargs):
+                kwargs.update(params)
+                return es.delete(index, cls.get_type_name(), document_id, **kwargs)
+
+            sent = True
             try:
-                cls.get_es().delete(
-                    index_name or cls.get_index_name(),
-                    cls.get_type_name(),
-                    cls.get_document_id(obj),
-                    **cls.get_request_params(obj)
-                )
+                sent = cls.send_write(obj, 'delete', lambda: request(cls.get_es('write')), index_name)
             except TransportError as e:
                 if e.status_code != 404:
                     raise
-            return True
+            if sent:
+                cls.mirror_write(lambda es: request(es, ignore=404))
+
+            # forgotten even if the delete was spooled, so that the document
+            # can't be skipped as unchanged after the delete is replayed
+            cache = cls.get_fingerprint_cache(index_name)
+            if cache:
+                cache.delete(cls.get_fingerprint_key(document_id))
+            return sent
         return False
 
+    @classmethod
+    def index_update(cls, obj, fields, index_name=''):
+        # sends only the `fields` of the document as a partial update,
+        # indexing the whole document if it isn't in the index yet
+        if obj and cls.should_index(obj):
+            # a missing partition index is a 404 too, and `index_add` creates it
+            index = index_name or cls.get_write_index_name(obj, create=False)
+            document_id = cls.get_document_id(obj)
+            params = cls.get_request_params(obj)
+            body = {'doc': cls.get_partial_document(obj, fields)}
+
+            def request(es):
+                return es.update(index, cls.get_type_name(), document_id, body, **params)
+
+            # the mirrors' fallback document is built here rather than on
+            # their threads (which would query the database there)
+            document = cls.get_document(obj) if cls.get_mirrors() else None
+
+            def mirror_request(es):
+                try:
+                    return request(es)
+                except TransportError as e:
+                    if e.status_code != 404:
+                        raise
+                return es.index(index, cls.get_type_name(), document, document_id, **params)
+
+            try:
+                sent = cls.send_write(obj, 'index', lambda: request(cls.get_es('write')), index_name)
+            except TransportError as e:
+                if e.status_code != 404:
+                    raise
+                return cls.index_add(obj, index_name)
+            if not sent:
+                return False
+            cls.mirror_write(cls.get_mirror_request(mirror_request, [None if index_name else cls.get_partition(obj)]))
+
+            cache = cls.get_fingerprint_cache(index_name)
+            if cache:
+                cache.delete(cls.get_fingerprint_key(document_id))
+            return True
+        return cls.index_delete(obj, index_name)
+
     @classmethod
     def index_add_or_delete(cls, obj, index_name=''):
         if obj:
@@ -132,10 +792,194 @@ class ElasticsearchIndexMixin(object):
                 return cls.index_delete(obj, index_name)
         return False
 
+    @classmethod
+    def init_handler(cls, sender, instance, **kwargs):
+        # connect to `post_init` to have saves send partial updates (see
+        # `get_document_dependencies`) and, for partitioned type classes,
+        # delete documents from the partition their object moves out of
+        instance._es_loaded_values = cls.get_loaded_values(instance)
+
     @classmethod
     def save_handler(cls, sender, instance, **kwargs):
-        cls.index_add_or_delete(instance)
+        if not signal_indexing_suppressed(cls):
+            fields = None
+            if not kwargs.get('created'):
+                previous = cls.get_loaded_partition(instance)
+                if previous is not None and previous != cls.get_partition(instance):
+                    # the document moves to another partition's index, in full;
+                    # its fingerprint (kept by document id) would have it skipped
+                    cls.index_delete(instance, get_partition_alias(cls.get_index_name(), previous))
+                    cache = cls.get_fingerprint_cache()
+                    if cache:
+                        cache.delete(cls.get_fingerprint_key(cls.get_document_id(instance)))
+                else:
+                    changed = kwargs.get('update_fields') or cls.get_changed_fields(instance)
+                    if changed:
+                        fields = cls.get_document_fields(changed)
+
+            if fields is None:
+                cls.index_add_or_delete(instance)
+            elif fields:
+                cls.index_update(instance, fields)
+
+        if hasattr(instance, '_es_loaded_values'):
+            instance._es_loaded_values = cls.get_loaded_values(instance)
 
     @classmethod
     def delete_handler(cls, sender, instance, **kwargs):
-        cls.index_delete(instance)
+        if not signal_indexing_suppressed(cls):
+            cls.index_delete(instance)
+
+    @classmethod
+    def related_init_handler(cls, sender, instance, **kwargs):
+        # connect to `post_init` of the models in `get_related_dependencies`
+        # to only reindex on saves that change the dependencies' `fields`
+        for dependency in cls.get_related_dependencies():
+            if dependency.get('fields') and cls.get_dependency_model(dependency) is sender:
+                instance._es_loaded_values = cls.get_loaded_values(instance)
+                break
+
+    @classmethod
+    def related_save_handler(cls, sender, instance, **kwargs):
+        # connect to `post_save` of the models in `get_related_dependencies`;
+        # the reindexing is queued in memory when ELASTICSEARCH_RELATED_REINDEX_ASYNC
+        # is set, so a fan-out still queued when the process exits is lost
+        if not (signal_indexing_suppressed(cls) or kwargs.get('created') or kwargs.get('raw')):
+            cls.reindex_dependents(sender, instance, kwargs.get('update_fields') or cls.get_changed_fields(instance))
+
+        if hasattr(instance, '_es_loaded_values'):
+            instance._es_loaded_values = cls.get_loaded_values(instance)
+
+    @classmethod
+    def reindex_dependents(cls, sender, instance, changed):
+        for dependency in cls.get_related_dependencies():
+            if cls.get_dependency_model(dependency) is not sender:
+                continue
+
+            # `changed` is None when it isn't known what the save changed
+            if dependency.get('fields') and changed is not None and not set(dependency['fields']) & set(changed):
+                continue
+
+            if es_settings.ELASTICSEARCH_RELATED_REINDEX_ASYNC:
+                # keep the fan-out out of the request, and wait for the commit
+                # so that the worker reads the new data
+                run_after_commit(lambda dependency=dependency, pk=instance.pk: background.put(
+                    cls.reindex_related, dependency, [pk]
+                ))
+            else:
+                cls.reindex_related(dependency, [instance.pk])
+
+
+class ElasticsearchQuerySetMixin(object):
+    """
+    Mix into the QuerySet of a model that has type classes so that `update()`,
+    `bulk_create()` and `delete()` - which don't send `post_save` for every
+    object, or send `pre_delete` one object at a time - keep Elasticsearch up
+    to date with one `_bulk` request per batch of affected objects.
+    """
+    def get_es_type_classes(self):
+        type_classes = []
+        if getattr(settings, 'ELASTICSEARCH_TYPE_CLASSES', None):
+            type_classes = registry.get_type_classes_for_model(self.model)
+        if not type_classes and issubclass(self.model, ElasticsearchIndexMixin):
+            type_classes = [self.model]
+        return type_classes
+
+    def get_es_pk_chunks(self, pks, type_class):
+        return chunked(pks, type_class.get_query_limit())
+
+    def es_bulk_index(self, pks, model_fields=None):
+        for type_class in self.get_es_type_classes():
+            # only the document fields depending on `model_fields` are sent
+            # when the type class declares them all
+            fields = type_class.get_document_fields(model_fields) if model_fields else None
+            if fields is not None and not fields:
+                continue
+
+            for chunk in self.get_es_pk_chunks(pks, type_class):
+                type_class.bulk_index(queryset=type_class.get_queryset().filter(pk__in=chunk), fields=fields)
+
+    def update(self, **kwargs):
+        # the pks must be collected first as the update may change which
+        # objects match this queryset
+        pks = list(self.values_list('pk', flat=True))
+        partitions = self.get_es_partitions(pks, kwargs)
+        rows = super(ElasticsearchQuerySetMixin, self).update(**kwargs)
+        self.es_delete_moved(partitions)
+        self.es_bulk_index(pks, list(kwargs.keys()))
+        return rows
+
+    def get_es_partitions(self, pks, model_fields):
+        # the partitions of the objects, for the type classes partitioned by
+        # one of the `model_fields` being updated
+        partitions = {}
+        for type_class in self.get_es_type_classes():
+            field = type_class.get_partition_field()
+            if field not in model_fields:
+                continue
+
+            interval = type_class.get_partition_interval()
+            partitions[type_class] = dict(
+                (pk, get_partition_name(value, interval))
+                for chunk in self.get_es_pk_chunks(pks, type_class)
+                for pk, value in self.model._default_manager.filter(pk__in=chunk).values_list('pk', field)
+            )
+        return partitions
+
+    def es_delete_moved(self, partitions):
+        # deletes the documents of objects that moved to another partition from
+        # their previous partition's index
+        for type_class, previous in partitions.items():
+            for chunk in self.get_es_pk_chunks(list(previous.keys()), type_class):
+                operations = [
+                    type_class.get_delete_operation(obj, get_partition_alias(type_class.get_index_name(), previous[obj.pk]))
+                    for obj in type_class.get_queryset().filter(pk__in=chunk)
+                    if previous[obj.pk] != type_class.get_partition(obj)
+                ]
+                if operations:
+                    type_class.bulk_delete(operations)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(ElasticsearchQuerySetMixin, self).bulk_create(objs, *args, **kwargs)
+
+        # only backends that return the new primary keys (eg. PostgreSQL) can
+        # be indexed here; reindex the rest yourself
+        self.es_bulk_index([obj.pk for obj in objs if obj.pk is not None])
+        return objs
+
+    def delete(self):
+        type_classes = self.get_es_type_classes()
+        pks = list(self.values_list('pk', flat=True))
+
+        # the objects are needed for their document ids and request params
+        # (eg. routing), so they're fetched before they're gone - a chunk at a
+        # time, keeping just their bulk delete lines; like `delete_handler`,
+        # this includes objects outside `get_queryset()`
+        operations = []
+        for type_class in type_classes:
+            for chunk in self.get_es_pk_chunks(pks, type_class):
+                operations.append((type_class, [
+                    type_class.get_delete_operation(obj) for obj in self.model._default_manager.filter(pk__in=chunk)
+                ]))
+
+        # only this model's handlers are suppressed; objects of other indexed
+        # models deleted by cascade are still removed by theirs
+        with suppress_signal_indexing(type_classes):
+            result = super(ElasticsearchQuerySetMixin, self).delete()
+
+        for type_class, chunk in operations:
+            type_class.bulk_delete(chunk)
+        return result
+
+
+class ElasticsearchQuerySet(ElasticsearchQuerySetMixin, models.query.QuerySet):
+    pass
+
+
+class ElasticsearchManager(models.Manager):
+
+    def get_queryset(self):
+        return ElasticsearchQuerySet(self.model, using=self._db)
+
+    # Django < 1.6
+    get_query_set = get_queryset
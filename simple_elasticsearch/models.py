@@ -1,11 +1,17 @@
 from django.conf import settings
 
+from . import settings as es_settings
+from .registry import registry
+
+
+if es_settings.ELASTICSEARCH_AUTO_CONNECT_SIGNALS:
+    registry.connect_signals()
 
 if getattr(settings, 'IS_TEST', False):
     from django.db import models
-    from django.db.models.signals import post_save, pre_delete
+    from django.db.models.signals import post_init, post_save, pre_delete
 
-    from .mixins import ElasticsearchIndexMixin
+    from .mixins import ElasticsearchIndexMixin, ElasticsearchManager
 
     class Blog(models.Model):
         name = models.CharField(max_length=50)
@@ -18,6 +24,8 @@ if getattr(settings, 'IS_TEST', False):
         body = models.TextField()
         created_at = models.DateTimeField(auto_now_add=True)
 
+        objects = ElasticsearchManager()
+
         @classmethod
         def get_bulk_index_limit(cls):
             return 2
@@ -85,9 +93,28 @@ if getattr(settings, 'IS_TEST', False):
                 }
             }
 
+        @classmethod
+        def get_document_dependencies(cls):
+            return {
+                'title': ['title'],
+                'body': ['body'],
+                'slug': ['slug'],
+            }
+
+        @classmethod
+        def get_related_dependencies(cls):
+            return [{
+                'model': Blog,
+                'lookup': 'blog_id',
+                'fields': ['name', 'description'],
+            }]
+
         @classmethod
         def should_index(cls, obj):
             return obj.slug != 'DO-NOT-INDEX'
 
+    post_init.connect(BlogPost.init_handler, sender=BlogPost)
     post_save.connect(BlogPost.save_handler, sender=BlogPost)
     pre_delete.connect(BlogPost.delete_handler, sender=BlogPost)
+    post_init.connect(BlogPost.related_init_handler, sender=Blog)
+    post_save.connect(BlogPost.related_save_handler, sender=Blog)
@@ -0,0 +1,161 @@
+import sys
+import threading
+from django.conf import settings
+from django.db.models.signals import post_init, post_save, pre_delete
+
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
+
+
+class TypeClassRegistry(object):
+    """
+    Resolves the `ELASTICSEARCH_TYPE_CLASSES` class paths the first time they
+    are needed (not at startup) and keeps index -> type classes, model -> type
+    classes and (index, type name) -> type class lookups so that signal
+    dispatch and management commands don't need to scan every index.
+    """
+    def __init__(self, class_paths=None):
+        self.class_paths = class_paths
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.loaded = False
+            # a plain dict and a list of its keys in registration order, as
+            # OrderedDict isn't available on Python 2.6
+            self.by_index = {}
+            self.index_names = []
+            self.by_model = {}
+            self.by_related_model = {}
+            self.by_type = {}
+
+    def get_class_paths(self):
+        if self.class_paths is not None:
+            return self.class_paths
+
+        class_paths = getattr(settings, 'ELASTICSEARCH_TYPE_CLASSES', ())
+        if not class_paths:
+            raise Exception('Missing `ELASTICSEARCH_TYPE_CLASSES` in project `settings`.')
+        return class_paths
+
+    def load(self):
+        if self.loaded:
+            return
+
+        with self.lock:
+            if self.loaded:
+                return
+
+            for class_path in self.get_class_paths():
+                package_name, klass_name = class_path.rsplit('.', 1)
+                try:
+                    package = import_module(package_name)
+                    klass = getattr(package, klass_name)
+                except ImportError:
+                    sys.stderr.write('Unable to import `{}`.\n'.format(class_path))
+                    continue
+                self.register(klass)
+
+            self.loaded = True
+
+    def register(self, type_class):
+        with self.lock:
+            if type_class.get_index_name() not in self.by_index:
+                self.index_names.append(type_class.get_index_name())
+            self.by_index.setdefault(type_class.get_index_name(), []).append(type_class)
+            self.by_type[(type_class.get_index_name(), type_class.get_type_name())] = type_class
+
+            model = type_class.get_model()
+            if model is not None:
+                self.by_model.setdefault(model, []).append(type_class)
+
+            for dependency in type_class.get_related_dependencies():
+                related_model = type_class.get_dependency_model(dependency)
+                type_classes = self.by_related_model.setdefault(related_model, [])
+                if type_class not in type_classes:
+                    type_classes.append(type_class)
+
+    def get_indices(self, indices=[]):
+        self.load()
+
+        result = {}
+        for k in self.index_names:
+            if not indices or k in indices:
+                result[k] = self.by_index[k]
+        return result
+
+    def get_type_classes_for_model(self, model):
+        self.load()
+
+        type_classes = self.by_model.get(model)
+        if type_classes is None and getattr(model, '_meta', None) is not None:
+            # proxy models share the type classes of their concrete model
+            type_classes = self.by_model.get(model._meta.concrete_model)
+        return type_classes or []
+
+    def get_type_classes_for_related_model(self, model):
+        self.load()
+        return self.by_related_model.get(model, [])
+
+    def get_type_class(self, index_name, type_name):
+        self.load()
+        return self.by_type.get((index_name, type_name))
+
+    def get_type_class_for_index(self, index_name, type_name):
+        # like `get_type_class`, but `index_name` may also be a concrete
+        # (timestamped or partition) index, as found in search hits
+        type_class = self.get_type_class(index_name, type_name)
+        if type_class is not None:
+            return type_class
+
+        matches = [
+            (alias, type_class) for (alias, name), type_class in self.by_type.items()
+            if name == type_name and index_name.startswith(alias + '-')
+        ]
+        if not matches:
+            return None
+        # the longest alias is the most specific match
+        return max(matches, key=lambda match: len(match[0]))[1]
+
+    def init_handler(self, sender, instance, **kwargs):
+        for type_class in self.get_type_classes_for_model(sender):
+            if type_class.get_document_dependencies() or type_class.get_partition_field():
+                type_class.init_handler(sender, instance, **kwargs)
+                return
+        for type_class in self.get_type_classes_for_related_model(sender):
+            type_class.related_init_handler(sender, instance, **kwargs)
+            if hasattr(instance, '_es_loaded_values'):
+                return
+
+    def save_handler(self, sender, instance, **kwargs):
+        # every handler resets the loaded values once it's done, so each is
+        # given those the instance had before the save
+        loaded = getattr(instance, '_es_loaded_values', None)
+        handlers = [type_class.save_handler for type_class in self.get_type_classes_for_model(sender)]
+        handlers += [type_class.related_save_handler for type_class in self.get_type_classes_for_related_model(sender)]
+        for handler in handlers:
+            if loaded is not None:
+                instance._es_loaded_values = loaded
+            handler(sender, instance, **kwargs)
+
+    def delete_handler(self, sender, instance, **kwargs):
+        for type_class in self.get_type_classes_for_model(sender):
+            type_class.delete_handler(sender, instance, **kwargs)
+
+    def connect_signals(self):
+        # handlers are connected for all senders so that nothing needs to be
+        # imported now; each dispatch is a dictionary lookup by model
+        post_init.connect(self.init_handler, dispatch_uid='simple_elasticsearch_init_{0}'.format(id(self)))
+        post_save.connect(self.save_handler, dispatch_uid='simple_elasticsearch_save_{0}'.format(id(self)))
+        pre_delete.connect(self.delete_handler, dispatch_uid='simple_elasticsearch_delete_{0}'.format(id(self)))
+
+    def disconnect_signals(self):
+        post_init.disconnect(dispatch_uid='simple_elasticsearch_init_{0}'.format(id(self)))
+        post_save.disconnect(dispatch_uid='simple_elasticsearch_save_{0}'.format(id(self)))
+        pre_delete.disconnect(dispatch_uid='simple_elasticsearch_delete_{0}'.format(id(self)))
+
+
+registry = TypeClassRegistry()
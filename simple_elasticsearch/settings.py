@@ -4,6 +4,20 @@ from django.conf import settings
 ELASTICSEARCH_SERVER = getattr(settings, 'ELASTICSEARCH_SERVER', ['127.0.0.1:9200', ])
 ELASTICSEARCH_CONNECTION_PARAMS = getattr(settings, 'ELASTICSEARCH_CONNECTION_PARAMS', {'hosts': ELASTICSEARCH_SERVER})
 
+# Override this to give kinds of requests their own connection settings, each updating
+# ELASTICSEARCH_CONNECTION_PARAMS: 'search' (ElasticsearchProcessor), 'suggest' (ElasticsearchSuggester),
+# 'get' (get_from_es_or_None), 'write' (index_add/index_update/index_delete), 'bulk'
+# (bulk_index/bulk_delete) and 'admin' (creating, rebuilding and importing indices). Requests
+# of the same profile share a client.
+# Eg.
+# ELASTICSEARCH_CONNECTION_PROFILES = {
+#     "search": {"timeout": 2, "max_retries": 1, "retry_on_timeout": True, "maxsize": 25},
+#     "get": {"timeout": 1, "max_retries": 2, "retry_on_timeout": True},
+#     "bulk": {"timeout": 120, "max_retries": 0, "maxsize": 2, "hosts": ["10.0.0.5:9200"]},
+#     "admin": {"timeout": 1800}
+# }
+ELASTICSEARCH_CONNECTION_PROFILES = getattr(settings, 'ELASTICSEARCH_CONNECTION_PROFILES', {})
+
 # Override this if you want to have a base set of settings for all your indexes. This dictionary
 # gets cloned and then updated with custom index-specific from your ELASTICSEARCH_CUSTOM_INDEX_SETTINGS
 # Eg. to ensure that all of your indexes have 1 shard and have an edgengram tokenizer/analyzer
@@ -58,8 +72,146 @@ ELASTICSEARCH_DEFAULT_INDEX_SETTINGS = getattr(settings, 'ELASTICSEARCH_DEFAULT_
 # }
 ELASTICSEARCH_CUSTOM_INDEX_SETTINGS = getattr(settings, 'ELASTICSEARCH_CUSTOM_INDEX_SETTINGS', {})
 
+# The settings applied to a new index while `rebuild_indices` (or `import_indices`) bulk loads it,
+# and what happens before its alias is switched over to it:
+#  - 'settings': index settings used during the bulk load; afterwards each one is restored to the
+#    index's original value (or its Elasticsearch default)
+#  - 'max_num_segments': if set, force merge the index down to this many segments after loading
+#  - 'merge_timeout': seconds the force merge request may take
+#  - 'wait_for_status': cluster health the index must reach before its alias is switched; None to
+#    not wait. 'yellow' is reached as soon as the primaries are allocated, so it doesn't wait for
+#    replicas; 'green' (all replicas allocated) does, but can never be reached on a single node cluster
+#  - 'wait_timeout': how long to wait for that health status before giving up (an Elasticsearch time
+#    value; the request's own timeout is set to match)
+# Eg. to also relax translog durability (Elasticsearch 2.0+) while loading:
+# ELASTICSEARCH_DEFAULT_BULK_LOAD_PROFILE = {
+#     "settings": {
+#         "number_of_replicas": 0,
+#         "refresh_interval": "-1",
+#         "translog.durability": "async"
+#     },
+#     "max_num_segments": 1,
+#     "merge_timeout": 7200,
+#     "wait_for_status": "green",
+#     "wait_timeout": "30m"
+# }
+ELASTICSEARCH_DEFAULT_BULK_LOAD_PROFILE = getattr(settings, 'ELASTICSEARCH_DEFAULT_BULK_LOAD_PROFILE', {
+    'settings': {
+        'number_of_replicas': 0,
+        'refresh_interval': '-1',
+    },
+    'max_num_segments': None,
+    'merge_timeout': 3600,
+    'wait_for_status': 'yellow',
+    'wait_timeout': '30m',
+})
+
+# Override this in your project settings to customize the bulk load profile per index; each
+# dictionary is merged into a copy of ELASTICSEARCH_DEFAULT_BULK_LOAD_PROFILE.
+# Eg.
+# ELASTICSEARCH_CUSTOM_BULK_LOAD_PROFILES = {
+#     "twitter": {
+#         "max_num_segments": 5
+#     }
+# }
+ELASTICSEARCH_CUSTOM_BULK_LOAD_PROFILES = getattr(settings, 'ELASTICSEARCH_CUSTOM_BULK_LOAD_PROFILES', {})
+
+# Set this to True to have the save and delete handlers of all `ELASTICSEARCH_TYPE_CLASSES`
+# connected to Django's `post_save` and `pre_delete` signals automatically (instead of connecting
+# each type class's `save_handler` and `delete_handler` yourself).
+ELASTICSEARCH_AUTO_CONNECT_SIGNALS = getattr(settings, 'ELASTICSEARCH_AUTO_CONNECT_SIGNALS', False)
+
+# Set this to the name of a Django cache (see `CACHES`) to store a fingerprint (hash) of every
+# document indexed by `index_add` and `bulk_index`; documents whose fingerprint hasn't changed since
+# they were last indexed are then not sent again. Fingerprints are kept for
+# ELASTICSEARCH_FINGERPRINT_TIMEOUT seconds (None for as long as the cache allows).
+ELASTICSEARCH_FINGERPRINT_CACHE = getattr(settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', None)
+ELASTICSEARCH_FINGERPRINT_TIMEOUT = getattr(settings, 'ELASTICSEARCH_FINGERPRINT_TIMEOUT', None)
+
+# Set this to False to have the documents depending on a saved related model (see
+# `get_related_dependencies`) reindexed during the save rather than in a background thread after
+# the transaction commits.
+ELASTICSEARCH_RELATED_REINDEX_ASYNC = getattr(settings, 'ELASTICSEARCH_RELATED_REINDEX_ASYNC', True)
+
+# Set this to a dictionary to guard single document writes (`index_add`, `index_update` and
+# `index_delete`, ie. the signal handlers) with a circuit breaker: after `failure_threshold`
+# consecutive failures because the cluster is unavailable, writes fail fast for `reset_timeout`
+# seconds instead of each waiting for a timeout. Failed and refused writes are appended to the
+# ELASTICSEARCH_SPOOL_PATH SQLite file, if set, to be sent by `es_manage --replay-spool`;
+# otherwise they raise `CircuitOpenError`.
+# Eg.
+# ELASTICSEARCH_CIRCUIT_BREAKER = {
+#     "failure_threshold": 5,
+#     "reset_timeout": 30
+# }
+# ELASTICSEARCH_SPOOL_PATH = '/var/spool/myproject/elasticsearch.sqlite3'
+ELASTICSEARCH_CIRCUIT_BREAKER = getattr(settings, 'ELASTICSEARCH_CIRCUIT_BREAKER', None)
+ELASTICSEARCH_SPOOL_PATH = getattr(settings, 'ELASTICSEARCH_SPOOL_PATH', None)
+
+# Set this to the name of one of your Django caches to have `DSEResponse.hydrate()` cache the model
+# instances it loads for search hits, for ELASTICSEARCH_HYDRATION_CACHE_TIMEOUT seconds.
+ELASTICSEARCH_HYDRATION_CACHE = getattr(settings, 'ELASTICSEARCH_HYDRATION_CACHE', None)
+ELASTICSEARCH_HYDRATION_CACHE_TIMEOUT = getattr(settings, 'ELASTICSEARCH_HYDRATION_CACHE_TIMEOUT', 60)
+
+# Searches through `ElasticsearchProcessor` taking at least this many seconds (server side `took`
+# or client round trip) are logged as warnings to the 'simple_elasticsearch.search' logger, with
+# the form class, the index and the query with its values replaced by '?'. None disables the log.
+ELASTICSEARCH_SLOW_SEARCH_THRESHOLD = getattr(settings, 'ELASTICSEARCH_SLOW_SEARCH_THRESHOLD', None)
+
+# Set this to True to send every search with `profile: true` (or pass `profile=True` to
+# `add_search` for single searches); the profile is kept in the response's `search_stats`.
+ELASTICSEARCH_SEARCH_PROFILE = getattr(settings, 'ELASTICSEARCH_SEARCH_PROFILE', False)
+
+# Set this to a dictionary to have `bulk_index` adapt its batch size to the cluster's response
+# times and rejections, rather than always sending `get_bulk_index_limit()` documents per request
+# (which is then only the initial size). See `utils.AdaptiveBulkController` for all the options.
+# Eg.
+# ELASTICSEARCH_ADAPTIVE_BULK = {
+#     "max_latency": 2.0,             # seconds; slower bulk requests shrink the batch size
+#     "max_docs_per_second": 5000,    # pause between batches to stay under this rate
+#     "min_batch_size": 50,
+#     "max_batch_size": 2000
+# }
+ELASTICSEARCH_ADAPTIVE_BULK = getattr(settings, 'ELASTICSEARCH_ADAPTIVE_BULK', None)
+
 # Override this in your project settings, setting it to True, to have
 # old indexes deleted on a full rebuild. Currently a new index is
 # created, and the alias is switched to the new one from the old, leaving
 # old ones on the ES cluster.
 ELASTICSEARCH_DELETE_OLD_INDEXES = getattr(settings, 'ELASTICSEARCH_DELETE_OLD_INDEXES', False)
+
+# Set this to True to have `queryset_iterator` stream rows through a single query using
+# database server-side cursors (where supported - see Django's `QuerySet.iterator()`) instead
+# of issuing a sliced query for every chunk.
+ELASTICSEARCH_QUERYSET_STREAMING = getattr(settings, 'ELASTICSEARCH_QUERYSET_STREAMING', False)
+
+# `queryset_iterator` forces a full garbage collection after a chunk only when the process'
+# resident memory is above this many megabytes. Set it to 0 to collect after every chunk,
+# or to None to never force a collection.
+ELASTICSEARCH_GC_RSS_THRESHOLD = getattr(settings, 'ELASTICSEARCH_GC_RSS_THRESHOLD', 1024)
+
+# The number of slices `es_manage --rebuild --from-index` splits each `_reindex` (and `delete_where`
+# its `_delete_by_query`) into, run in parallel by the cluster, and how many seconds they wait
+# between checks of the tasks' progress. `_reindex` needs Elasticsearch 2.3+ (and a matching
+# elasticsearch-py), more than one slice 5.1+ and 'auto' 6.1+.
+ELASTICSEARCH_REINDEX_SLICES = getattr(settings, 'ELASTICSEARCH_REINDEX_SLICES', 1)
+ELASTICSEARCH_REINDEX_POLL_INTERVAL = getattr(settings, 'ELASTICSEARCH_REINDEX_POLL_INTERVAL', 5)
+
+# Set this to copy every write (`index_add`, `index_update`, `index_delete`, bulk indexing and
+# deleting, and rebuilds) to other clusters too, eg. during a migration. Each is named and has
+# its own connection settings (not based on ELASTICSEARCH_CONNECTION_PARAMS). Writes to a mirror
+# are queued and sent from a background thread, so a slow mirror doesn't slow down the primary
+# cluster; once ELASTICSEARCH_MIRROR_QUEUE_SIZE (or the mirror's own 'queue_size') requests are
+# waiting, further ones are dropped and counted. Eg.
+# ELASTICSEARCH_MIRRORS = {
+#     "new-cluster": {"hosts": ["10.0.1.5:9200"], "timeout": 60, "queue_size": 1000}
+# }
+ELASTICSEARCH_MIRRORS = getattr(settings, 'ELASTICSEARCH_MIRRORS', {})
+ELASTICSEARCH_MIRROR_QUEUE_SIZE = getattr(settings, 'ELASTICSEARCH_MIRROR_QUEUE_SIZE', 10000)
+
+# The number of suggestions `ElasticsearchSuggester` asks for, how many prefixes each suggester
+# keeps the suggestions of (least recently used first out; 0 disables the cache) and for how many
+# seconds (None for as long as they fit). Rebuilding indices clears the caches.
+ELASTICSEARCH_SUGGEST_SIZE = getattr(settings, 'ELASTICSEARCH_SUGGEST_SIZE', 10)
+ELASTICSEARCH_SUGGEST_CACHE_SIZE = getattr(settings, 'ELASTICSEARCH_SUGGEST_CACHE_SIZE', 1000)
+ELASTICSEARCH_SUGGEST_CACHE_TIMEOUT = getattr(settings, 'ELASTICSEARCH_SUGGEST_CACHE_TIMEOUT', 300)
@@ -3,3 +3,7 @@ import django.dispatch
 
 post_indices_create = django.dispatch.Signal(providing_args=["indices", "aliases_set"])
 post_indices_rebuild = django.dispatch.Signal(providing_args=["indices", "aliases_set"])
+
+# sent after every `ElasticsearchProcessor.search()`, with a list of the
+# `search_stats` of each of its searches (see `get_search_stats`)
+post_search = django.dispatch.Signal(providing_args=["searches"])
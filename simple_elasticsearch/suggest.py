@@ -0,0 +1,187 @@
+import collections
+import threading
+import time
+import weakref
+
+from . import settings as es_settings
+from .connections import get_connection
+from .signals import post_indices_rebuild
+
+# every `PrefixCache`, for `clear_caches`
+_caches = weakref.WeakValueDictionary()
+
+
+class PrefixCache(object):
+    """
+    A thread safe LRU cache of suggestions by prefix, each kept for up to
+    `timeout` seconds (None for no limit). Besides exact lookups, a longer
+    prefix is answered from the results of the longest cached shorter prefix
+    when those were complete (ie. fewer than were asked for).
+    """
+    def __init__(self, maxsize=1000, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        _caches[id(self)] = self
+
+    def get(self, prefix):
+        # returns (results, complete) or None
+        with self.lock:
+            item = self.items.pop(prefix, None)
+            if item is None or item[2] is not None and item[2] <= time.time():
+                return None
+            self.items[prefix] = item
+            return item[:2]
+
+    def set(self, prefix, results, complete):
+        if not self.maxsize:
+            return
+        expires = time.time() + self.timeout if self.timeout is not None else None
+        with self.lock:
+            self.items.pop(prefix, None)
+            self.items[prefix] = (results, complete, expires)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def get_complete(self, prefix):
+        # the complete results of the longest cached prefix of `prefix`
+        for i in range(len(prefix) - 1, 0, -1):
+            item = self.get(prefix[:i])
+            if item is not None and item[1]:
+                return item[0]
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+def clear_caches(**kwargs):
+    # rebuilt indices may have other suggestions
+    for cache in list(_caches.values()):
+        cache.clear()
+
+
+post_indices_rebuild.connect(clear_caches, dispatch_uid='simple_elasticsearch_suggest_clear_caches')
+
+
+class ElasticsearchSuggester(object):
+    """
+    Autocomplete suggestions with a single, small request per prefix and no
+    form or response objects: subclass and override `get_index`, `get_type`
+    and `get_field` (and `get_mode` for 'prefix' queries rather than the
+    completion suggester). `suggest(prefix)` returns (id, text, payload)
+    tuples, the payload being the `get_payload_fields` of the document.
+    """
+    def __init__(self, es=None, size=None, cache_size=None, cache_timeout=None):
+        self.es = es
+        self.size = size or es_settings.ELASTICSEARCH_SUGGEST_SIZE
+        self.cache = PrefixCache(
+            es_settings.ELASTICSEARCH_SUGGEST_CACHE_SIZE if cache_size is None else cache_size,
+            es_settings.ELASTICSEARCH_SUGGEST_CACHE_TIMEOUT if cache_timeout is None else cache_timeout
+        )
+
+    def get_es(self):
+        return self.es or get_connection('suggest')
+
+    def get_index(self):
+        # the ES index name (or alias) to get suggestions from
+        raise NotImplementedError
+
+    def get_type(self):
+        return ''
+
+    def get_field(self):
+        # a `completion` field, or a field to run prefix queries on
+        raise NotImplementedError
+
+    def get_mode(self):
+        # 'completion' (the completion suggester) or 'prefix' (a query)
+        return 'completion'
+
+    def get_payload_fields(self):
+        # the document fields returned with each suggestion
+        return []
+
+    def normalize_prefix(self, prefix):
+        # what's sent for `prefix`, and its cache key: lowercased for the
+        # completion suggester (whose default analyzer lowercases anyway), as
+        # typed for prefix queries, which may well be case sensitive
+        if self.get_mode() == 'prefix':
+            return prefix.strip()
+        return prefix.strip().lower()
+
+    def matches(self, text, prefix):
+        # whether a cached suggestion for a shorter prefix also matches
+        # `prefix`; override this if the suggestions' text doesn't start with
+        # what was typed (eg. prefix queries on analyzed fields)
+        return self.normalize_prefix(text).startswith(prefix)
+
+    def get_request_body(self, prefix):
+        if self.get_mode() == 'prefix':
+            return {
+                'query': {'prefix': {self.get_field(): prefix}},
+                'size': self.size,
+                '_source': [self.get_field()] + list(self.get_payload_fields()),
+            }
+        return {
+            'suggest': {
+                'suggestions': {
+                    'prefix': prefix,
+                    'completion': {'field': self.get_field(), 'size': self.size},
+                },
+            },
+            '_source': list(self.get_payload_fields()) or False,
+            'size': 0,
+        }
+
+    def get_filter_path(self):
+        if self.get_mode() == 'prefix':
+            return 'hits.hits._id,hits.hits._source'
+        return 'suggest.suggestions.options._id,suggest.suggestions.options.text,suggest.suggestions.options._source'
+
+    def parse_response(self, response):
+        payload_fields = self.get_payload_fields()
+        if self.get_mode() == 'prefix':
+            field = self.get_field()
+            return [
+                (hit['_id'], hit.get('_source', {}).get(field, ''),
+                 dict((name, hit.get('_source', {}).get(name)) for name in payload_fields))
+                for hit in response.get('hits', {}).get('hits', [])
+            ]
+
+        result = []
+        for suggestion in response.get('suggest', {}).get('suggestions', []):
+            for option in suggestion.get('options', []):
+                result.append((
+                    option.get('_id'), option.get('text', ''),
+                    dict((name, option.get('_source', {}).get(name)) for name in payload_fields)
+                ))
+        return result
+
+    def suggest(self, prefix):
+        prefix = self.normalize_prefix(prefix)
+        if not prefix:
+            return []
+
+        cached = self.cache.get(prefix)
+        if cached is not None:
+            return cached[0]
+
+        results = self.cache.get_complete(prefix)
+        if results is not None:
+            # narrowing down complete results leaves them complete
+            results = [item for item in results if self.matches(item[1], prefix)]
+            self.cache.set(prefix, results, True)
+            return results
+
+        response = self.get_es().search(
+            index=self.get_index(),
+            doc_type=self.get_type(),
+            body=self.get_request_body(prefix),
+            filter_path=self.get_filter_path(),
+        )
+        results = self.parse_response(response or {})
+        self.cache.set(prefix, results, len(results) < self.size)
+        return results
@@ -1,13 +1,22 @@
+import collections
 import copy
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
 from datadiff import tools as ddtools
 from django import forms
 from django.core.paginator import Page
 from django.test import TestCase
-from elasticsearch import Elasticsearch
+from django.utils import timezone
+from elasticsearch import Elasticsearch, ConnectionError, TransportError
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.result import Response
 import mock
-from simple_elasticsearch.forms import ElasticsearchForm, ElasticsearchProcessor
+from simple_elasticsearch.forms import ElasticsearchForm, ElasticsearchProcessor, DSEResponse, DSESummaryResponse
 
 try:
     # `reload` is not a python3 builtin like python2
@@ -16,8 +25,23 @@ except NameError:
     from imp import reload
 
 from . import settings as es_settings
-from .mixins import ElasticsearchIndexMixin
+from . import breaker
+from . import mirrors
+from .connections import get_connection, get_connection_params, reset_connections
+from .exceptions import IndexHealthError, CircuitOpenError, ReindexError
+from .instrumentation import CallCollector, get_call_collectors, get_elasticsearch, get_operation
+from .middleware import ElasticsearchCallsMiddleware
+from .mixins import ElasticsearchIndexMixin, suppress_signal_indexing, signal_indexing_suppressed
 from .models import Blog, BlogPost
+from .registry import TypeClassRegistry
+from .signals import post_search, post_indices_rebuild
+from .suggest import ElasticsearchSuggester, PrefixCache
+from .utils import export_indices, import_indices, run_concurrently, queryset_iterator, collect_garbage, measure_queryset_iterator, rebuild_indices, \
+    prepare_index_for_bulk_load, restore_index_after_bulk_load, set_rebuilt_aliases, ClusterMetadata, create_aliases, \
+    get_indices_from_aliases, get_new_index_name, chunked, BackgroundWorker, AdaptiveBulkController, create_indices, \
+    get_partition_range, get_partitions_for_range, get_partitioned_index_names, normalize_query, IdBitmap, verify_index, scan_index, \
+    rebuild_indices_from_index, wait_for_reindex, create_partition_index, get_time_value_seconds, \
+    get_fingerprint_generation
 
 
 class ElasticsearchIndexMixinClass(ElasticsearchIndexMixin):
@@ -47,8 +71,8 @@ class ElasticsearchIndexMixinTestCase(TestCase):
     def latest_post(self):
         return BlogPost.objects.select_related('blog').latest('id')
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.delete')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def setUp(self, mock_index, mock_delete):
         self.blog = Blog.objects.create(
             name='test blog name',
@@ -133,7 +157,7 @@ class ElasticsearchIndexMixinTestCase(TestCase):
         post.delete()
         mock_index_delete.assert_called_with(post)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def test__index_add(self, mock_index):
         post = self.latest_post
         mock_index.return_value = {}
@@ -160,7 +184,7 @@ class ElasticsearchIndexMixinTestCase(TestCase):
         result = BlogPost.index_add(post)
         self.assertFalse(result)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.delete')
     def test__index_delete(self, mock_delete):
         post = self.latest_post
         mock_delete.return_value = {
@@ -312,7 +336,7 @@ class ElasticsearchIndexMixinTestCase(TestCase):
         with self.assertRaises(NotImplementedError):
             ElasticsearchIndexMixinClass.get_document(1)
 
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.index')
     def test__should_index(self, mock_index):
         post = self.latest_post
         self.assertTrue(BlogPost.should_index(post))
@@ -339,7 +363,7 @@ class ElasticsearchIndexMixinTestCase(TestCase):
 
     @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
     @mock.patch('simple_elasticsearch.models.BlogPost.should_index')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.bulk')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
     def test__bulk_index_should_index(self, mock_bulk, mock_should_index, mock_get_document):
         # hack the return value to ensure we save some BlogPosts here;
         # without this mock, the post_save handler indexing blows up
@@ -351,7 +375,7 @@ class ElasticsearchIndexMixinTestCase(TestCase):
         self.assertTrue(mock_should_index.call_count == queryset_count)
 
     @mock.patch('simple_elasticsearch.models.BlogPost.get_document')
-    @mock.patch('simple_elasticsearch.mixins.Elasticsearch.bulk')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
     def test__bulk_index_get_document(self, mock_bulk, mock_get_document):
         mock_bulk.return_value = mock_get_document.return_value = {}
 
@@ -571,7 +595,7 @@ class ESSearchProcessorTestCase(TestCase):
         ddtools.assert_equal(esp.bulk_search_data[0], {'index': ['blog'], 'type': ['posts'], 'routing': 'id'})
         ddtools.assert_equal(esp.bulk_search_data[1], query_with_size)
 
-    @mock.patch('simple_elasticsearch.forms.Elasticsearch.msearch')
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
     def test__esp_search(self, mock_msearch):
         mock_msearch.return_value = {
             "responses": [
@@ -628,3 +652,2074 @@ class ESSearchProcessorTestCase(TestCase):
         page = responses[0].page
         self.assertTrue(page.has_next())
         self.assertFalse(page.has_previous())
+
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
+    def test__esp_search_count_only(self, mock_msearch):
+        mock_msearch.return_value = {'responses': [
+            {'took': 2, 'hits': {'total': 20, 'hits': []}},
+            {'took': 3, 'hits': {'total': 20, 'hits': []}, 'aggregations': {'tags': {'buckets': [{'key': 'python', 'doc_count': 4}]}}},
+        ]}
+        query = {'query': {'match_all': {}}, 'sort': ['title'], 'aggs': {'tags': {'terms': {'field': 'tags'}}}}
+
+        esp = ElasticsearchProcessor()
+        esp.add_search(copy.deepcopy(query), 3, 2, index='blog', count_only=True)
+        esp.add_search(copy.deepcopy(query), 3, 2, index='blog', aggs_only=True)
+        ddtools.assert_equal(esp.bulk_search_data, [
+            {'index': 'blog', 'request_cache': True},
+            {'query': {'match_all': {}}, 'size': 0},
+            {'index': 'blog', 'request_cache': True},
+            {'query': {'match_all': {}}, 'aggs': {'tags': {'terms': {'field': 'tags'}}}, 'size': 0},
+        ])
+
+        responses = esp.search()
+        self.assertIsInstance(responses[0], DSESummaryResponse)
+        self.assertEqual(responses[0].total, 20)
+        self.assertEqual(responses[0].took, 2)
+        self.assertEqual(responses[1].aggregations.tags.buckets[0].doc_count, 4)
+
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
+    def test__esp_search_filter_path(self, mock_msearch):
+        mock_msearch.return_value = {'responses': [
+            {'hits': {'total': 1, 'hits': [{'_index': 'blog', '_type': 'posts', '_id': '1', '_source': {'title': 'one'}}]}},
+            {'hits': {'total': 0}},
+            {'hits': {'total': 0}},
+        ]}
+
+        esp = ElasticsearchProcessor()
+        esp.add_search({}, index='blog', source=['title'], response_paths=['hits.hits._source'])
+        esp.add_search({}, index='blog', source=['title'], response_paths=['hits.hits._source'])
+        esp.add_search({}, index='blog', count_only=True)
+        self.assertEqual(esp.bulk_search_data[1]['_source'], ['title'])
+
+        responses = esp.search()
+        mock_msearch.assert_called_with(mock.ANY, filter_path=','.join([
+            'responses._shards',
+            'responses.aggregations',
+            'responses.error',
+            'responses.hits.hits._id',
+            'responses.hits.hits._index',
+            'responses.hits.hits._source',
+            'responses.hits.hits._type',
+            'responses.hits.total',
+            'responses.timed_out',
+            'responses.took',
+        ]))
+        self.assertEqual(responses[0].hits[0].title, 'one')
+        self.assertEqual(responses[0].page.paginator.count, 1)
+        # a response without hits still works
+        self.assertEqual(len(responses[1]), 0)
+        self.assertEqual(responses[2].total, 0)
+
+        # a search that doesn't declare its paths needs the whole response
+        mock_msearch.return_value = {}
+        esp.add_search({}, index='blog', response_paths=['hits.hits._source'])
+        esp.add_search({}, index='blog')
+        esp.search()
+        mock_msearch.assert_called_with(mock.ANY)
+
+    @mock.patch('elasticsearch.Elasticsearch.msearch')
+    def test__esp_search_stats(self, mock_msearch):
+        mock_msearch.return_value = {'responses': [
+            {'took': 1500, 'timed_out': False, '_shards': {'total': 5, 'successful': 5, 'failed': 0}, 'hits': {'total': 0, 'hits': []}},
+            {'took': 10, 'hits': {'total': 0, 'hits': []}, 'profile': {'shards': []}},
+        ]}
+        received = []
+
+        def receiver(sender, searches=None, **kwargs):
+            received.extend(searches)
+
+        post_search.connect(receiver)
+        try:
+            esp = ElasticsearchProcessor()
+            esp.add_search(self.form)
+            esp.add_search({'query': {'term': {'title': 'python'}}}, index='blog', profile=True)
+            self.assertEqual(esp.bulk_search_data[3]['profile'], True)
+
+            with mock.patch.object(es_settings, 'ELASTICSEARCH_SLOW_SEARCH_THRESHOLD', 1.0):
+                with mock.patch('simple_elasticsearch.forms.logger') as mock_logger:
+                    responses = esp.search()
+        finally:
+            post_search.disconnect(receiver)
+
+        self.assertEqual(responses[0].search_stats['name'], 'BlogPostSearchForm')
+        self.assertEqual(responses[0].search_stats['took'], 1.5)
+        self.assertEqual(responses[0].search_stats['shards']['total'], 5)
+        self.assertEqual(responses[1].search_stats['index'], 'blog')
+        self.assertEqual(responses[1].search_stats['profile'], {'shards': []})
+        self.assertEqual(received, [responses[0].search_stats, responses[1].search_stats])
+
+        # only the slow search is logged, with its values normalized
+        self.assertEqual(mock_logger.warning.call_count, 1)
+        self.assertEqual(mock_logger.warning.call_args[0][3], 'BlogPostSearchForm')
+
+    def test__normalize_query(self):
+        self.assertEqual(
+            normalize_query({'query': {'terms': {'tags': ['a', 'b']}}, 'size': 20}),
+            {'query': {'terms': {'tags': ['?', '?']}}, 'size': '?'}
+        )
+
+    @mock.patch('simple_elasticsearch.forms.ElasticsearchProcessor.search')
+    @mock.patch('simple_elasticsearch.forms.ElasticsearchProcessor.add_search')
+    def test__form_search_count_only(self, mock_esp_add_search, mock_esp_search):
+        form = BlogPostSearchForm({'q': 'python'})
+        form.search(count_only=True)
+        mock_esp_add_search.assert_called_with(form, 1, 20, count_only=True)
+
+
+class ExportImportTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        self.directory = tempfile.mkdtemp()
+
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        BlogPost.objects.create(blog=blog, title="DO-NOT-INDEX title", slug="DO-NOT-INDEX", body="body")
+        for x in range(1, 6):
+            BlogPost.objects.create(
+                blog=blog,
+                title="blog post title {0}".format(x),
+                slug="blog-post-title-{0}".format(x),
+                body="blog post body {0}".format(x)
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_es(self):
+        es = mock.MagicMock()
+        es.indices.get_settings.return_value = {}
+        es.indices.get_aliases.return_value = {}
+        es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        return es
+
+    def test__export_indices(self):
+        results = export_indices(self.directory, docs_per_file=3)
+
+        # 5 indexable posts, 3 per file
+        self.assertEqual([(alias, type_name) for alias, type_name, path in results], [('blog', 'posts'), ('blog', 'posts')])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.directory, 'blog'))),
+            ['posts.00000.ndjson.gz', 'posts.00001.ndjson.gz']
+        )
+
+        with gzip.open(results[0][2], 'rb') as stream:
+            lines = [json.loads(line.decode('utf-8')) for line in stream]
+        self.assertEqual(len(lines), 6)
+
+        post = BlogPost.objects.exclude(slug='DO-NOT-INDEX').order_by('pk')[0]
+        self.assertEqual(lines[0], {'index': {'_type': 'posts', '_id': post.pk, 'routing': post.blog_id}})
+        self.assertEqual(lines[1]['slug'], post.slug)
+
+    def test__import_indices(self):
+        export_indices(self.directory, docs_per_file=3)
+
+        es = self.get_es()
+        created_indices, aliases = import_indices(self.directory, es=es, workers=2)
+
+        index_name = aliases[0][1]
+        self.assertEqual(aliases[0][0], 'blog')
+        es.indices.create.assert_called_once_with(index_name, mock.ANY)
+        self.assertEqual(es.bulk.call_count, 2)
+        for call in es.bulk.call_args_list:
+            self.assertEqual(call[1], {'index': index_name})
+        self.assertEqual(sum(len(call[0][0].splitlines()) for call in es.bulk.call_args_list), 10)
+        es.indices.update_aliases.assert_called_with({'actions': [{'add': {'index': index_name, 'alias': 'blog'}}]})
+
+    def test__import_indices_empty_directory(self):
+        with self.assertRaises(Exception):
+            import_indices(self.directory, es=self.get_es())
+
+    def test__run_concurrently(self):
+        self.assertEqual(run_concurrently(lambda x: x * 2, range(5), 3), [0, 2, 4, 6, 8])
+
+        def fail(x):
+            raise ValueError(x)
+
+        with self.assertRaises(ValueError):
+            run_concurrently(fail, range(3), 2)
+
+
+class QuerysetIteratorTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x in range(1, 8):
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+
+    def test__queryset_iterator_modes(self):
+        queryset = BlogPost.objects.order_by('pk')
+        expected = list(queryset)
+        self.assertEqual(list(queryset_iterator(queryset, 3, streaming=False)), expected)
+        self.assertEqual(list(queryset_iterator(queryset, 3, streaming=True)), expected)
+
+    @mock.patch('simple_elasticsearch.utils.gc.collect')
+    def test__queryset_iterator_gc_policy(self, mock_collect):
+        queryset = BlogPost.objects.order_by('pk')
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_GC_RSS_THRESHOLD', None):
+            list(queryset_iterator(queryset, 3))
+        self.assertEqual(mock_collect.call_count, 0)
+
+        # 0 keeps the old behaviour of collecting after every chunk
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_GC_RSS_THRESHOLD', 0):
+            list(queryset_iterator(queryset, 3))
+        self.assertEqual(mock_collect.call_count, 3)
+
+    @mock.patch('simple_elasticsearch.utils.gc.collect')
+    @mock.patch('simple_elasticsearch.utils.get_rss')
+    def test__collect_garbage(self, mock_get_rss, mock_collect):
+        mock_get_rss.return_value = 100 * 1024 * 1024
+        self.assertFalse(collect_garbage(None))
+        self.assertFalse(collect_garbage(200))
+        self.assertTrue(collect_garbage(50))
+        self.assertTrue(collect_garbage(0))
+        self.assertEqual(mock_collect.call_count, 2)
+
+    def test__measure_queryset_iterator(self):
+        result = measure_queryset_iterator(BlogPost.objects.all(), 3, streaming=True)
+        self.assertEqual(result['rows'], 7)
+
+
+class RebuildIndicesTestCase(TestCase):
+
+    def setUp(self):
+        self.events = []
+
+        def make_type_class(index_name, type_name):
+            events = self.events
+
+            class TypeClass(ElasticsearchIndexMixin):
+                @classmethod
+                def get_index_name(cls):
+                    return index_name
+
+                @classmethod
+                def get_type_name(cls):
+                    return type_name
+
+                @classmethod
+                def bulk_index(cls, es=None, index_name='', queryset=None):
+                    events.append(('bulk_index', index_name))
+
+            return TypeClass
+
+        self.type_classes = {
+            'one': [make_type_class('one', 'a'), make_type_class('one', 'b')],
+            'two': [make_type_class('two', 'c')],
+        }
+
+        self.es = mock.MagicMock()
+        self.es.indices.get_settings.return_value = {}
+        self.es.indices.get_aliases.return_value = {}
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        self.es.indices.put_settings.side_effect = lambda body, index: self.events.append(
+            ('bulk_load' if body['index']['refresh_interval'] == '-1' else 'restore', index)
+        )
+
+    def assert_settings_wrapped(self):
+        # every index gets its bulk loading settings before any of its type
+        # classes are indexed, and only gets them restored after all are done
+        for index_name in set(index for event, index in self.events):
+            events = [event for event, index in self.events if index == index_name]
+            self.assertEqual(events[0], 'bulk_load')
+            self.assertEqual(events[-1], 'restore')
+            self.assertEqual(events.count('bulk_load'), 1)
+            self.assertEqual(events.count('restore'), 1)
+
+    def test__rebuild_indices_concurrently(self):
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.type_classes):
+            created_indices, aliases = rebuild_indices(self.es, workers=3)
+
+        self.assertEqual(len([event for event in self.events if event[0] == 'bulk_index']), 3)
+        self.assert_settings_wrapped()
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+
+        # the cluster's alias metadata is fetched once to create the indices
+        # and once more right before switching the aliases
+        self.assertEqual(self.es.indices.get_aliases.call_count, 2)
+
+    def test__rebuild_indices_alias_each(self):
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.type_classes):
+            created_indices, aliases = rebuild_indices(self.es, workers=2, alias_each=True)
+
+        self.assert_settings_wrapped()
+        self.assertEqual(self.es.indices.update_aliases.call_count, 2)
+
+    def test__rebuild_indices_failed_build(self):
+        def bulk_index(es=None, index_name='', queryset=None):
+            raise TransportError(500, 'failed')
+        self.type_classes['two'][0].bulk_index = staticmethod(bulk_index)
+
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.type_classes):
+            self.assertRaises(TransportError, rebuild_indices, self.es, workers=2, alias_each=True)
+
+        # only the index that was built completely is switched to
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+        actions = self.es.indices.update_aliases.call_args[0][0]['actions']
+        self.assertEqual([action['add']['alias'] for action in actions], ['one'])
+
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.type_classes):
+            self.assertRaises(TransportError, rebuild_indices, self.es)
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+
+
+class BulkLoadProfileTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.MagicMock()
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        self.es.indices.get_aliases.return_value = {}
+
+    def test__bulk_load_default_profile(self):
+        self.es.indices.get_settings.return_value = {
+            'blog-1': {'settings': {'index': {'number_of_replicas': '2'}}}
+        }
+        index_settings = prepare_index_for_bulk_load(self.es, 'blog-1', 'blog')
+        self.es.indices.put_settings.assert_called_with(
+            {'index': {'number_of_replicas': 0, 'refresh_interval': '-1'}}, index='blog-1'
+        )
+
+        restore_index_after_bulk_load(self.es, 'blog-1', index_settings, 'blog')
+        self.es.indices.put_settings.assert_called_with(
+            {'index': {'number_of_replicas': '2', 'refresh_interval': '1s'}}, 'blog-1'
+        )
+        self.es.indices.refresh.assert_called_with('blog-1')
+        self.assertFalse(self.es.indices.forcemerge.called)
+
+    def test__bulk_load_custom_profile(self):
+        profiles = {'blog': {'settings': {'translog.durability': 'async'}, 'max_num_segments': 1}}
+        index_settings = {'index': {'translog': {'durability': 'request'}, 'refresh_interval': '30s'}}
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_CUSTOM_BULK_LOAD_PROFILES', profiles):
+            self.es.indices.get_settings.return_value = {'blog-1': {'settings': index_settings}}
+            prepare_index_for_bulk_load(self.es, 'blog-1', 'blog')
+            self.es.indices.put_settings.assert_called_with({'index': {
+                'number_of_replicas': 0, 'refresh_interval': '-1', 'translog.durability': 'async'
+            }}, index='blog-1')
+
+            restore_index_after_bulk_load(self.es, 'blog-1', index_settings, 'blog')
+            self.es.indices.forcemerge.assert_called_with('blog-1', max_num_segments=1, request_timeout=3600)
+
+            # an index that failed to load isn't merged
+            self.es.indices.forcemerge.reset_mock()
+            restore_index_after_bulk_load(self.es, 'blog-1', index_settings, 'blog', failed=True)
+            self.assertFalse(self.es.indices.forcemerge.called)
+            self.es.indices.put_settings.assert_called_with({'index': {
+                'number_of_replicas': 1, 'refresh_interval': '30s', 'translog.durability': 'request'
+            }}, 'blog-1')
+
+        # other indices are unaffected
+        prepare_index_for_bulk_load(self.es, 'other-1', 'other')
+        self.es.indices.put_settings.assert_called_with(
+            {'index': {'number_of_replicas': 0, 'refresh_interval': '-1'}}, index='other-1'
+        )
+
+    def test__set_rebuilt_aliases_waits_for_health(self):
+        set_rebuilt_aliases(self.es, [('blog', 'blog-1')])
+        self.es.cluster.health.assert_called_with(index='blog-1', wait_for_status='yellow', timeout='30m', request_timeout=1830)
+        self.assertTrue(self.es.indices.update_aliases.called)
+
+        self.es.reset_mock()
+        self.es.cluster.health.return_value = {'status': 'yellow', 'timed_out': True}
+        with self.assertRaises(IndexHealthError):
+            set_rebuilt_aliases(self.es, [('blog', 'blog-1')])
+        self.assertFalse(self.es.indices.update_aliases.called)
+
+    def test__get_time_value_seconds(self):
+        self.assertEqual(get_time_value_seconds('30m'), 1800)
+        self.assertEqual(get_time_value_seconds('90s'), 90)
+        self.assertEqual(get_time_value_seconds('2h'), 7200)
+        self.assertEqual(get_time_value_seconds('500ms'), 0.5)
+        self.assertEqual(get_time_value_seconds(1500), 1.5)
+        self.assertEqual(get_time_value_seconds('1500'), 1.5)
+
+
+class ClusterMetadataTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.MagicMock()
+        self.es.indices.get_aliases.return_value = {
+            'blog-1': {'aliases': {'blog': {}}},
+            'blog-2': {'aliases': {}},
+            'other-1': {'aliases': {'other': {}, 'all': {}}},
+        }
+        self.metadata = ClusterMetadata(self.es)
+
+    def test__lookups(self):
+        self.assertEqual(self.metadata.get_indices(['blog', 'other']), ['blog-1', 'other-1'])
+        self.assertEqual(get_indices_from_aliases(self.es, ['all', 'missing'], self.metadata), ['other-1'])
+        self.assertEqual(self.es.indices.get_aliases.call_count, 1)
+
+    def test__set_rebuilt_aliases_refreshes(self):
+        # the alias was moved to another index since the snapshot was taken
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        self.es.indices.get_aliases.return_value = {
+            'blog-1': {'aliases': {}},
+            'blog-2': {'aliases': {}},
+            'blog-3': {'aliases': {'blog': {}}},
+        }
+        set_rebuilt_aliases(self.es, [('blog', 'blog-2')], self.metadata)
+        self.es.indices.update_aliases.assert_called_with({'actions': [
+            {'remove': {'index': 'blog-3', 'alias': 'blog'}},
+            {'add': {'index': 'blog-2', 'alias': 'blog'}},
+        ]})
+
+    def test__create_aliases(self):
+        create_aliases(self.es, [('blog', 'blog-2')], self.metadata)
+        self.es.indices.update_aliases.assert_called_with({'actions': [
+            {'remove': {'index': 'blog-1', 'alias': 'blog'}},
+            {'add': {'index': 'blog-2', 'alias': 'blog'}},
+        ]})
+
+        # the snapshot is updated locally instead of being fetched again
+        self.assertEqual(self.metadata.get_indices(['blog']), ['blog-2'])
+        self.assertEqual(self.es.indices.get_aliases.call_count, 1)
+
+    def test__set_rebuilt_aliases_deletes_old_indices(self):
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_DELETE_OLD_INDEXES', True):
+            set_rebuilt_aliases(self.es, [('blog', 'blog-2')], self.metadata)
+        self.es.indices.delete.assert_called_once_with('blog-1')
+        self.assertNotIn('blog-1', self.metadata.indices)
+
+    def test__get_new_index_name(self):
+        self.assertEqual(get_new_index_name('blog', '3'), 'blog-3')
+        self.metadata.add_index('blog-3')
+        self.metadata.add_index('blog-3-1')
+        self.assertEqual(get_new_index_name('blog', '3', self.metadata), 'blog-3-2')
+
+
+class TypeClassRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.registry = TypeClassRegistry(['simple_elasticsearch.models.BlogPost', 'simple_elasticsearch.missing.Missing'])
+
+    def test__lazy_loading(self):
+        self.assertFalse(self.registry.loaded)
+        with mock.patch('sys.stderr'):
+            self.assertEqual(dict(self.registry.get_indices()), {'blog': [BlogPost]})
+        self.assertTrue(self.registry.loaded)
+
+    def test__lookups(self):
+        with mock.patch('sys.stderr'):
+            self.assertEqual(self.registry.get_type_classes_for_model(BlogPost), [BlogPost])
+        self.assertEqual(self.registry.get_type_classes_for_model(Blog), [])
+        self.assertEqual(self.registry.get_type_class('blog', 'posts'), BlogPost)
+        self.assertEqual(self.registry.get_indices(['other']), {})
+
+    def test__get_model(self):
+        self.assertEqual(BlogPost.get_model(), BlogPost)
+        self.assertEqual(ElasticsearchIndexMixinClass.get_model(), None)
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    @mock.patch('simple_elasticsearch.models.BlogPost.delete_handler')
+    @mock.patch('simple_elasticsearch.models.BlogPost.save_handler')
+    def test__connect_signals(self, mock_save_handler, mock_delete_handler, mock_index, mock_delete):
+        # the test models' own handlers are connected too; keep them off ES
+        mock_index.return_value = mock_delete.return_value = {}
+
+        self.registry.connect_signals()
+        try:
+            with mock.patch('sys.stderr'):
+                blog = Blog.objects.create(name='test blog name', description='test blog description')
+            self.assertFalse(mock_save_handler.called)
+
+            post = BlogPost(blog=blog, title='title', slug='slug', body='body')
+            post.save()
+            mock_save_handler.assert_called_with(BlogPost, post, signal=mock.ANY, created=True, update_fields=None, raw=False, using='default')
+
+            post.delete()
+            self.assertTrue(mock_delete_handler.called)
+        finally:
+            self.registry.disconnect_signals()
+
+
+class ElasticsearchQuerySetTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        self.blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x in range(1, 6):
+            BlogPost.objects.create(blog=self.blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__update(self, mock_bulk):
+        mock_bulk.return_value = {}
+        pks = list(BlogPost.objects.filter(slug__in=['title-1', 'title-2', 'title-3']).values_list('pk', flat=True))
+
+        # the update changes the filtered field; the updated objects still get indexed
+        rows = BlogPost.objects.filter(slug__in=['title-1', 'title-2', 'title-3']).update(slug='renamed')
+        self.assertEqual(rows, 3)
+
+        # `slug` is a declared document dependency, so only it is sent
+        updated = [line['update']['_id'] for call in mock_bulk.call_args_list for line in call[0][0] if 'update' in line]
+        self.assertEqual(sorted(updated), sorted(pks))
+        documents = [line for call in mock_bulk.call_args_list for line in call[0][0] if 'doc' in line]
+        self.assertEqual(documents, [{'doc': {'slug': 'renamed'}}] * 3)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__update_undeclared_field(self, mock_bulk):
+        mock_bulk.return_value = {}
+        blog = Blog.objects.create(name='other blog name', description='other blog description')
+
+        # `blog` isn't a declared document dependency; whole documents are indexed
+        BlogPost.objects.filter(slug='title-1').update(blog=blog)
+        operations = [line for call in mock_bulk.call_args_list for line in call[0][0]]
+        self.assertEqual(len(operations), 2)
+        self.assertIn('index', operations[0])
+        self.assertEqual(operations[1]['blog']['name'], 'other blog name')
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__delete(self, mock_bulk, mock_delete):
+        mock_bulk.return_value = {}
+        posts = list(BlogPost.objects.filter(slug__in=['title-1', 'title-2', 'title-3']))
+
+        BlogPost.objects.filter(slug__in=['title-1', 'title-2', 'title-3']).delete()
+        self.assertEqual(BlogPost.objects.count(), 2)
+
+        # no per-object deletes; the deletes go through `_bulk` in batches of `get_bulk_index_limit()`
+        self.assertFalse(mock_delete.called)
+        self.assertEqual(mock_bulk.call_count, 2)
+        deleted = [line['delete'] for call in mock_bulk.call_args_list for line in call[0][0]]
+        self.assertEqual(
+            sorted(deleted, key=lambda item: item['_id']),
+            [{'_index': 'blog', '_type': 'posts', '_id': post.pk, 'routing': post.blog_id} for post in posts]
+        )
+
+        # the per-object handlers work again afterwards
+        BlogPost.objects.get(slug='title-4').delete()
+        self.assertTrue(mock_delete.called)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__delete_outside_queryset(self, mock_bulk):
+        mock_bulk.return_value = {}
+        post = BlogPost.objects.get(slug='title-1')
+
+        # its document may have been indexed by `save_handler` all the same
+        with mock.patch.object(BlogPost, 'get_queryset', return_value=BlogPost.objects.exclude(slug='title-1')):
+            BlogPost.objects.filter(slug='title-1').delete()
+
+        deleted = [line['delete']['_id'] for call in mock_bulk.call_args_list for line in call[0][0]]
+        self.assertEqual(deleted, [post.pk])
+
+    @mock.patch('simple_elasticsearch.mixins.ElasticsearchIndexMixin.index_delete')
+    def test__delete_suppresses_only_own_type_classes(self, mock_index_delete):
+        post = BlogPost.objects.get(slug='title-4')
+
+        # eg. a cascaded delete of another indexed model still reaches its handler
+        with suppress_signal_indexing([ElasticsearchIndexMixinClass]):
+            self.assertFalse(signal_indexing_suppressed())
+            self.assertTrue(signal_indexing_suppressed(ElasticsearchIndexMixinClass))
+            BlogPost.delete_handler(BlogPost, post)
+        mock_index_delete.assert_called_once_with(post)
+
+        with suppress_signal_indexing([BlogPost]):
+            with suppress_signal_indexing():
+                BlogPost.delete_handler(BlogPost, post)
+            BlogPost.delete_handler(BlogPost, post)
+        self.assertEqual(mock_index_delete.call_count, 1)
+        self.assertFalse(signal_indexing_suppressed(BlogPost))
+
+    @mock.patch('simple_elasticsearch.mixins.ElasticsearchQuerySetMixin.es_bulk_index')
+    def test__bulk_create(self, mock_es_bulk_index):
+        posts = BlogPost.objects.bulk_create([
+            BlogPost(blog=self.blog, title='bulk', slug='bulk', body='body', pk=100),
+            BlogPost(blog=self.blog, title='bulk', slug='bulk', body='body'),
+        ])
+        self.assertEqual(len(posts), 2)
+
+        # objects whose new primary key the backend didn't return are skipped
+        mock_es_bulk_index.assert_called_with([100])
+
+
+class FingerprintTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        BlogPost.objects.create(blog=blog, title="DO-NOT-INDEX title", slug="DO-NOT-INDEX", body="body")
+        for x in range(1, 5):
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+
+        self.patcher = mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default')
+        self.patcher.start()
+
+        from django.core.cache import cache
+        cache.clear()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__index_add(self, mock_index, mock_delete):
+        post = BlogPost.objects.get(slug='title-1')
+
+        self.assertTrue(BlogPost.index_add(post))
+        self.assertFalse(BlogPost.index_add(post))
+        self.assertEqual(mock_index.call_count, 1)
+
+        # other indices (eg. a rebuild's) are always written to
+        self.assertTrue(BlogPost.index_add(post, 'blog-1'))
+        self.assertEqual(mock_index.call_count, 2)
+
+        post.title = 'changed'
+        self.assertTrue(BlogPost.index_add(post))
+        self.assertEqual(mock_index.call_count, 3)
+
+        # a delete forgets the fingerprint
+        BlogPost.index_delete(post)
+        self.assertTrue(BlogPost.index_add(post))
+        self.assertEqual(mock_index.call_count, 4)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index(self, mock_bulk):
+        mock_bulk.side_effect = self.bulk_response
+
+        self.assertEqual(BlogPost.bulk_index(), {'indexed': 4, 'deleted': 1, 'skipped': 0, 'failed': 0})
+        mock_bulk.reset_mock()
+
+        self.assertEqual(BlogPost.bulk_index(), {'indexed': 0, 'deleted': 1, 'skipped': 4, 'failed': 0})
+        # only the batch with the delete in it is sent
+        self.assertEqual(mock_bulk.call_count, 1)
+
+        # writing into another index doesn't skip anything
+        self.assertEqual(BlogPost.bulk_index(index_name='blog-1'), {'indexed': 4, 'deleted': 1, 'skipped': 0, 'failed': 0})
+
+    def bulk_response(self, body, status=200, rejected=()):
+        # a `_bulk` response with an item per operation
+        items = []
+        for line in body:
+            for action in ('index', 'delete', 'update'):
+                if action in line:
+                    items.append({action: {'_id': line[action]['_id'], 'status': 429 if line[action]['_id'] in rejected else status}})
+        return {'items': items}
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_failed_items(self, mock_bulk):
+        post = BlogPost.objects.get(slug='title-1')
+        mock_bulk.side_effect = lambda body: self.bulk_response(body, rejected=[post.pk])
+        BlogPost.bulk_index()
+
+        # the rejected document isn't skipped next time
+        mock_bulk.side_effect = self.bulk_response
+        self.assertEqual(BlogPost.bulk_index(), {'indexed': 1, 'deleted': 1, 'skipped': 3, 'failed': 0})
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__new_index_forgets_fingerprints(self, mock_bulk):
+        mock_bulk.side_effect = self.bulk_response
+        BlogPost.bulk_index()
+
+        # eg. `es_manage --initialize`: the alias points at a new, empty index
+        es = mock.MagicMock()
+        es.indices.get_aliases.return_value = {'blog-1': {'aliases': {'blog': {}}}}
+        create_indices(es)
+        self.assertEqual(BlogPost.bulk_index(), {'indexed': 4, 'deleted': 1, 'skipped': 0, 'failed': 0})
+
+    def test__get_document_fingerprint(self):
+        post = BlogPost.objects.get(slug='title-1')
+        document = BlogPost.get_document(post)
+        self.assertEqual(BlogPost.get_document_fingerprint(document), BlogPost.get_document_fingerprint(dict(document)))
+        document['title'] = 'changed'
+        self.assertNotEqual(BlogPost.get_document_fingerprint(document), BlogPost.get_document_fingerprint(BlogPost.get_document(post)))
+
+
+class PartialUpdateTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        self.blog = Blog.objects.create(name='test blog name', description='test blog description')
+        BlogPost.objects.create(blog=self.blog, title="title", slug="title", body="body")
+
+    def test__get_changed_fields(self):
+        post = BlogPost.objects.get(slug='title')
+        self.assertEqual(BlogPost.get_changed_fields(post), set())
+
+        post.title = 'changed'
+        post.blog_id = 100
+        self.assertEqual(BlogPost.get_changed_fields(post), set(['title', 'blog']))
+
+    def test__get_changed_fields_old_django(self):
+        # `_meta.concrete_fields` is missing before Django 1.6
+        post = BlogPost.objects.get(slug='title')
+        post.title = 'changed'
+        meta = mock.Mock(spec=['fields'], fields=BlogPost._meta.fields)
+        with mock.patch.object(BlogPost, '_meta', meta):
+            self.assertEqual(BlogPost.get_changed_fields(post), set(['title']))
+
+    def test__get_document_fields(self):
+        self.assertEqual(BlogPost.get_document_fields(['title', 'slug']), set(['title', 'slug']))
+        self.assertEqual(BlogPost.get_document_fields(['title', 'blog_id']), None)
+        self.assertEqual(ElasticsearchIndexMixinClass.get_document_fields(['title']), None)
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.update')
+    def test__save_handler(self, mock_update, mock_index):
+        mock_update.return_value = mock_index.return_value = {}
+        post = BlogPost.objects.get(slug='title')
+
+        post.title = 'changed'
+        post.save()
+        mock_update.assert_called_once_with('blog', 'posts', post.pk, {'doc': {'title': 'changed'}}, routing=self.blog.pk)
+        self.assertFalse(mock_index.called)
+
+        # the loaded values are reset on save
+        post.body = 'changed'
+        post.save()
+        mock_update.assert_called_with('blog', 'posts', post.pk, {'doc': {'body': 'changed'}}, routing=self.blog.pk)
+
+        # unchanged, or changed in a way the type class doesn't declare: index the whole document
+        post.save()
+        self.assertEqual(mock_index.call_count, 1)
+        post.blog = Blog.objects.create(name='other', description='other')
+        post.save()
+        self.assertEqual(mock_index.call_count, 2)
+        self.assertEqual(mock_update.call_count, 2)
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    @mock.patch('elasticsearch.Elasticsearch.update')
+    def test__index_update_missing_document(self, mock_update, mock_index):
+        mock_update.side_effect = TransportError(404, 'DocumentMissingException')
+        mock_index.return_value = {}
+        post = BlogPost.objects.get(slug='title')
+
+        self.assertTrue(BlogPost.index_update(post, ['title']))
+        mock_index.assert_called_with('blog', 'posts', BlogPost.get_document(post), post.pk, routing=self.blog.pk)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_fields_missing_document(self, mock_bulk):
+        post = BlogPost.objects.get(slug='title')
+        mock_bulk.side_effect = [
+            {'items': [{'update': {'_id': str(post.pk), 'status': 404}}]},
+            {'items': [{'index': {'_id': str(post.pk), 'status': 201}}]},
+        ]
+
+        BlogPost.bulk_index(fields=['title'])
+        self.assertEqual(mock_bulk.call_count, 2)
+        self.assertEqual(mock_bulk.call_args_list[0][0][0][1], {'doc': {'title': 'title'}})
+        self.assertEqual(mock_bulk.call_args_list[1][0][0][1], BlogPost.get_document(post))
+
+
+class RelatedDependencyTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        self.blog = Blog.objects.create(name='test blog name', description='test blog description')
+        other = Blog.objects.create(name='other blog name', description='other blog description')
+        for x in range(1, 6):
+            BlogPost.objects.create(blog=self.blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+        BlogPost.objects.create(blog=other, title="other", slug="other", body="body")
+
+        self.patcher = mock.patch.object(es_settings, 'ELASTICSEARCH_RELATED_REINDEX_ASYNC', False)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__related_save(self, mock_bulk):
+        mock_bulk.return_value = {}
+        self.blog.name = 'renamed'
+        self.blog.save()
+
+        documents = [line for call in mock_bulk.call_args_list for line in call[0][0] if 'blog' in line]
+        self.assertEqual(len(documents), 5)
+        self.assertEqual(set(document['blog']['name'] for document in documents), set(['renamed']))
+
+    @mock.patch('simple_elasticsearch.mixins.ElasticsearchIndexMixin.reindex_related')
+    def test__related_save_update_fields(self, mock_reindex_related):
+        self.blog.save(update_fields=['name'])
+        self.assertEqual(mock_reindex_related.call_count, 1)
+
+        # no declared field was saved
+        dependencies = [dict(BlogPost.get_related_dependencies()[0], fields=['name'])]
+        with mock.patch.object(BlogPost, 'get_related_dependencies', return_value=dependencies):
+            self.blog.save(update_fields=['description'])
+        self.assertEqual(mock_reindex_related.call_count, 1)
+
+    @mock.patch('simple_elasticsearch.mixins.ElasticsearchIndexMixin.reindex_related')
+    def test__related_save_changed_fields(self, mock_reindex_related):
+        blog = Blog.objects.get(pk=self.blog.pk)
+        blog.save()
+        self.assertEqual(mock_reindex_related.call_count, 0)
+
+        blog.description = 'changed'
+        blog.save()
+        self.assertEqual(mock_reindex_related.call_count, 1)
+
+        # compared with the values as of the last save
+        blog.save()
+        self.assertEqual(mock_reindex_related.call_count, 1)
+
+    @mock.patch('simple_elasticsearch.mixins.background.put')
+    def test__related_save_async(self, mock_put):
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_RELATED_REINDEX_ASYNC', True):
+            self.blog.name = 'renamed'
+            self.blog.save()
+        mock_put.assert_called_once_with(BlogPost.reindex_related, BlogPost.get_related_dependencies()[0], [self.blog.pk])
+
+    @mock.patch('simple_elasticsearch.models.BlogPost.bulk_index')
+    def test__reindex_related_chunks(self, mock_bulk_index):
+        with mock.patch.object(BlogPost, 'get_query_limit', return_value=2):
+            BlogPost.reindex_related(BlogPost.get_related_dependencies()[0], [self.blog.pk])
+
+        # 5 posts, 2 per chunk
+        chunks = [list(call[1]['queryset'].order_by('pk')) for call in mock_bulk_index.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(sum(chunks, []), list(BlogPost.objects.filter(blog=self.blog).order_by('pk')))
+
+    def test__reindex_related_update_by_query(self):
+        es = mock.MagicMock()
+        body = {'query': {'term': {'blog.id': self.blog.pk}}, 'script': {'inline': 'ctx._source.blog.name = "renamed"'}}
+        with mock.patch.object(BlogPost, 'get_related_update', return_value=body):
+            BlogPost.reindex_related(BlogPost.get_related_dependencies()[0], [self.blog.pk], es)
+        es.transport.perform_request.assert_called_with(
+            'POST', '/blog/posts/_update_by_query', params={'conflicts': 'proceed', 'wait_for_completion': 'false'}, body=body
+        )
+        self.assertFalse(es.bulk.called)
+
+    def test__reindex_related_update_by_query_resets_fingerprints(self):
+        body = {'query': {'term': {'blog.id': self.blog.pk}}, 'script': {'inline': 'ctx._source.blog.name = "renamed"'}}
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default'):
+            generation = get_fingerprint_generation('blog')
+            with mock.patch.object(BlogPost, 'get_related_update', return_value=body):
+                BlogPost.reindex_related(BlogPost.get_related_dependencies()[0], [self.blog.pk], mock.MagicMock())
+            self.assertNotEqual(get_fingerprint_generation('blog'), generation)
+
+    def test__registry_related_lookup(self):
+        registry = TypeClassRegistry(['simple_elasticsearch.models.BlogPost'])
+        self.assertEqual(registry.get_type_classes_for_related_model(Blog), [BlogPost])
+        self.assertEqual(registry.get_type_classes_for_related_model(BlogPost), [])
+
+    def test__chunked(self):
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+    def test__background_worker(self):
+        worker = BackgroundWorker()
+        results = []
+        worker.put(results.append, 1)
+        with mock.patch('sys.stderr'):
+            worker.put(lambda: 1 / 0)
+        worker.put(results.append, 2)
+        worker.join()
+        self.assertEqual(results, [1, 2])
+
+
+class AdaptiveBulkTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x in range(1, 11):
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+
+    def get_controller(self, **kwargs):
+        controller = AdaptiveBulkController(**kwargs)
+        controller.sleep = mock.Mock()
+        return controller
+
+    def test__record(self):
+        controller = self.get_controller(batch_size=100, min_batch_size=10, max_batch_size=160, increase=50, max_latency=1.0)
+
+        controller.record(100, 0.1, {'took': 50})
+        self.assertEqual(controller.batch_size, 150)
+        controller.record(150, 0.1, {'took': 50})
+        self.assertEqual(controller.batch_size, 160)
+
+        # the server side `took` counts as well
+        controller.record(160, 0.1, {'took': 2000})
+        self.assertEqual(controller.batch_size, 80)
+        self.assertFalse(controller.sleep.called)
+
+        # rejections shrink the batch and back off, longer each time
+        controller.record(80, 0.1, {'items': [{'index': {'status': 429}}]})
+        controller.record(40, 0.1, rejected=True)
+        self.assertEqual(controller.batch_size, 20)
+        self.assertEqual([c[0][0] for c in controller.sleep.call_args_list], [1.0, 2.0])
+
+    def test__throttle(self):
+        controller = self.get_controller(max_docs_per_second=100)
+        controller.record(50, 0.1, {})
+        controller.sleep.assert_called_once_with(0.4)
+
+    def test__send_retries_rejected_request(self):
+        controller = self.get_controller(max_retries=1)
+        es = mock.Mock()
+        es.bulk.side_effect = [TransportError(429, 'rejected'), {'took': 1, 'items': []}]
+        self.assertEqual(controller.send(es, [], 10), {'took': 1, 'items': []})
+        self.assertEqual(es.bulk.call_count, 2)
+
+        es.bulk.side_effect = [TransportError(429, 'rejected'), TransportError(429, 'rejected')]
+        self.assertRaises(TransportError, controller.send, es, [], 10)
+
+        es.bulk.side_effect = [TransportError(400, 'bad request')]
+        self.assertRaises(TransportError, controller.send, es, [], 10)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index(self, mock_bulk):
+        mock_bulk.return_value = {'took': 1, 'items': []}
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_ADAPTIVE_BULK', {'min_batch_size': 1, 'increase': 2}):
+            stats = BlogPost.bulk_index()
+
+        # batches grow from the initial `get_bulk_index_limit()`
+        self.assertEqual(stats['indexed'], 10)
+        self.assertEqual([len(c[0][0]) // 2 for c in mock_bulk.call_args_list], [2, 4, 4])
+        self.assertEqual(stats['batch_sizes'], {'batches': 3, 'min': 2, 'max': 4, 'mean': 10 / 3.0, 'last': 4})
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_retries_rejected_items(self, mock_bulk):
+        mock_bulk.side_effect = [
+            {'took': 1, 'items': [{'index': {'status': 201}}, {'index': {'status': 429}}] + [{'index': {'status': 201}}] * 8},
+            {'took': 1, 'items': [{'index': {'status': 201}}]},
+        ]
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_ADAPTIVE_BULK', {'batch_size': 10, 'backoff': 0}):
+            stats = BlogPost.bulk_index()
+
+        self.assertEqual(mock_bulk.call_count, 2)
+        self.assertEqual(mock_bulk.call_args[0][0][1]['slug'], 'title-2')
+        self.assertEqual(stats['indexed'], 10)
+        self.assertEqual(stats['batch_sizes']['last'], 1)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__bulk_index_counts_failed_items(self, mock_bulk):
+        mock_bulk.side_effect = [
+            {'took': 1, 'items': [{'index': {'status': 429}}, {'index': {'status': 400}}] + [{'index': {'status': 201}}] * 8},
+            {'took': 1, 'items': [{'index': {'status': 429}}]},
+        ]
+
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_ADAPTIVE_BULK', {'batch_size': 10, 'backoff': 0, 'max_retries': 1}):
+            with mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default'):
+                from django.core.cache import cache
+                cache.clear()
+                stats = BlogPost.bulk_index()
+
+                # neither failed document is fingerprinted
+                mock_bulk.side_effect = None
+                mock_bulk.return_value = {'took': 1, 'items': []}
+                again = BlogPost.bulk_index()
+
+        self.assertEqual((stats['indexed'], stats['failed']), (8, 2))
+        self.assertEqual((again['indexed'], again['skipped']), (2, 8))
+
+
+class PartitionedBlogPostIndex(ElasticsearchIndexMixin):
+
+    @classmethod
+    def get_index_name(cls):
+        return 'events'
+
+    @classmethod
+    def get_type_name(cls):
+        return 'posts'
+
+    @classmethod
+    def get_queryset(cls):
+        return BlogPost.objects.order_by('pk')
+
+    @classmethod
+    def get_document(cls, obj):
+        return {'title': obj.title}
+
+    @classmethod
+    def get_partition_field(cls):
+        return 'created_at'
+
+
+class PartitionTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete, mock_bulk):
+        mock_index.return_value = mock_delete.return_value = mock_bulk.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        for x, created_at in enumerate([datetime.datetime(2015, 12, 31), datetime.datetime(2016, 1, 1), datetime.datetime(2016, 1, 15)]):
+            post = BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            BlogPost.objects.filter(pk=post.pk).update(created_at=created_at)
+
+        self.es = mock.MagicMock()
+        self.es.indices.get_settings.return_value = {}
+        self.es.indices.get_aliases.return_value = {}
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        self.es.bulk.return_value = {}
+        self.indices = collections.OrderedDict([('events', [PartitionedBlogPostIndex])])
+
+    def test__partition_ranges(self):
+        self.assertEqual(get_partition_range('2015.12'), (datetime.date(2015, 12, 1), datetime.date(2016, 1, 1)))
+        self.assertEqual(get_partition_range('2016', 'year'), (datetime.date(2016, 1, 1), datetime.date(2017, 1, 1)))
+        self.assertEqual(get_partition_range('2016.02.29', 'day'), (datetime.date(2016, 2, 29), datetime.date(2016, 3, 1)))
+        self.assertEqual(
+            get_partitions_for_range(datetime.date(2015, 11, 20), datetime.datetime(2016, 1, 1, 12)),
+            ['2015.11', '2015.12', '2016.01']
+        )
+
+    def test__get_partitions(self):
+        self.assertEqual(PartitionedBlogPostIndex.get_partitions(), ['2015.12', '2016.01'])
+        self.assertEqual(
+            list(PartitionedBlogPostIndex.get_partition_queryset('2016.01').values_list('slug', flat=True)),
+            ['title-1', 'title-2']
+        )
+
+    def test__create_indices(self):
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+            result, aliases = create_indices(self.es, ['events'])
+
+        self.assertEqual([index_name.rsplit('-', 2)[0] for index_alias, index_name in aliases], [
+            'events-2015.12', 'events-2015.12', 'events-2016.01', 'events-2016.01'
+        ])
+        self.assertEqual([index_alias for index_alias, index_name in aliases], [
+            'events', 'events-2015.12', 'events', 'events-2016.01'
+        ])
+        self.assertEqual(len(result), 2)
+        self.assertEqual(self.es.indices.create.call_count, 2)
+
+        # the read alias is only cleared once
+        actions = self.es.indices.update_aliases.call_args[0][0]['actions']
+        self.assertEqual([list(action.keys())[0] for action in actions], ['add'] * 4)
+
+    def test__rebuild_indices(self):
+        stats = {}
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+            rebuild_indices(self.es, stats=stats, alias_each=True)
+
+        # each partition's index only gets that partition's documents
+        self.assertEqual(stats[('events-2015.12', 'posts')]['indexed'], 1)
+        self.assertEqual(stats[('events-2016.01', 'posts')]['indexed'], 2)
+        for call in self.es.bulk.call_args_list:
+            operation = call[0][0][0]['index']
+            partition = BlogPost.objects.get(pk=operation['_id']).created_at.strftime('%Y.%m')
+            self.assertTrue(operation['_index'].startswith('events-{0}-'.format(partition)))
+
+        # the alias is switched once, when all partitions are complete
+        self.assertEqual(self.es.indices.update_aliases.call_count, 1)
+
+    def test__write_index_name(self):
+        post = BlogPost.objects.get(slug='title-0')
+        PartitionedBlogPostIndex._es = self.es
+        self.es.indices.exists_alias.return_value = False
+        try:
+            with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+                self.assertEqual(PartitionedBlogPostIndex.get_write_index_name(post), 'events-2015.12')
+                self.assertEqual(PartitionedBlogPostIndex.get_write_index_name(post), 'events-2015.12')
+                PartitionedBlogPostIndex.index_add(post)
+        finally:
+            del PartitionedBlogPostIndex._es
+
+        # a missing partition is created (once) with both aliases
+        self.assertEqual(self.es.indices.create.call_count, 1)
+        index_name, body = self.es.indices.create.call_args[0]
+        self.assertEqual(index_name, 'events-2015.12-auto')
+        self.assertEqual(sorted(body['aliases'].keys()), ['events', 'events-2015.12'])
+        self.assertEqual(self.es.index.call_args[0][0], 'events-2015.12')
+
+    def test__create_partition_index_concurrently(self):
+        # another process created the index between the check and the create
+        self.es.indices.exists_alias.side_effect = [False, True]
+        self.es.indices.create.side_effect = TransportError(400, 'IndexAlreadyExistsException[[events-2015.12-auto] already exists]')
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+            self.assertIsNone(create_partition_index(self.es, 'events', '2015.12'))
+        self.assertEqual(self.es.indices.create.call_count, 1)
+
+    def test__undated_partition(self):
+        self.assertEqual(PartitionedBlogPostIndex.get_partition(mock.Mock(created_at=None)), 'undated')
+        self.assertEqual(list(PartitionedBlogPostIndex.get_partition_queryset('undated')), [])
+
+    def test__partitions_are_utc(self):
+        tz = timezone.get_fixed_timezone(-300)
+        value = timezone.make_aware(datetime.datetime(2015, 12, 31, 20), tz)
+        self.assertEqual(PartitionedBlogPostIndex.get_partition(mock.Mock(created_at=value)), '2016.01')
+
+        # whatever the current time zone
+        with timezone.override(tz):
+            self.assertEqual(PartitionedBlogPostIndex.get_partitions(), ['2015.12', '2016.01'])
+            self.assertEqual(
+                list(PartitionedBlogPostIndex.get_partition_queryset('2016.01').values_list('slug', flat=True)),
+                ['title-1', 'title-2']
+            )
+
+    def test__mixed_type_classes(self):
+        indices = collections.OrderedDict([('events', [PartitionedBlogPostIndex, BlogPost])])
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=indices):
+            self.assertRaises(Exception, create_indices, self.es, ['events'])
+        self.assertEqual(self.es.indices.create.call_count, 0)
+
+    @mock.patch('simple_elasticsearch.mixins.create_partition_index')
+    def test__delete_does_not_create_partition(self, mock_create_partition_index):
+        post = BlogPost.objects.get(slug='title-0')
+        with mock.patch('simple_elasticsearch.mixins._partition_aliases', set()):
+            self.assertEqual(PartitionedBlogPostIndex.get_delete_operation(post)['delete']['_index'], 'events-2015.12')
+            with mock.patch.object(PartitionedBlogPostIndex, 'should_index', return_value=False):
+                PartitionedBlogPostIndex.bulk_index_objects([post], self.es)
+        self.assertFalse(mock_create_partition_index.called)
+        self.assertEqual(self.es.bulk.call_args[0][0], [{'delete': {'_index': 'events-2015.12', '_type': 'posts', '_id': post.pk}}])
+
+    def test__export_refused(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+                self.assertRaises(Exception, export_indices, directory)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    @mock.patch.object(PartitionedBlogPostIndex, 'index_add')
+    @mock.patch.object(PartitionedBlogPostIndex, 'index_delete')
+    def test__save_moves_partition(self, mock_index_delete, mock_index_add):
+        post = BlogPost.objects.get(slug='title-0')
+        PartitionedBlogPostIndex.init_handler(BlogPost, post)
+        post.created_at = timezone.make_aware(datetime.datetime(2016, 2, 1), timezone.utc)
+        PartitionedBlogPostIndex.save_handler(BlogPost, post, created=False)
+
+        mock_index_delete.assert_called_once_with(post, 'events-2015.12')
+        mock_index_add.assert_called_once_with(post, '')
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__save_moves_partition_fingerprinted(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        post = BlogPost.objects.get(slug='title-1')
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default'):
+            from django.core.cache import cache
+            cache.clear()
+            with mock.patch('simple_elasticsearch.mixins._partition_aliases', set(['events-2016.01', 'events-2016.02'])):
+                self.assertTrue(PartitionedBlogPostIndex.index_add(post))
+
+                # the document is unchanged, but in another partition now
+                PartitionedBlogPostIndex.init_handler(BlogPost, post)
+                post.created_at = timezone.make_aware(datetime.datetime(2016, 2, 1), timezone.utc)
+                PartitionedBlogPostIndex.save_handler(BlogPost, post, created=False)
+
+        self.assertEqual(mock_delete.call_args[0][0], 'events-2016.01')
+        self.assertEqual([call[0][0] for call in mock_index.call_args_list], ['events-2016.01', 'events-2016.02'])
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__update_moves_partition(self, mock_bulk):
+        mock_bulk.return_value = {}
+        with mock.patch('simple_elasticsearch.mixins.ElasticsearchQuerySetMixin.get_es_type_classes', return_value=[PartitionedBlogPostIndex]):
+            with mock.patch('simple_elasticsearch.mixins._partition_aliases', set(['events-2016.01'])):
+                BlogPost.objects.filter(slug__in=['title-0', 'title-1']).update(
+                    created_at=timezone.make_aware(datetime.datetime(2016, 1, 20), timezone.utc)
+                )
+
+        # only the post that was in another partition is deleted from it
+        deletes = [line['delete'] for line in mock_bulk.call_args_list[0][0][0]]
+        self.assertEqual([(line['_index'], line['_id']) for line in deletes], [('events-2015.12', BlogPost.objects.get(slug='title-0').pk)])
+
+    def test__search_date_range(self):
+        with mock.patch('simple_elasticsearch.utils.get_indices', return_value=self.indices):
+            self.assertEqual(
+                get_partitioned_index_names('events,blog', datetime.date(2015, 12, 5), datetime.date(2016, 1, 5)),
+                'events-2015.12,events-2016.01,blog'
+            )
+
+            esp = ElasticsearchProcessor(self.es)
+            esp.add_search({}, index='events', date_range=(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)))
+        self.assertEqual(esp.bulk_search_data[0], {'index': 'events-2016.01', 'ignore_unavailable': True})
+
+
+class HydrationTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.posts = [
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            for x in range(3)
+        ]
+
+        from django.core.cache import cache
+        cache.clear()
+
+    def get_response(self):
+        def hit(index, type_name, id):
+            return {'_index': index, '_type': type_name, '_id': str(id), '_source': {}}
+
+        return DSEResponse({'hits': {'total': 5, 'hits': [
+            hit('blog-20160101-000000', 'posts', self.posts[2].pk),
+            hit('blog', 'posts', 999999),
+            hit('blog-20160101-000000', 'posts', self.posts[0].pk),
+            hit('other', 'things', 1),
+        ]}}, 1, 20)
+
+    def test__hydrate(self):
+        response = self.get_response()
+        with self.assertNumQueries(1):
+            objects = response.hydrate()
+        self.assertEqual(objects, [self.posts[2], self.posts[0]])
+        self.assertEqual(response.hits[0].meta.object, self.posts[2])
+        self.assertIsNone(response.hits[1].meta.object)
+
+        self.assertEqual(self.get_response().hydrate(missing='none'), [self.posts[2], None, self.posts[0], None])
+
+    def test__hydrate_cache(self):
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_HYDRATION_CACHE', 'default'):
+            self.get_response().hydrate()
+            with self.assertNumQueries(1):
+                # only the missing row is looked up again
+                objects = self.get_response().hydrate()
+        self.assertEqual(objects, [self.posts[2], self.posts[0]])
+
+    def test__get_type_class_for_index(self):
+        registry = TypeClassRegistry(['simple_elasticsearch.models.BlogPost'])
+        self.assertEqual(registry.get_type_class_for_index('blog', 'posts'), BlogPost)
+        self.assertEqual(registry.get_type_class_for_index('blog-2016.01-20160101-000000', 'posts'), BlogPost)
+        self.assertIsNone(registry.get_type_class_for_index('blogs', 'posts'))
+        self.assertIsNone(registry.get_type_class_for_index('blog-1', 'comments'))
+
+
+class CallCollectorTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.perform_request.return_value = (200, {}, '{"found": true}')
+        self.es = get_elasticsearch(connection_class=mock.Mock(return_value=self.connection))
+
+    def test__get_operation(self):
+        self.assertEqual(get_operation('POST', '/blog/posts/_search'), ('search', 'blog'))
+        self.assertEqual(get_operation('GET', '/_msearch'), ('msearch', ''))
+        self.assertEqual(get_operation('GET', '/blog/posts/1'), ('get', 'blog'))
+        self.assertEqual(get_operation('PUT', '/blog/posts/1'), ('index', 'blog'))
+        self.assertEqual(get_operation('DELETE', '/blog/posts/1'), ('delete', 'blog'))
+
+    def test__collect(self):
+        # nothing is recorded without an active collector
+        self.es.get('blog', 1, 'posts')
+
+        with CallCollector() as outer:
+            self.es.get('blog', 1, 'posts')
+            with CallCollector() as inner:
+                self.es.get('blog', 1, 'posts')
+                self.es.search('blog', body={'query': {'match_all': {}}})
+
+        self.assertEqual([call['operation'] for call in outer.calls], ['get', 'get', 'search'])
+        self.assertEqual(inner.count, 2)
+        self.assertEqual(outer.duplicates, 1)
+        self.assertEqual(inner.size, len('{"query": {"match_all": {}}}'))
+        self.assertTrue(outer.get_server_timing().endswith('desc="3 Elasticsearch calls"'))
+
+    def test__middleware(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from .context_processors import elasticsearch_calls
+
+        def view(request):
+            self.es.get('blog', 1, 'posts')
+            self.assertEqual(elasticsearch_calls(request)['elasticsearch_calls'].count, 1)
+            response = HttpResponse()
+            response['Server-Timing'] = 'db;dur=2'
+            return response
+
+        request = RequestFactory().get('/')
+        response = ElasticsearchCallsMiddleware(view)(request)
+        self.assertTrue(response['Server-Timing'].startswith('db;dur=2, es;dur='))
+        self.assertEqual(get_call_collectors(), [])
+
+
+class ConnectionProfileTestCase(TestCase):
+
+    profiles = {
+        'search': {'timeout': 2, 'max_retries': 1},
+        'bulk': {'timeout': 120, 'hosts': ['10.0.0.5:9200']},
+    }
+
+    def setUp(self):
+        reset_connections()
+
+    def tearDown(self):
+        reset_connections()
+        for attr in ('_es', '_es_profiles'):
+            if attr in BlogPost.__dict__:
+                delattr(BlogPost, attr)
+
+    def test__get_connection_params(self):
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_CONNECTION_PROFILES', self.profiles):
+            self.assertEqual(get_connection_params('bulk', {'hosts': ['127.0.0.1:9200'], 'timeout': 10}), {
+                'hosts': ['10.0.0.5:9200'], 'timeout': 120
+            })
+            self.assertEqual(get_connection_params('get', {'timeout': 10}), {'timeout': 10})
+
+    def test__get_connection(self):
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_CONNECTION_PROFILES', self.profiles):
+            self.assertIs(get_connection('search'), get_connection('search'))
+            self.assertIsNot(get_connection('search'), get_connection('bulk'))
+            # profiles without settings share the default client
+            self.assertIs(get_connection('get'), get_connection('admin'))
+            self.assertIs(get_connection('get'), get_connection())
+
+    def test__mixin_profiles(self):
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_CONNECTION_PROFILES', self.profiles):
+            self.assertIs(BlogPost.get_es('write'), BlogPost.get_es())
+            self.assertIsNot(BlogPost.get_es('bulk'), BlogPost.get_es())
+            self.assertIs(BlogPost.get_es('bulk'), BlogPost.get_es('bulk'))
+
+            with mock.patch('simple_elasticsearch.mixins.get_elasticsearch') as mock_get_elasticsearch:
+                del BlogPost._es_profiles
+                BlogPost.get_es('bulk')
+            mock_get_elasticsearch.assert_called_once_with(hosts=['10.0.0.5:9200'], timeout=120)
+
+    @mock.patch('simple_elasticsearch.forms.get_connection')
+    def test__processor_profile(self, mock_get_connection):
+        self.assertEqual(ElasticsearchProcessor().es, mock_get_connection.return_value)
+        mock_get_connection.assert_called_once_with('search')
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index, mock_delete):
+        mock_index.return_value = mock_delete.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.posts = [
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            for x in range(2)
+        ]
+
+        self.directory = tempfile.mkdtemp()
+        self.patchers = [
+            mock.patch.object(es_settings, 'ELASTICSEARCH_CIRCUIT_BREAKER', {'failure_threshold': 2, 'reset_timeout': 30}),
+            mock.patch.object(es_settings, 'ELASTICSEARCH_SPOOL_PATH', os.path.join(self.directory, 'spool.sqlite3')),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        breaker.reset()
+
+    def tearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        breaker.reset()
+        shutil.rmtree(self.directory)
+
+    def test__circuit_breaker(self):
+        circuit_breaker = breaker.CircuitBreaker(failure_threshold=2, reset_timeout=10)
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow())
+
+        # a single trial request is let through after the timeout
+        circuit_breaker.opened_at -= 10
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow())
+
+        circuit_breaker.opened_at -= 10
+        self.assertTrue(circuit_breaker.allow())
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.is_open)
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__trial_error(self, mock_index):
+        circuit_breaker = breaker.get_circuit_breaker()
+        circuit_breaker.opened_at = time.time() - 30
+
+        # the trial request fails, but not because of the cluster
+        mock_index.side_effect = ValueError('not serializable')
+        self.assertRaises(ValueError, BlogPost.index_add, self.posts[0])
+
+        mock_index.side_effect = None
+        mock_index.return_value = {}
+        self.assertTrue(BlogPost.index_add(self.posts[0]))
+        self.assertFalse(circuit_breaker.is_open)
+
+    def test__is_unavailable_error(self):
+        self.assertTrue(breaker.is_unavailable_error(ConnectionError('N/A', 'refused')))
+        self.assertTrue(breaker.is_unavailable_error(TransportError(503, 'unavailable')))
+        self.assertTrue(breaker.is_unavailable_error(TransportError(429, 'rejected')))
+        self.assertFalse(breaker.is_unavailable_error(TransportError(400, 'bad request')))
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__spool_and_replay(self, mock_index, mock_delete):
+        mock_index.side_effect = mock_delete.side_effect = ConnectionError('N/A', 'refused')
+
+        self.assertFalse(BlogPost.index_add(self.posts[0]))
+        self.assertFalse(BlogPost.index_delete(self.posts[1]))
+        self.assertEqual(mock_index.call_count, 1)
+        self.assertEqual(mock_delete.call_count, 1)
+
+        # the breaker is open now, so nothing else is sent
+        self.assertFalse(BlogPost.index_add(self.posts[0]))
+        self.assertFalse(BlogPost.index_add(self.posts[1]))
+        self.assertEqual(mock_index.call_count, 1)
+
+        spool = breaker.get_spool()
+        self.assertEqual(len(spool), 4)
+
+        with mock.patch('elasticsearch.Elasticsearch.bulk') as mock_bulk:
+            mock_bulk.return_value = {}
+            stats = breaker.replay_spool(spool)
+
+        # only the last write of each document is sent
+        self.assertEqual(stats, {'indexed': 2, 'deleted': 0, 'skipped': 2, 'failed': 0})
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(
+            sorted(line['index']['_id'] for call in mock_bulk.call_args_list for line in call[0][0] if 'index' in line),
+            sorted([self.posts[0].pk, self.posts[1].pk])
+        )
+
+    def test__replay_delete(self):
+        spool = breaker.get_spool()
+        spool.append(BlogPost, self.posts[0], 'delete')
+
+        with mock.patch('elasticsearch.Elasticsearch.bulk') as mock_bulk:
+            mock_bulk.return_value = {'items': [{'delete': {'status': 200}}]}
+            stats = breaker.replay_spool(spool)
+        self.assertEqual(stats, {'indexed': 0, 'deleted': 1, 'skipped': 0, 'failed': 0})
+        mock_bulk.assert_called_once_with([BlogPost.get_bulk_operation(self.posts[0], delete=True)[0]])
+        self.assertEqual(len(spool), 0)
+
+    def test__replay_keeps_failed(self):
+        spool = breaker.get_spool()
+        spool.append(BlogPost, self.posts[0], 'index')
+        spool.append(BlogPost, self.posts[1], 'delete')
+        spool.append(BlogPost, self.posts[1], 'index')
+
+        def bulk(body, **kwargs):
+            if 'delete' in body[0]:
+                return {'items': [{'delete': {'status': 500}}]}
+            return {'items': [{'index': {'status': 201 if line['index']['_id'] == self.posts[0].pk else 400}}
+                              for line in body if 'index' in line]}
+
+        # a write at a time, so none supersedes another
+        with mock.patch('elasticsearch.Elasticsearch.bulk', side_effect=bulk):
+            stats = breaker.replay_spool(spool, chunksize=1)
+        self.assertEqual(stats, {'indexed': 1, 'deleted': 0, 'skipped': 0, 'failed': 2})
+
+        # the rejected writes are left for the next replay
+        self.assertEqual([(row[5], row[6]) for row in spool.read()], [('delete', str(self.posts[1].pk)), ('index', str(self.posts[1].pk))])
+
+    def test__spool_partitioned_delete(self):
+        spool = breaker.get_spool()
+        es = mock.MagicMock()
+        PartitionedBlogPostIndex._es = es
+        try:
+            # appending doesn't need the cluster
+            spool.append(PartitionedBlogPostIndex, self.posts[0], 'delete')
+            self.assertEqual(es.method_calls, [])
+
+            with mock.patch.object(breaker.registry, 'get_type_class', return_value=PartitionedBlogPostIndex):
+                breaker.replay_spool(spool)
+        finally:
+            del PartitionedBlogPostIndex._es
+
+        partition = self.posts[0].created_at.strftime('%Y.%m')
+        es.bulk.assert_called_once_with([{'delete': {'_index': 'events-' + partition, '_type': 'posts', '_id': self.posts[0].pk}}])
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__without_spool(self, mock_index):
+        mock_index.side_effect = TransportError(503, 'unavailable')
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_SPOOL_PATH', None):
+            self.assertRaises(TransportError, BlogPost.index_add, self.posts[0])
+            self.assertRaises(TransportError, BlogPost.index_add, self.posts[0])
+            self.assertRaises(CircuitOpenError, BlogPost.index_add, self.posts[0])
+        self.assertEqual(mock_index.call_count, 2)
+
+        # request errors don't trip the breaker
+        breaker.reset()
+        mock_index.side_effect = TransportError(400, 'bad request')
+        for x in range(3):
+            self.assertRaises(TransportError, BlogPost.index_add, self.posts[0])
+        self.assertEqual(mock_index.call_count, 5)
+
+
+class VerifyIndexTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.posts = [
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            for x in range(3)
+        ]
+
+    def test__id_bitmap(self):
+        bitmap = IdBitmap()
+        for id in (3, 1, 70000, 3):
+            bitmap.add(id)
+        self.assertEqual(len(bitmap), 3)
+        self.assertTrue(70000 in bitmap)
+        self.assertFalse(2 in bitmap)
+        self.assertFalse(10 ** 9 in bitmap)
+        self.assertRaises(ValueError, bitmap.add, -1)
+
+        other = IdBitmap()
+        for id in (1, 2, 5):
+            other.add(id)
+        self.assertEqual(list(bitmap.difference(other)), [3, 70000])
+        self.assertEqual(list(other.difference(bitmap)), [2, 5])
+
+    @mock.patch('simple_elasticsearch.utils.scan_index')
+    def test__verify_index(self, mock_scan):
+        es = mock.MagicMock()
+        extra_id = self.posts[-1].pk + 100
+        mock_scan.return_value = iter([{'_id': str(self.posts[0].pk)}, {'_id': str(extra_id)}])
+
+        result = verify_index(BlogPost, es)
+        self.assertEqual(mock_scan.call_args[0], ('blog',))
+        self.assertEqual(mock_scan.call_args[1]['es'], es)
+        self.assertEqual(mock_scan.call_args[1]['source'], False)
+        self.assertEqual((result['missing'], result['extra']), (2, 1))
+        self.assertEqual(result['samples']['missing'], [self.posts[1].pk, self.posts[2].pk])
+        self.assertEqual(result['samples']['extra'], [extra_id])
+        self.assertFalse(es.bulk.called)
+
+        # samples are capped
+        mock_scan.return_value = iter([])
+        result = verify_index(BlogPost, es, sample_size=1)
+        self.assertEqual(result['missing'], 3)
+        self.assertEqual(result['samples']['missing'], [self.posts[0].pk])
+
+    @mock.patch('simple_elasticsearch.utils.scan_index')
+    def test__verify_index_should_index(self, mock_scan):
+        es = mock.MagicMock()
+        with mock.patch('elasticsearch.Elasticsearch.bulk', return_value={}):
+            BlogPost.objects.filter(pk=self.posts[1].pk).update(slug='DO-NOT-INDEX')
+        mock_scan.return_value = iter([{'_id': str(self.posts[0].pk)}])
+
+        with mock.patch.object(BlogPost, 'bulk_index') as mock_bulk_index:
+            result = verify_index(BlogPost, es, repair=True)
+
+        # the post that isn't to be indexed is neither missing nor repaired
+        self.assertEqual(result['missing'], 1)
+        self.assertEqual(result['samples']['missing'], [self.posts[2].pk])
+        self.assertEqual(list(mock_bulk_index.call_args[1]['queryset'].values_list('pk', flat=True)), [self.posts[2].pk])
+
+    @mock.patch('simple_elasticsearch.utils.scan_index')
+    def test__verify_index_repair(self, mock_scan):
+        es = mock.MagicMock()
+        extra_id = self.posts[-1].pk + 100
+        hits = [{'_id': str(post.pk), '_source': BlogPost.get_document(post)} for post in self.posts[:2]]
+        hits[1]['_source']['title'] = 'changed'
+        mock_scan.return_value = iter(hits + [{'_id': str(extra_id), '_source': {}}])
+        es.search.return_value = {'hits': {'hits': [{'_index': 'blog-1', '_id': str(extra_id), '_routing': '1'}]}}
+
+        with mock.patch.object(BlogPost, 'bulk_index') as mock_bulk_index:
+            result = verify_index(BlogPost, es, repair=True, stale=True)
+
+        self.assertEqual(result['samples']['missing'], [self.posts[2].pk])
+        self.assertEqual(result['samples']['stale'], [self.posts[1].pk])
+
+        # only the missing and stale objects are indexed
+        self.assertEqual(
+            sorted(pk for call in mock_bulk_index.call_args_list for pk in call[1]['queryset'].values_list('pk', flat=True)),
+            [self.posts[1].pk, self.posts[2].pk]
+        )
+        es.bulk.assert_called_once_with([{'delete': {'_index': 'blog-1', '_type': 'posts', '_id': str(extra_id), 'routing': '1'}}])
+
+    @mock.patch('simple_elasticsearch.utils.scan_index')
+    def test__verify_index_repair_fingerprinted(self, mock_scan):
+        es = mock.MagicMock()
+        es.bulk.return_value = {}
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default'):
+            from django.core.cache import cache
+            cache.clear()
+            BlogPost.bulk_index(es)
+            es.bulk.reset_mock()
+
+            # the documents were lost from the index since
+            mock_scan.return_value = iter([])
+            verify_index(BlogPost, es, repair=True)
+
+        self.assertEqual(
+            sorted(line['index']['_id'] for call in es.bulk.call_args_list for line in call[0][0] if 'index' in line),
+            [post.pk for post in self.posts]
+        )
+
+
+class ReindexFromIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.MagicMock()
+        self.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        self.es.indices.get_settings.return_value = {}
+        self.es.indices.get_aliases.return_value = {'blog-old': {'aliases': {'blog': {}}}}
+        self.requests = []
+
+        def perform_request(method, url, params=None, body=None):
+            self.requests.append((method, url, params, body))
+            if method == 'POST':
+                return {'task': 'node:1'}
+            # the task completes on the second check
+            completed = len([request for request in self.requests if request[0] == 'GET']) > 1
+            return {'completed': completed, 'response': {'created': 3, 'took': 1500, 'failures': []}}
+        self.es.transport.perform_request.side_effect = perform_request
+
+    def test__wait_for_reindex(self):
+        self.assertEqual(wait_for_reindex(self.es, 'node:1', poll_interval=0)['created'], 3)
+        self.assertEqual([request[:2] for request in self.requests], [('GET', '/_tasks/node:1')] * 2)
+
+        self.es.transport.perform_request.side_effect = None
+        self.es.transport.perform_request.return_value = {'completed': True, 'response': {'failures': [{'id': '1'}]}}
+        self.assertRaises(ReindexError, wait_for_reindex, self.es, 'node:1', 0)
+
+    def test__wait_for_task_interrupted(self):
+        self.es.transport.perform_request.side_effect = [KeyboardInterrupt(), {}]
+        self.assertRaises(KeyboardInterrupt, wait_for_reindex, self.es, 'node:1', 0)
+
+        # the task is cancelled rather than left running in the cluster
+        self.assertEqual(self.es.transport.perform_request.call_args[0], ('POST', '/_tasks/node:1/_cancel'))
+
+    def test__start_reindex_single_slice(self):
+        rebuild_indices_from_index(self.es, slices=1, poll_interval=0)
+        self.assertEqual(self.requests[0][2], {'wait_for_completion': 'false'})
+
+    def test__rebuild_indices_from_index(self):
+        stats = {}
+        created_indices, aliases = rebuild_indices_from_index(self.es, slices=4, poll_interval=0, stats=stats)
+        index_name = aliases[0][1]
+
+        method, url, params, body = self.requests[0]
+        self.assertEqual((method, url, params), ('POST', '/_reindex', {'wait_for_completion': 'false', 'slices': 4}))
+        self.assertEqual(body, {'source': {'index': 'blog'}, 'dest': {'index': index_name}})
+        self.assertEqual(stats[('blog', index_name)]['created'], 3)
+
+        # the new index gets the bulk loading settings, then is aliased
+        # in place of the old one
+        self.assertEqual(self.es.indices.put_settings.call_count, 2)
+        self.es.indices.update_aliases.assert_called_once_with({'actions': [
+            {'remove': {'index': 'blog-old', 'alias': 'blog'}},
+            {'add': {'index': index_name, 'alias': 'blog'}},
+        ]})
+
+    def test__rebuild_indices_from_missing_index(self):
+        self.es.indices.get_aliases.return_value = {}
+        self.assertRaises(ReindexError, rebuild_indices_from_index, self.es)
+        self.assertFalse(self.es.indices.create.called)
+
+
+class BulkDeleteTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.posts = [
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            for x in range(3)
+        ]
+
+    def test__index_delete_many(self):
+        es = mock.MagicMock()
+        es.bulk.side_effect = [
+            {'items': [{'delete': {'status': 200}}, {'delete': {'status': 404}}]},
+            {'items': [{'delete': {'status': 500}}]},
+        ]
+
+        # objects and ids can be mixed; a batch is `get_bulk_index_limit()` (2) documents
+        stats = BlogPost.index_delete_many([self.posts[0], self.posts[1], 'abc'], es)
+        self.assertEqual(stats, {'deleted': 1, 'missing': 1, 'failed': 1})
+        self.assertEqual(es.bulk.call_count, 2)
+        self.assertEqual(es.bulk.call_args_list[0][0][0][0], BlogPost.get_bulk_operation(self.posts[0], delete=True)[0])
+        self.assertEqual(es.bulk.call_args_list[1][0][0], [{'delete': {'_index': 'blog', '_type': 'posts', '_id': 'abc'}}])
+
+    def test__index_delete_many_partitioned_ids(self):
+        es = mock.MagicMock()
+        self.assertRaises(ValueError, PartitionedBlogPostIndex.index_delete_many, [self.posts[0].pk], es)
+        self.assertFalse(es.bulk.called)
+
+        # unless the partition's index is given
+        es.bulk.return_value = {}
+        PartitionedBlogPostIndex.index_delete_many([self.posts[0].pk], es, 'events-2016.01')
+        self.assertEqual(es.bulk.call_args[0][0], [{'delete': {'_index': 'events-2016.01', '_type': 'posts', '_id': self.posts[0].pk}}])
+
+    def test__delete_queryset(self):
+        es = mock.MagicMock()
+        es.bulk.return_value = {'items': [{'delete': {'status': 200}}] * 2}
+        BlogPost.delete_queryset(BlogPost.objects.filter(pk__in=[self.posts[0].pk, self.posts[2].pk]), es)
+        self.assertEqual(
+            sorted(line['delete']['_id'] for call in es.bulk.call_args_list for line in call[0][0]),
+            [self.posts[0].pk, self.posts[2].pk]
+        )
+        # the objects themselves are left alone
+        self.assertEqual(BlogPost.objects.count(), 3)
+
+    def test__delete_where(self):
+        es = mock.MagicMock()
+        es.transport.perform_request.side_effect = [
+            {'task': 'node:1'},
+            {'completed': True, 'response': {'deleted': 5, 'failures': []}},
+        ]
+
+        query = {'range': {'created_at': {'lt': '2015-01-01'}}}
+        response = BlogPost.delete_where(query, es, slices=2, requests_per_second=500)
+        self.assertEqual(response['deleted'], 5)
+        es.transport.perform_request.assert_any_call(
+            'POST', '/blog/posts/_delete_by_query',
+            params={'wait_for_completion': 'false', 'conflicts': 'proceed', 'slices': 2, 'requests_per_second': 500},
+            body={'query': query}
+        )
+
+    def test__delete_where_resets_fingerprints(self):
+        es = mock.MagicMock()
+        es.transport.perform_request.side_effect = [{'task': 'node:1'}, {'completed': True, 'response': {'deleted': 5}}]
+        with mock.patch.object(es_settings, 'ELASTICSEARCH_FINGERPRINT_CACHE', 'default'):
+            generation = get_fingerprint_generation('blog')
+            BlogPost.delete_where({'match_all': {}}, es)
+            self.assertNotEqual(get_fingerprint_generation('blog'), generation)
+
+        # without scrolling through the matching documents first
+        self.assertFalse(es.search.called)
+
+
+class MirrorTestCase(TestCase):
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def setUp(self, mock_index):
+        mock_index.return_value = {}
+        blog = Blog.objects.create(name='test blog name', description='test blog description')
+        self.posts = [
+            BlogPost.objects.create(blog=blog, title="title {0}".format(x), slug="title-{0}".format(x), body="body")
+            for x in range(3)
+        ]
+
+        self.patcher = mock.patch.object(es_settings, 'ELASTICSEARCH_MIRRORS', {'secondary': {'hosts': ['10.0.0.2:9200'], 'queue_size': 5}})
+        self.patcher.start()
+        mirrors.reset_mirrors()
+        self.mirror = mirrors.get_mirrors()[0]
+        self.mirror.es = mock.MagicMock()
+        self.mirror.es.indices.get_settings.return_value = {}
+        self.mirror.es.indices.get_aliases.return_value = {}
+        self.mirror.es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+
+    def tearDown(self):
+        self.patcher.stop()
+        mirrors.reset_mirrors()
+
+    def test__mirror_stats(self):
+        self.assertEqual(self.mirror.name, 'secondary')
+        self.assertEqual(self.mirror.worker.queue.maxsize, 5)
+
+        self.mirror.call(lambda es: {'errors': False})
+        with mock.patch('sys.stderr'):
+            self.mirror.call(lambda es: {'errors': True})
+            self.mirror.call(lambda es: 1 / 0)
+        with mock.patch.object(self.mirror.worker, 'put_nowait', return_value=False):
+            self.mirror.send(lambda es: None)
+
+        stats = self.mirror.get_stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['dropped']), (1, 2, 1))
+        self.assertTrue('ZeroDivisionError' in stats['last_error'])
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__single_writes(self, mock_index, mock_delete):
+        post = self.posts[0]
+        self.assertTrue(BlogPost.index_add(post))
+        self.assertTrue(BlogPost.index_delete(post))
+        self.mirror.join()
+
+        self.mirror.es.index.assert_called_once_with('blog', 'posts', BlogPost.get_document(post), post.pk, routing=1)
+        self.mirror.es.delete.assert_called_once_with('blog', 'posts', post.pk, routing=1, ignore=404)
+        self.assertEqual(self.mirror.get_stats()['sent'], 2)
+
+    def test__bulk_index(self):
+        es = mock.MagicMock()
+        BlogPost.bulk_index(es)
+        self.mirror.join()
+
+        # every batch is serialized once, and the same body sent to both clusters
+        bodies = [call[0][0] for call in es.bulk.call_args_list]
+        self.assertTrue(all(isinstance(body, str) for body in bodies))
+        self.assertEqual(bodies, [call[0][0] for call in self.mirror.es.bulk.call_args_list])
+        self.assertEqual(sorted(json.loads(line)['index']['_id'] for body in bodies for line in body.splitlines()[::2]),
+                         [post.pk for post in self.posts])
+
+    def test__rebuild_indices(self):
+        es = mock.MagicMock()
+        es.indices.get_settings.return_value = {}
+        es.indices.get_aliases.return_value = {}
+        es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+
+        created_indices, aliases = rebuild_indices(es)
+
+        # the mirror gets the same index, documents and alias
+        index_name = aliases[0][1]
+        self.assertEqual(self.mirror.es.indices.create.call_args[0][0], index_name)
+        self.assertEqual(self.mirror.es.bulk.call_count, es.bulk.call_count)
+        self.mirror.es.indices.update_aliases.assert_called_once_with({'actions': [{'add': {'index': index_name, 'alias': 'blog'}}]})
+
+    def test__rebuild_indices_blocks_only_its_writes(self):
+        es = mock.MagicMock()
+        es.indices.get_settings.return_value = {}
+        es.indices.get_aliases.return_value = {}
+        es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+
+        with mock.patch.object(self.mirror, 'send', wraps=self.mirror.send) as mock_send:
+            rebuild_indices(es)
+            self.assertTrue(all(call[0][1] for call in mock_send.call_args_list))
+
+            # writes through the alias meanwhile are still dropped when the queue is full
+            BlogPost.bulk_index(es)
+            self.assertFalse(mock_send.call_args[0][1])
+
+    def test__failed_rebuild_indices(self):
+        es = mock.MagicMock()
+        es.indices.get_settings.return_value = {}
+        es.indices.get_aliases.return_value = {}
+        es.cluster.health.return_value = {'status': 'green', 'timed_out': False}
+        es.bulk.side_effect = ConnectionError('N/A', 'refused')
+
+        self.assertRaises(ConnectionError, rebuild_indices, es)
+
+        # the mirror's index gets its settings back, but isn't aliased
+        self.assertEqual(self.mirror.es.indices.put_settings.call_count, 2)
+        self.assertFalse(self.mirror.es.indices.update_aliases.called)
+
+    def test__rebuild_indices_from_index(self):
+        self.assertRaises(ReindexError, rebuild_indices_from_index, mock.MagicMock())
+
+    @mock.patch('elasticsearch.Elasticsearch.delete')
+    def test__delete_without_pk(self, mock_delete):
+        post = self.posts[0]
+        pk = post.pk
+        with mock.patch.object(self.mirror.worker, 'put_nowait') as mock_put:
+            BlogPost.index_delete(post)
+            post.pk = None
+
+            # the queued request doesn't look at the object again
+            func, request = mock_put.call_args[0]
+            request(self.mirror.es)
+        self.mirror.es.delete.assert_called_once_with('blog', 'posts', pk, routing=1, ignore=404)
+
+    @mock.patch('elasticsearch.Elasticsearch.index')
+    def test__partition_write(self, mock_index):
+        mock_index.return_value = {}
+        self.mirror.es.indices.exists_alias.return_value = False
+        post = self.posts[0]
+        partition = PartitionedBlogPostIndex.get_partition(post)
+        with mock.patch('simple_elasticsearch.mixins._partition_aliases', set(['events-' + partition])):
+            with mock.patch('simple_elasticsearch.utils.get_indices', return_value={'events': [PartitionedBlogPostIndex]}):
+                self.assertTrue(PartitionedBlogPostIndex.index_add(post))
+                PartitionedBlogPostIndex.bulk_index_objects(self.posts, mock.MagicMock())
+                self.mirror.join()
+
+        # the mirror gets the partition's index, with its aliases, before the first write; once
+        self.assertEqual(self.mirror.es.indices.create.call_count, 1)
+        index_name, body = self.mirror.es.indices.create.call_args[0]
+        self.assertEqual(index_name, 'events-{0}-auto'.format(partition))
+        self.assertEqual(body['aliases'], {'events': {}, 'events-' + partition: {}})
+        self.assertEqual(self.mirror.es.method_calls[-2][0], 'index')
+        self.assertEqual(self.mirror.es.method_calls[-1][0], 'bulk')
+
+    def test__reindex_related_update_by_query(self):
+        es = mock.MagicMock()
+        body = {'query': {'match_all': {}}, 'script': {'inline': 'ctx._source.blog.name = "renamed"'}}
+        with mock.patch.object(BlogPost, 'get_related_update', return_value=body):
+            BlogPost.reindex_related(BlogPost.get_related_dependencies()[0], [1], es)
+        self.mirror.join()
+        self.assertEqual(self.mirror.es.transport.perform_request.call_args, es.transport.perform_request.call_args)
+
+    @mock.patch('elasticsearch.Elasticsearch.bulk')
+    def test__replay_delete(self, mock_bulk):
+        mock_bulk.return_value = {'items': [{'delete': {'status': 200}}]}
+        directory = tempfile.mkdtemp()
+        try:
+            spool = breaker.WriteSpool(os.path.join(directory, 'spool.sqlite3'))
+            spool.append(BlogPost, self.posts[0], 'delete')
+            breaker.replay_spool(spool)
+        finally:
+            shutil.rmtree(directory)
+        self.mirror.join()
+
+        self.assertEqual(self.mirror.es.bulk.call_count, 1)
+        self.assertEqual(self.mirror.es.bulk.call_args[0][0], mock_bulk.call_args[0][0])
+
+    @mock.patch('elasticsearch.Elasticsearch.update')
+    def test__update(self, mock_update):
+        post = self.posts[0]
+        self.mirror.es.update.side_effect = TransportError(404, 'missing')
+        with mock.patch.object(self.mirror.worker, 'put_nowait') as mock_put:
+            BlogPost.index_update(post, ['title'])
+            func, request = mock_put.call_args[0]
+
+        # the fallback document was built on this thread
+        with self.assertNumQueries(0):
+            request(self.mirror.es)
+        self.mirror.es.index.assert_called_once_with('blog', 'posts', BlogPost.get_document(post), post.pk, routing=1)
+
+
+class TitleSuggester(ElasticsearchSuggester):
+
+    def get_index(self):
+        return 'blog'
+
+    def get_type(self):
+        return 'posts'
+
+    def get_field(self):
+        return 'title_suggest'
+
+    def get_payload_fields(self):
+        return ['slug']
+
+
+class SuggestTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.MagicMock()
+        self.suggester = TitleSuggester(self.es, size=3)
+
+    def get_response(self, titles):
+        return {'suggest': {'suggestions': [{'options': [
+            {'_id': str(i), 'text': title, '_source': {'slug': title.lower().replace(' ', '-')}}
+            for i, title in enumerate(titles)
+        ]}]}}
+
+    def test__prefix_cache(self):
+        cache = PrefixCache(maxsize=2)
+        cache.set('a', ['a1'], True)
+        cache.set('b', ['b1'], False)
+        cache.get('a')
+        cache.set('c', ['c1'], True)
+
+        # 'b' was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get_complete('abc'), ['a1'])
+        self.assertEqual(cache.get_complete('c'), None)
+
+    def test__prefix_cache_timeout(self):
+        cache = PrefixCache(timeout=10)
+        with mock.patch('time.time', return_value=1000):
+            cache.set('a', ['a1'], True)
+        with mock.patch('time.time', return_value=1009):
+            self.assertEqual(cache.get('a'), (['a1'], True))
+        with mock.patch('time.time', return_value=1010):
+            self.assertEqual(cache.get('a'), None)
+
+    def test__rebuild_clears_cache(self):
+        self.es.search.return_value = self.get_response(['Hello'])
+        self.suggester.suggest('he')
+        post_indices_rebuild.send(None, indices=[('blog', 'blog-1')], aliases_set=True)
+        self.suggester.suggest('he')
+        self.assertEqual(self.es.search.call_count, 2)
+
+    def test__suggest(self):
+        self.es.search.return_value = self.get_response(['Hello World', 'Help'])
+
+        result = self.suggester.suggest(' He')
+        self.assertEqual(result, [('0', 'Hello World', {'slug': 'hello-world'}), ('1', 'Help', {'slug': 'help'})])
+        self.es.search.assert_called_once_with(
+            index='blog', doc_type='posts',
+            body={
+                'suggest': {'suggestions': {'prefix': 'he', 'completion': {'field': 'title_suggest', 'size': 3}}},
+                '_source': ['slug'],
+                'size': 0,
+            },
+            filter_path='suggest.suggestions.options._id,suggest.suggestions.options.text,suggest.suggestions.options._source'
+        )
+
+        # fewer than `size` results are complete, so longer prefixes are
+        # answered from them
+        self.assertEqual(self.suggester.suggest('hell'), [('0', 'Hello World', {'slug': 'hello-world'})])
+        self.assertEqual(self.suggester.suggest('He'), result)
+        self.assertEqual(self.es.search.call_count, 1)
+
+    def test__suggest_incomplete(self):
+        self.es.search.return_value = self.get_response(['Ha', 'Hat', 'Hats'])
+        self.suggester.suggest('h')
+        self.suggester.suggest('ha')
+        self.assertEqual(self.es.search.call_count, 2)
+
+    def test__suggest_prefix_mode(self):
+        self.suggester.get_mode = lambda: 'prefix'
+        self.es.search.return_value = {'hits': {'hits': [{'_id': '1', '_source': {'title_suggest': 'Hello', 'slug': 'hello'}}]}}
+
+        self.assertEqual(self.suggester.suggest('He'), [('1', 'Hello', {'slug': 'hello'})])
+        self.assertEqual(self.es.search.call_args[1]['body']['query'], {'prefix': {'title_suggest': 'He'}})
+
+        # the prefix is sent as typed, so other cases aren't answered from the cache
+        self.es.search.return_value = {'hits': {'hits': []}}
+        self.assertEqual(self.suggester.suggest('he'), [])
+        self.assertEqual(self.es.search.call_args[1]['body']['query'], {'prefix': {'title_suggest': 'he'}})
+        self.assertEqual(self.es.search.call_count, 2)
+
+
+class ScanIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.es = mock.MagicMock()
+        self.pages = {}
+
+        def search(index=None, doc_type=None, body=None, scroll=None, size=None):
+            # three pages of `size` hits per slice
+            slice_id = body.get('slice', {}).get('id', 0)
+            self.pages[slice_id] = [
+                {'_scroll_id': '{0}-{1}'.format(slice_id, page), 'hits': {'hits': [
+                    {'_id': '{0}-{1}-{2}'.format(slice_id, page, i)} for i in range(size)
+                ]}}
+                for page in range(1, 3)
+            ] + [{'_scroll_id': '{0}-3'.format(slice_id), 'hits': {'hits': []}}]
+            return {'_scroll_id': '{0}-0'.format(slice_id), 'hits': {'hits': [
+                {'_id': '{0}-0-{1}'.format(slice_id, i)} for i in range(size)
+            ]}}
+
+        def scroll(scroll_id=None, scroll=None):
+            return self.pages[int(scroll_id.split('-')[0])].pop(0)
+
+        self.es.search.side_effect = search
+        self.es.scroll.side_effect = scroll
+
+    def test__scan_index(self):
+        hits = list(scan_index('blog', {'query': {'match_all': {}}}, slices=3, es=self.es, source=['title'], size=2))
+        self.assertEqual(len(hits), 3 * 3 * 2)
+        self.assertEqual(len(set(hit['_id'] for hit in hits)), len(hits))
+
+        bodies = sorted((call[1]['body'] for call in self.es.search.call_args_list), key=lambda body: body['slice']['id'])
+        self.assertEqual(bodies[1], {'query': {'match_all': {}}, '_source': ['title'], 'sort': ['_doc'], 'slice': {'id': 1, 'max': 3}})
+
+        # every slice's scroll context is cleared
+        self.assertEqual(
+            sorted(call[1]['scroll_id'] for call in self.es.clear_scroll.call_args_list),
+            ['0-3', '1-3', '2-3']
+        )
+
+    def test__scan_index_stops_early(self):
+        hits = scan_index('blog', slices=2, es=self.es, size=2, buffer_size=1)
+        next(hits)
+        hits.close()
+        self.assertEqual(self.es.clear_scroll.call_count, 2)
+
+    def test__scan_index_error(self):
+        self.es.scroll.side_effect = TransportError(500, 'search_phase_execution_exception')
+        self.assertRaises(TransportError, list, scan_index('blog', slices=2, es=self.es))
+        self.assertEqual(sorted(call[1]['scroll_id'] for call in self.es.clear_scroll.call_args_list), ['0-0', '1-0'])
+
+    def test__scan_index_single_slice(self):
+        self.es.search.side_effect = None
+        self.es.search.return_value = {'_scroll_id': '1', '_shards': {'failed': 0, 'total': 1}, 'hits': {'hits': []}}
+        self.es.scroll.side_effect = [
+            {'_scroll_id': '1', '_shards': {'failed': 0, 'total': 1}, 'hits': {'hits': [{'_id': '1'}, {'_id': '2'}]}},
+            {'_scroll_id': '1', '_shards': {'failed': 0, 'total': 1}, 'hits': {'hits': []}},
+        ]
+
+        hits = list(scan_index('blog', es=self.es, source=False, size=2))
+        self.assertEqual([hit['_id'] for hit in hits], ['1', '2'])
+
+        # no sort or slice, which older clusters don't support
+        self.assertEqual(self.es.search.call_args[1]['body'], {'_source': False})
+        self.assertEqual(self.es.search.call_args[1]['search_type'], 'scan')
@@ -1,83 +1,138 @@
 import collections
+import copy
 import datetime
 import gc
+import gzip
+import hashlib
+import json
+import os
 import sys
-from django.conf import settings
+import threading
+import time
+import uuid
+from django import db
 from django.http import Http404
-from elasticsearch import Elasticsearch, ElasticsearchException
+from django.utils import six, timezone
+from elasticsearch import ElasticsearchException, TransportError, helpers
+from elasticsearch.serializer import JSONSerializer
 
 from . import settings as es_settings
+from .exceptions import IndexHealthError, ReindexError, TaskError
+from .connections import get_connection
+from .registry import registry
 from .signals import post_indices_create, post_indices_rebuild
 
 try:
-    from importlib import import_module
+    import queue
 except ImportError:
-    from django.utils.importlib import import_module
+    import Queue as queue
 
-_elasticsearch_indices = collections.defaultdict(lambda: [])
+EXPORT_FILENAME_SUFFIX = '.ndjson.gz'
+EXPORT_FILENAME_FORMAT = '{0}.{1:05d}' + EXPORT_FILENAME_SUFFIX
+
+# values index settings are restored to after a bulk load when the index
+# didn't have them set explicitly
+BULK_LOAD_SETTING_DEFAULTS = {
+    'number_of_replicas': 1,
+    'refresh_interval': '1s',
+    'translog.durability': 'request',
+}
+
+# partition names for each `get_partition_interval()`; they must sort chronologically
+PARTITION_FORMATS = {
+    'year': '%Y',
+    'month': '%Y.%m',
+    'day': '%Y.%m.%d',
+}
+
+# the partition of the objects whose partition field is empty
+UNDATED_PARTITION = 'undated'
 
 
 def get_indices(indices=[]):
-    if not _elasticsearch_indices:
-        type_classes = getattr(settings, 'ELASTICSEARCH_TYPE_CLASSES', ())
-        if not type_classes:
-            raise Exception('Missing `ELASTICSEARCH_TYPE_CLASSES` in project `settings`.')
+    return registry.get_indices(indices)
 
-        for type_class in type_classes:
-            package_name, klass_name = type_class.rsplit('.', 1)
-            try:
-                package = import_module(package_name)
-                klass = getattr(package, klass_name)
-            except ImportError:
-                sys.stderr.write('Unable to import `{}`.\n'.format(type_class))
-                continue
-            _elasticsearch_indices[klass.get_index_name()].append(klass)
 
-    if not indices:
-        return _elasticsearch_indices
-    else:
-        result = {}
-        for k, v in _elasticsearch_indices.items():
-            if k in indices:
-                result[k] = v
-        return result
+class ClusterMetadata(object):
+    """
+    A snapshot of the cluster's indices and their aliases, fetched with a single
+    request and then kept up to date locally as aliases are switched and indices
+    are created or deleted. Pass one instance to the functions below to share it
+    across a whole operation instead of re-fetching the metadata for every call;
+    `set_rebuilt_aliases` refreshes it before switching aliases, as others may
+    have changed them since.
+    """
+    def __init__(self, es):
+        self.lock = threading.RLock()
+        self.refresh(es)
+
+    def refresh(self, es):
+        # the full index list is needed (for index name collisions), so the
+        # response isn't trimmed to the indices with aliases
+        data = es.indices.get_aliases() or {}
 
+        with self.lock:
+            self.indices = {}
+            self.aliases = collections.defaultdict(set)
+            for index, tmp in data.items():
+                self.add_index(index, list((tmp or {}).get('aliases', {}).keys()))
 
-def get_indices_from_aliases(es, search_aliases):
-    indices = []
+    def add_index(self, index, aliases=()):
+        with self.lock:
+            self.indices.setdefault(index, set()).update(aliases)
+            for alias in aliases:
+                self.aliases[alias].add(index)
 
-    for alias in search_aliases:
-        indices.extend([
-            index
-            for index, aliases in es.indices.get_aliases().items()
-            if alias in aliases['aliases'].keys()
-        ])
+    def remove_index(self, index):
+        with self.lock:
+            for alias in self.indices.pop(index, ()):
+                self.aliases[alias].discard(index)
 
-    return indices
+    def get_indices(self, aliases):
+        with self.lock:
+            indices = []
+            for alias in aliases:
+                indices.extend(sorted(self.aliases.get(alias, ())))
+            return indices
+
+    def update_aliases(self, actions):
+        # apply the actions of an `update_aliases` request to the snapshot
+        with self.lock:
+            for action in actions:
+                for name, details in action.items():
+                    index, alias = details['index'], details['alias']
+                    if name == 'add':
+                        self.add_index(index, [alias])
+                    elif name == 'remove':
+                        self.indices.get(index, set()).discard(alias)
+                        self.aliases[alias].discard(index)
+
+
+def get_indices_from_aliases(es, search_aliases, metadata=None):
+    metadata = metadata or ClusterMetadata(es)
+    return metadata.get_indices(search_aliases)
 
 
 def get_alias_names(aliases):
     return set([alias[0] for alias in aliases])
 
 
-def create_aliases(es=None, indices=[]):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
-
-    current_aliases = es.indices.get_aliases()
-    aliases_for_removal = collections.defaultdict(lambda: [])
-    for item, tmp in current_aliases.items():
-        for iname in list(tmp.get('aliases', {}).keys()):
-            aliases_for_removal[iname].append(item)
+def create_aliases(es=None, indices=[], metadata=None):
+    es = es or get_connection('admin')
+    metadata = metadata or ClusterMetadata(es)
 
     actions = []
+    removed = set()
     for index_alias, index_name in indices:
-        for item in aliases_for_removal[index_alias]:
+        # a partitioned index alias is given once for each of its partitions
+        for item in metadata.get_indices([index_alias]) if index_alias not in removed else []:
             actions.append({
                 'remove': {
                     'index': item,
                     'alias': index_alias
                 }
             })
+        removed.add(index_alias)
         actions.append({
             'add': {
                 'index': index_name,
@@ -86,46 +141,192 @@ def create_aliases(es=None, indices=[]):
         })
 
     es.indices.update_aliases({'actions': actions})
+    metadata.update_aliases(actions)
 
+    # the documents fingerprinted so far aren't in the new indices
+    for index_alias in removed:
+        reset_fingerprints(index_alias)
 
-def create_indices(es=None, indices=[], set_aliases=True):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
 
-    result = []
-    aliases = []
+def get_new_index_name(index_alias, now, metadata=None):
+    # timestamped index names only collide when indices are created within the
+    # same second; add a suffix to avoid any index already in the cluster
+    index_name = "{0}-{1}".format(index_alias, now)
+    if metadata is not None:
+        suffix = 1
+        while index_name in metadata.indices:
+            index_name = "{0}-{1}-{2}".format(index_alias, now, suffix)
+            suffix += 1
+    return index_name
 
-    now = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    for index_alias, type_classes in get_indices(indices).items():
-        index_settings = es_settings.ELASTICSEARCH_DEFAULT_INDEX_SETTINGS
-        index_settings = recursive_dict_update(
-            index_settings,
-            es_settings.ELASTICSEARCH_CUSTOM_INDEX_SETTINGS.get(index_alias, {})
-        )
 
-        index_name = "{0}-{1}".format(index_alias, now)
+def get_index_settings(index_alias, type_classes):
+    # copied, so the default settings aren't changed by every index created
+    index_settings = recursive_dict_update(
+        copy.deepcopy(es_settings.ELASTICSEARCH_DEFAULT_INDEX_SETTINGS),
+        es_settings.ELASTICSEARCH_CUSTOM_INDEX_SETTINGS.get(index_alias, {})
+    )
 
-        aliases.append((index_alias, index_name))
+    type_mappings = {}
+    for type_class in type_classes:
+        tmp = type_class.get_type_mapping()
+        if tmp:
+            type_mappings[type_class.get_type_name()] = tmp
 
-        type_mappings = {}
-        for type_class in type_classes:
-            tmp = type_class.get_type_mapping()
-            if tmp:
-                type_mappings[type_class.get_type_name()] = tmp
+    # if we got any type mappings, put them in the index settings
+    if type_mappings:
+        index_settings['mappings'] = type_mappings
+
+    return index_settings
+
+
+def to_utc(value):
+    # partitions are named by UTC date, whatever the current time zone
+    if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return value.astimezone(timezone.utc)
+    return value
+
+
+def get_partition_name(value, interval='month'):
+    if value is None:
+        return UNDATED_PARTITION
+    return to_utc(value).strftime(PARTITION_FORMATS[interval])
+
+
+def get_partition_alias(index_alias, partition):
+    return '{0}-{1}'.format(index_alias, partition)
+
+
+def get_partition_range(partition, interval='month'):
+    # the [start, end) dates of the documents in `partition`
+    start = datetime.datetime.strptime(partition, PARTITION_FORMATS[interval]).date()
+    if interval == 'year':
+        end = start.replace(year=start.year + 1)
+    elif interval == 'month':
+        end = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    else:
+        end = start + datetime.timedelta(days=1)
+    return start, end
+
+
+def get_partitions_for_range(start, end, interval='month'):
+    # the names of the partitions covering `start` to `end` (inclusive)
+    if isinstance(end, datetime.datetime):
+        end = to_utc(end).date()
+
+    result = [get_partition_name(start, interval)]
+    while True:
+        next_start = get_partition_range(result[-1], interval)[1]
+        if next_start > end:
+            return result
+        result.append(get_partition_name(next_start, interval))
+
+
+def get_index_partitions(type_classes):
+    # documents are only ever written to one partition's index, so all the
+    # type classes of a partitioned index must be partitioned the same way
+    intervals = set(type_class.get_partition_interval() if type_class.get_partition_field() else None for type_class in type_classes)
+    if len(intervals) > 1:
+        raise Exception('The type classes of a partitioned index must all be partitioned by the same interval: {0}.'.format(
+            ', '.join(type_class.__name__ for type_class in type_classes)
+        ))
+
+    partitions = set()
+    for type_class in type_classes:
+        partitions.update(type_class.get_partitions())
+    return sorted(partitions)
 
-            result.append((
-                type_class,
-                index_alias,
-                index_name
-            ))
 
-        # if we got any type mappings, put them in the index settings
-        if type_mappings:
-            index_settings['mappings'] = type_mappings
+def get_partitioned_index_names(index, start, end):
+    # replaces the partitioned index aliases in the (comma separated) `index`
+    # with the aliases of just their partitions covering `start` to `end`
+    result = []
+    for index_alias in index.split(','):
+        type_classes = [type_class for type_class in get_indices([index_alias]).get(index_alias, []) if type_class.get_partition_field()]
+        if not type_classes:
+            result.append(index_alias)
+            continue
+
+        for partition in get_partitions_for_range(start, end, type_classes[0].get_partition_interval()):
+            result.append(get_partition_alias(index_alias, partition))
+    return ','.join(result)
+
+
+def is_already_exists_error(e):
+    # 'IndexAlreadyExistsException' before Elasticsearch 5, then 'resource_already_exists_exception'
+    return e.status_code == 400 and 'alreadyexists' in str(e.error).replace('_', '').lower()
+
+
+def create_partition_index(es, index_alias, partition, metadata=None):
+    # creates the index of a partition that `create_indices` didn't know
+    # about (eg. when the first document of a new month is indexed); returns
+    # its name, or None if the partition already exists. Every process names
+    # it the same and it's created with its aliases, so when several index
+    # the partition's first documents at once only one index is created
+    partition_alias = get_partition_alias(index_alias, partition)
+    if es.indices.exists_alias(name=partition_alias):
+        return None
 
+    index_settings = get_index_settings(index_alias, get_indices([index_alias]).get(index_alias, []))
+    index_settings['aliases'] = {index_alias: {}, partition_alias: {}}
+    index_name = '{0}-auto'.format(partition_alias)
+    try:
+        es.indices.create(index_name, index_settings)
+    except TransportError as e:
+        if not is_already_exists_error(e):
+            raise
+        if es.indices.exists_alias(name=partition_alias):
+            return None
+        # an earlier index of the partition, no longer aliased
+        now = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        index_name = get_new_index_name(partition_alias, now, metadata)
         es.indices.create(index_name, index_settings)
 
+    if metadata is not None:
+        metadata.add_index(index_name, [index_alias, partition_alias])
+    return index_name
+
+
+def create_indices(es=None, indices=[], set_aliases=True, metadata=None):
+    # partitioned type classes (see `get_partition_field`) get an index per
+    # partition, all of them under the index alias and each also under its
+    # own '<index alias>-<partition>' alias, which writes go to
+    es = es or get_connection('admin')
+    metadata = metadata or ClusterMetadata(es)
+
+    result = []
+    aliases = []
+
+    now = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    for index_alias, type_classes in get_indices(indices).items():
+        index_settings = get_index_settings(index_alias, type_classes)
+
+        partitions = get_index_partitions(type_classes)
+        if partitions:
+            index_names = []
+            for partition in partitions:
+                partition_alias = get_partition_alias(index_alias, partition)
+                index_name = get_new_index_name(partition_alias, now, metadata)
+                aliases.append((index_alias, index_name))
+                aliases.append((partition_alias, index_name))
+                index_names.append(index_name)
+        else:
+            index_names = [get_new_index_name(index_alias, now, metadata)]
+            aliases.append((index_alias, index_names[0]))
+
+        for index_name in index_names:
+            for type_class in type_classes:
+                result.append((
+                    type_class,
+                    index_alias,
+                    index_name
+                ))
+
+            es.indices.create(index_name, index_settings)
+            metadata.add_index(index_name)
+
     if set_aliases:
-        create_aliases(es, aliases)
+        create_aliases(es, aliases, metadata)
 
     # `aliases` is a list of (index alias, index timestamped-name) tuples
     post_indices_create.send(None, indices=aliases, aliases_set=set_aliases)
@@ -133,71 +334,491 @@ def create_indices(es=None, indices=[], set_aliases=True):
     return result, aliases
 
 
-def rebuild_indices(es=None, indices=[], set_aliases=True):
-    es = es or Elasticsearch(**es_settings.ELASTICSEARCH_CONNECTION_PARAMS)
+def get_bulk_load_profile(index_alias):
+    return recursive_dict_update(
+        copy.deepcopy(es_settings.ELASTICSEARCH_DEFAULT_BULK_LOAD_PROFILE),
+        es_settings.ELASTICSEARCH_CUSTOM_BULK_LOAD_PROFILES.get(index_alias, {})
+    )
+
+
+def get_index_setting(index_settings, name, default=None):
+    # settings can come back from ES flattened ('translog.durability') or nested
+    index_settings = index_settings.get('index', {})
+    if name in index_settings:
+        return index_settings[name]
+
+    for part in name.split('.'):
+        if not isinstance(index_settings, collections.Mapping) or part not in index_settings:
+            return default
+        index_settings = index_settings[part]
+    return index_settings
+
+
+def prepare_index_for_bulk_load(es, index_name, index_alias=''):
+    # save the index's current settings locally so that they can be
+    # restored with `restore_index_after_bulk_load()` afterwards
+    index_settings = es.indices.get_settings(index_name).get(index_name, {}).get('settings', {})
+
+    # modify index settings to speed up bulk indexing and then restore them after
+    es.indices.put_settings({'index': get_bulk_load_profile(index_alias)['settings']}, index=index_name)
+
+    return index_settings
+
+
+def restore_index_after_bulk_load(es, index_name, index_settings, index_alias='', failed=False):
+    # after a `failed` load the index is never going to be used, so it isn't merged
+    profile = get_bulk_load_profile(index_alias)
+
+    if profile.get('max_num_segments') and not failed:
+        # merge before replicas are restored so they copy the merged segments;
+        # this can take far longer than the client's default timeout
+        forcemerge = getattr(es.indices, 'forcemerge', None) or es.indices.optimize
+        forcemerge(index_name, max_num_segments=profile['max_num_segments'], request_timeout=profile.get('merge_timeout', 3600))
+
+    # restore the original (or their ES defaults) settings back into
+    # the index to restore desired elasticsearch functionality
+    settings = {}
+    for name in profile['settings']:
+        settings[name] = get_index_setting(index_settings, name, BULK_LOAD_SETTING_DEFAULTS.get(name))
+    es.indices.put_settings({'index': settings}, index_name)
+    es.indices.refresh(index_name)
 
-    created_indices, aliases = create_indices(es, indices, False)
+
+def get_time_value_seconds(value):
+    # the seconds of an Elasticsearch time value (eg. '30m', '90s' or 1000,
+    # which is milliseconds)
+    units = (('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600), ('d', 86400))
+    if isinstance(value, six.string_types):
+        for unit, seconds in units:
+            if value.endswith(unit) and value[:-len(unit)].isdigit():
+                return int(value[:-len(unit)]) * seconds
+        value = int(value)
+    return value / 1000.0
+
+
+def wait_for_index_health(es, index_name, index_alias=''):
+    # block until the index reaches the profile's health status (with the
+    # default 'yellow', until its primaries are allocated; 'green' waits for
+    # its replicas too), so no searches land on it any earlier
+    profile = get_bulk_load_profile(index_alias)
+    if not profile.get('wait_for_status'):
+        return
+
+    timeout = profile.get('wait_timeout', '30m')
+    health = es.cluster.health(
+        index=index_name,
+        wait_for_status=profile['wait_for_status'],
+        timeout=timeout,
+        # the cluster answers once the wait times out; give it a moment more
+        request_timeout=get_time_value_seconds(timeout) + 30
+    )
+    if health.get('timed_out'):
+        raise IndexHealthError('Index `{0}` did not reach `{1}` health; its status is `{2}`.'.format(
+            index_name, profile['wait_for_status'], health.get('status')
+        ))
+
+
+def set_rebuilt_aliases(es, aliases, metadata=None):
+    metadata = metadata or ClusterMetadata(es)
+
+    waited = set()
+    for index_alias, index_name in aliases:
+        if index_name not in waited:
+            wait_for_index_health(es, index_name, index_alias)
+            waited.add(index_name)
+
+    # aliases may have been changed while the new indices were loaded
+    metadata.refresh(es)
+
+    alias_names = get_alias_names(aliases)
+    existing_aliased_indices = get_indices_from_aliases(es, alias_names, metadata)
+
+    create_aliases(es, aliases, metadata)
+
+    new_aliased_indices = get_indices_from_aliases(es, alias_names, metadata)
+
+    for index in existing_aliased_indices:
+        # Ensure that there are new aliased indexes, and that our old
+        # index is not somehow in them.
+        if new_aliased_indices and index not in new_aliased_indices:
+            if es_settings.ELASTICSEARCH_DELETE_OLD_INDEXES:
+                es.indices.delete(index)
+                metadata.remove_index(index)
+
+
+def create_mirror_indices(mirror, created_indices):
+    # creates the indices `create_indices` created on the primary cluster on
+    # a mirror too, with the same names and settings, ready for bulk loading;
+    # returns the mirror's metadata and the indices' original settings
+    metadata = ClusterMetadata(mirror.es)
+    index_settings = {}
+    for type_class, index_alias, index_name in created_indices:
+        if index_name not in index_settings:
+            mirror.es.indices.create(index_name, get_index_settings(index_alias, get_indices([index_alias]).get(index_alias, [])))
+            metadata.add_index(index_name)
+            index_settings[index_name] = prepare_index_for_bulk_load(mirror.es, index_name, index_alias)
+    return metadata, index_settings
+
+
+def rebuild_indices(es=None, indices=[], set_aliases=True, workers=1, alias_each=False, stats=None):
+    # with `workers` > 1, type classes (whether in the same index or not) are
+    # bulk indexed concurrently; with `alias_each`, each index's alias is
+    # switched as soon as that index is complete rather than all at the end.
+    # If a `stats` dictionary is given, it's filled with the `bulk_index` counts
+    # keyed by (index alias, type name).
+    # without an `es`, the type classes bulk index with their own 'bulk' clients
+    from .mirrors import get_mirrors
+
+    bulk_es = es
+    es = es or get_connection('admin')
+
+    # fetched once and shared by index creation and alias switching
+    metadata = ClusterMetadata(es)
+
+    created_indices, aliases = create_indices(es, indices, False, metadata)
+
+    # the bulk requests are copied to the mirrors, which need the same
+    # indices; writes into new indices wait for room in their queues rather
+    # than being dropped (see `bulk_index_objects`)
+    mirrors = []
+    for mirror in get_mirrors():
+        mirrors.append((mirror, mirror.get_stats()['failed']) + create_mirror_indices(mirror, created_indices))
 
     # kludge to avoid OOM due to Django's query logging
     # db_logger = logging.getLogger('django.db.backends')
     # oldlevel = db_logger.level
     # db_logger.setLevel(logging.ERROR)
 
-    current_index_name = None
-    current_index_settings = {}
-
-    def change_index():
-        if current_index_name:
-            # restore the original (or their ES defaults) settings back into
-            # the index to restore desired elasticsearch functionality
-            settings = {
-                'number_of_replicas': current_index_settings.get('index', {}).get('number_of_replicas', 1),
-                'refresh_interval': current_index_settings.get('index', {}).get('refresh_interval', '1s'),
-                'merge.policy.merge_factor': current_index_settings.get('index', {}).get('merge.policy.merge_factor', 10)
-            }
-            es.indices.put_settings({'index': settings}, current_index_name)
-            es.indices.refresh(current_index_name)
-
+    lock = threading.Lock()
+    index_settings = {}
+    failed_indices = set()
+    failed_aliases = set()
+    remaining = collections.defaultdict(int)
+    index_aliases = {}
     for type_class, index_alias, index_name in created_indices:
-        if index_name != current_index_name:
-            change_index()
+        remaining[index_name] += 1
+        index_aliases[index_name] = index_alias
 
-            # save the current index's settings locally so that we can restore them after
-            current_index_settings = es.indices.get_settings(index_name).get(index_name, {}).get('settings', {})
-            current_index_name = index_name
+    # each partition's index is loaded from just the partition's objects;
+    # an index alias is only switched once all its partitions are complete
+    partitions = {}
+    remaining_indices = collections.defaultdict(int)
+    for alias, index_name in aliases:
+        if alias == index_aliases[index_name]:
+            remaining_indices[alias] += 1
+        else:
+            partitions[index_name] = alias[len(index_aliases[index_name]) + 1:]
+
+    def build(item):
+        type_class, index_alias, index_name = item
 
-            # modify index settings to speed up bulk indexing and then restore them after
-            es.indices.put_settings({'index': {
-                'number_of_replicas': 0,
-                'refresh_interval': '-1',
-                'merge.policy.merge_factor': 30
-            }}, index=index_name)
+        # the first type class of an index to start switches it to bulk
+        # loading settings; the others wait here until that's done
+        with lock:
+            if index_name not in index_settings:
+                index_settings[index_name] = prepare_index_for_bulk_load(es, index_name, index_alias)
 
         try:
-            type_class.bulk_index(es, index_name)
+            if index_name in partitions:
+                partition = partitions[index_name]
+                result = type_class.bulk_index(bulk_es, index_name, queryset=type_class.get_partition_queryset(partition))
+                key = (get_partition_alias(index_alias, partition), type_class.get_type_name())
+            else:
+                result = type_class.bulk_index(bulk_es, index_name)
+                key = (index_alias, type_class.get_type_name())
+            if stats is not None:
+                stats[key] = result
         except NotImplementedError:
             sys.stderr.write('`bulk_index` not implemented on `{}`.\n'.format(type_class.get_index_name()))
-            continue
-    else:
-        change_index()
+        except Exception:
+            # a partially built index never goes live; `run_concurrently`
+            # re-raises this once every build is done
+            with lock:
+                failed_indices.add(index_name)
+                failed_aliases.add(index_alias)
+            raise
+        finally:
+            # the last type class of an index to finish restores its settings
+            with lock:
+                remaining[index_name] -= 1
+                complete = not remaining[index_name]
+                if complete:
+                    remaining_indices[index_alias] -= 1
+                alias_complete = complete and not remaining_indices[index_alias] and index_alias not in failed_aliases
+
+            if complete:
+                restore_index_after_bulk_load(es, index_name, index_settings[index_name], index_alias, index_name in failed_indices)
+            if alias_complete and set_aliases and alias_each:
+                set_rebuilt_aliases(es, [pair for pair in aliases if index_aliases[pair[1]] == index_alias], metadata)
+
+    completed = False
+    try:
+        run_concurrently(build, created_indices, workers)
+
+        # return to the norm for db query logging
+        # db_logger.setLevel(oldlevel)
+
+        if set_aliases and not alias_each:
+            set_rebuilt_aliases(es, aliases, metadata)
+        completed = True
+    finally:
+        for mirror, failed, mirror_metadata, mirror_index_settings in mirrors:
+            mirror.join()
+            for index_alias, index_name in aliases:
+                if index_name in mirror_index_settings:
+                    restore_index_after_bulk_load(
+                        mirror.es, index_name, mirror_index_settings.pop(index_name), index_alias, not completed
+                    )
+
+            # a mirror missing some of the documents keeps its current indices
+            if not completed:
+                continue
+            if mirror.get_stats()['failed'] > failed:
+                sys.stderr.write('Not switching the aliases of mirror `{0}`; some of its bulk requests failed.\n'.format(mirror.name))
+            elif set_aliases:
+                set_rebuilt_aliases(mirror.es, aliases, mirror_metadata)
+
+    # `aliases` is a list of (index alias, index timestamped-name) tuples
+    post_indices_rebuild.send(None, indices=aliases, aliases_set=set_aliases)
+
+    return created_indices, aliases
+
+
+def start_reindex(es, source, dest, slices=None):
+    # starts a server side `_reindex` of `source` into `dest`, returning its task id
+    params = {'wait_for_completion': 'false'}
+    if slices is None:
+        slices = es_settings.ELASTICSEARCH_REINDEX_SLICES
+    # (a single slice is left out, for clusters older than 5.1 that can't slice)
+    if slices and slices != 1:
+        params['slices'] = slices
+
+    response = es.transport.perform_request('POST', '/_reindex', params=params, body={
+        'source': {'index': source},
+        'dest': {'index': dest},
+    })
+    return response['task']
+
+
+def wait_for_task(es, task, poll_interval=None, error_class=TaskError):
+    # blocks until the (`_reindex`, `_delete_by_query`, ...) task is complete,
+    # returning its response; a failed task raises `error_class`
+    if poll_interval is None:
+        poll_interval = es_settings.ELASTICSEARCH_REINDEX_POLL_INTERVAL
+
+    try:
+        while True:
+            result = es.transport.perform_request('GET', '/_tasks/{0}'.format(task))
+            if result.get('completed'):
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        # (including a KeyboardInterrupt) the task would keep running otherwise
+        exc_info = sys.exc_info()
+        cancel_task(es, task)
+        six.reraise(*exc_info)
+
+    if result.get('error'):
+        raise error_class('Task `{0}` failed: {1}'.format(task, result['error']))
+
+    response = result.get('response', {})
+    if response.get('failures'):
+        raise error_class('Task `{0}` failed for {1} documents; first failure: {2}'.format(
+            task, len(response['failures']), response['failures'][0]
+        ))
+    return response
+
+
+def cancel_task(es, task):
+    try:
+        es.transport.perform_request('POST', '/_tasks/{0}/_cancel'.format(task))
+    except ElasticsearchException:
+        # it may have completed already, or the cluster is what failed
+        pass
+
 
-    # return to the norm for db query logging
-    # db_logger.setLevel(oldlevel)
+def wait_for_reindex(es, task, poll_interval=None):
+    return wait_for_task(es, task, poll_interval, ReindexError)
+
+
+def rebuild_indices_from_index(es=None, indices=[], set_aliases=True, slices=None, poll_interval=None, stats=None):
+    # like `rebuild_indices`, but the new indices (with the current mappings
+    # and settings) are filled by the cluster from the currently aliased
+    # indices with `_reindex`, rather than from the database; for when only
+    # mappings or analysis settings changed. If a `stats` dictionary is
+    # given, it's filled with the reindex responses keyed by (source alias,
+    # new index name).
+    from .mirrors import get_mirrors
+
+    es = es or get_connection('admin')
+    if get_mirrors():
+        # the copy happens inside the primary cluster, so the mirrors would
+        # never get the new indices' documents
+        raise ReindexError('Indices can not be rebuilt from an index while `ELASTICSEARCH_MIRRORS` is set; '
+                           'rebuild them from the database instead.')
+    metadata = ClusterMetadata(es)
+
+    # every new index is copied from the index its alias (or, for partitions,
+    # its partition alias) points at now; they all need to exist
+    for index_alias, type_classes in get_indices(indices).items():
+        partitions = get_index_partitions(type_classes)
+        for source in [get_partition_alias(index_alias, partition) for partition in partitions] or [index_alias]:
+            if not metadata.get_indices([source]):
+                raise ReindexError('`{0}` has no index to copy from; rebuild it from the database instead.'.format(source))
+
+    created_indices, aliases = create_indices(es, indices, False, metadata)
+
+    sources = {}
+    for alias, index_name in aliases:
+        # a partition alias is more specific than the index alias
+        if index_name not in sources or len(alias) > len(sources[index_name]):
+            sources[index_name] = alias
+
+    index_settings = {}
+    tasks = []
+    completed = False
+    try:
+        for index_alias, index_name in aliases:
+            if index_name in index_settings:
+                continue
+            index_settings[index_name] = prepare_index_for_bulk_load(es, index_name, index_alias)
+            tasks.append((index_alias, index_name, start_reindex(es, sources[index_name], index_name, slices)))
+
+        # the tasks run concurrently in the cluster; wait for all of them
+        for index_alias, index_name, task in tasks:
+            response = wait_for_reindex(es, task, poll_interval)
+            if stats is not None:
+                stats[(sources[index_name], index_name)] = response
+        completed = True
+    finally:
+        for index_alias, index_name, task in tasks:
+            if not completed:
+                cancel_task(es, task)
+            restore_index_after_bulk_load(es, index_name, index_settings[index_name], index_alias, not completed)
 
     if set_aliases:
-        alias_names = get_alias_names(aliases)
-        existing_aliased_indices = get_indices_from_aliases(es, alias_names)
+        set_rebuilt_aliases(es, aliases, metadata)
+
+    # `aliases` is a list of (index alias, index timestamped-name) tuples
+    post_indices_rebuild.send(None, indices=aliases, aliases_set=set_aliases)
+
+    return created_indices, aliases
+
 
-        create_aliases(es, aliases)
+def export_indices(directory, indices=[], docs_per_file=100000):
+    # writes the bulk API lines for every indexable object to gzipped NDJSON
+    # files, laid out as `<directory>/<index alias>/<type name>.<part>.ndjson.gz`;
+    # the `_index` is left out so that `import_indices` can load them into any index
+    serializer = JSONSerializer()
+    result = []
+
+    # checked up front; exporting works offline, but partitioned documents
+    # are written to their partition's index, which would be created
+    for index_alias, type_classes in get_indices(indices).items():
+        if any(type_class.get_partition_field() for type_class in type_classes):
+            raise Exception('Partitioned index `{0}` can not be exported; rebuild it instead.'.format(index_alias))
+
+    for index_alias, type_classes in get_indices(indices).items():
+        index_directory = os.path.join(directory, index_alias)
+        if not os.path.isdir(index_directory):
+            os.makedirs(index_directory)
+
+        for type_class in type_classes:
+            part = 0
+            count = 0
+            stream = None
+
+            try:
+                for obj in queryset_iterator(type_class.get_queryset(), type_class.get_query_limit()):
+                    if not type_class.should_index(obj):
+                        # a new index has nothing to delete
+                        continue
+
+                    if stream is None or (docs_per_file and not count % docs_per_file):
+                        if stream is not None:
+                            stream.close()
+                        path = os.path.join(index_directory, EXPORT_FILENAME_FORMAT.format(type_class.get_type_name(), part))
+                        stream = gzip.open(path, 'wb')
+                        result.append((index_alias, type_class.get_type_name(), path))
+                        part += 1
+
+                    action, document = type_class.get_bulk_operation(obj)
+                    action['index'].pop('_index', None)
+                    stream.write((serializer.dumps(action) + '\n').encode('utf-8'))
+                    stream.write((serializer.dumps(document) + '\n').encode('utf-8'))
+                    count += 1
+            except NotImplementedError:
+                sys.stderr.write('`get_queryset` not implemented on `{}`.\n'.format(type_class.get_index_name()))
+            finally:
+                if stream is not None:
+                    stream.close()
+
+    # `result` is a list of (index alias, type name, file path) tuples
+    return result
+
+
+def get_export_files(directory, indices=[]):
+    result = []
+    for index_alias in sorted(os.listdir(directory)):
+        index_directory = os.path.join(directory, index_alias)
+        if not os.path.isdir(index_directory) or (indices and index_alias not in indices):
+            continue
+        for filename in sorted(os.listdir(index_directory)):
+            if filename.endswith(EXPORT_FILENAME_SUFFIX):
+                result.append((index_alias, os.path.join(index_directory, filename)))
+    return result
+
+
+def import_file(es, index_name, path, chunksize=500):
+    # the exported file alternates operation and document lines, so batches
+    # are sent as raw NDJSON without deserializing anything
+    lines = []
+    with gzip.open(path, 'rb') as stream:
+        for line in stream:
+            lines.append(line.decode('utf-8').rstrip('\n'))
+            if len(lines) >= chunksize * 2:
+                es.bulk('\n'.join(lines), index=index_name)
+                lines = []
+    if lines:
+        es.bulk('\n'.join(lines), index=index_name)
 
-        new_aliased_indices = get_indices_from_aliases(es, alias_names)
 
-        for index in existing_aliased_indices:
-            # Ensure that there are new aliased indexes, and that our old
-            # index is not somehow in them.
-            if new_aliased_indices and index not in new_aliased_indices:
-                if es_settings.ELASTICSEARCH_DELETE_OLD_INDEXES:
-                    es.indices.delete(index)
+def import_indices(directory, es=None, indices=[], set_aliases=True, workers=1):
+    bulk_es = es or get_connection('bulk')
+    es = es or get_connection('admin')
+
+    export_files = get_export_files(directory, indices)
+    if not export_files:
+        raise Exception('No exported files found in `{0}`.'.format(directory))
+
+    metadata = ClusterMetadata(es)
+
+    for index_alias, type_classes in get_indices(set(alias for alias, path in export_files)).items():
+        if any(type_class.get_partition_field() for type_class in type_classes):
+            raise Exception('Partitioned index `{0}` can not be imported; rebuild it instead.'.format(index_alias))
+
+    # only the indices that were exported are created, with current mappings
+    created_indices, aliases = create_indices(es, sorted(set(alias for alias, path in export_files)), False, metadata)
+    index_names = dict(aliases)
+
+    index_settings = {}
+    for index_alias, index_name in aliases:
+        index_settings[index_name] = prepare_index_for_bulk_load(es, index_name, index_alias)
+
+    completed = False
+    try:
+        run_concurrently(
+            lambda item: import_file(bulk_es, index_names[item[0]], item[1]),
+            [item for item in export_files if item[0] in index_names],
+            workers
+        )
+        completed = True
+    finally:
+        for index_alias, index_name in aliases:
+            restore_index_after_bulk_load(es, index_name, index_settings[index_name], index_alias, not completed)
+
+    if set_aliases:
+        set_rebuilt_aliases(es, aliases, metadata)
 
     # `aliases` is a list of (index alias, index timestamped-name) tuples
     post_indices_rebuild.send(None, indices=aliases, aliases_set=set_aliases)
@@ -205,6 +826,421 @@ def rebuild_indices(es=None, indices=[], set_aliases=True):
     return created_indices, aliases
 
 
+def scan_index(index, query=None, slices=1, es=None, doc_type=None, source=True, size=1000, scroll='5m', buffer_size=None):
+    # yields every hit of `query` (the whole search body, eg. {'query': ...};
+    # all documents by default) in `index`, in no particular order. With
+    # `slices` > 1, a sliced scroll (Elasticsearch 5+) is read by that many
+    # threads at once. At most `buffer_size` pages of `size` hits (by default
+    # two per slice) wait to be consumed, and scroll contexts are cleared
+    # when done - or when the consumer stops early. `source` is passed as the
+    # body's `_source` (eg. False, or a list of fields).
+    es = es or get_connection('search')
+
+    if slices == 1:
+        # a plain scan, which works with any Elasticsearch version
+        body = dict(query or {})
+        body['_source'] = source
+        for hit in helpers.scan(es, body, scroll=scroll, index=index, doc_type=doc_type, size=size):
+            yield hit
+        return
+
+    stop = threading.Event()
+    pages = queue.Queue(buffer_size or slices * 2)
+    done = object()
+
+    def put(item):
+        # gives up once the consumer is gone
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(i):
+        body = dict(query or {})
+        body['_source'] = source
+        body.setdefault('sort', ['_doc'])
+        if slices > 1:
+            body['slice'] = {'id': i, 'max': slices}
+
+        scroll_id = None
+        try:
+            response = es.search(index=index, doc_type=doc_type, body=body, scroll=scroll, size=size)
+            while True:
+                scroll_id = response.get('_scroll_id')
+                hits = response['hits']['hits']
+                if not hits or not put(hits):
+                    break
+                response = es.scroll(scroll_id=scroll_id, scroll=scroll)
+        except Exception:
+            put(sys.exc_info())
+        finally:
+            if scroll_id:
+                try:
+                    es.clear_scroll(scroll_id=scroll_id)
+                except ElasticsearchException:
+                    # the context expires by itself
+                    pass
+            put(done)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(slices)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        remaining = slices
+        while remaining:
+            item = pages.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, tuple):
+                six.reraise(*item)
+            else:
+                for hit in item:
+                    yield hit
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+class IdBitmap(object):
+    """
+    A set of non-negative integer ids kept as one bit per possible id, so
+    that the ids of tens of millions of documents take megabytes rather than
+    gigabytes; differences are iterated in id order.
+    """
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, id):
+        id = int(id)
+        if id < 0:
+            raise ValueError('Only non-negative integer ids can be stored.')
+
+        byte = id >> 3
+        if byte >= len(self.bits):
+            # grow by at least doubling, to keep appending ids cheap
+            self.bits.extend(bytearray(max(byte + 1 - len(self.bits), len(self.bits))))
+
+        mask = 1 << (id & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return 0 <= byte < len(self.bits) and bool(self.bits[byte] & (1 << (id & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def difference(self, other, blocksize=4096):
+        # yields the ids in this bitmap that aren't in `other`; identical
+        # blocks (the common case) are skipped without looking at their bits
+        for start in range(0, len(self.bits), blocksize):
+            block = self.bits[start:start + blocksize]
+            other_block = other.bits[start:start + blocksize]
+            if block == other_block:
+                continue
+
+            for i, value in enumerate(block):
+                if i < len(other_block):
+                    value &= ~other_block[i] & 0xff
+                if value:
+                    for bit in range(8):
+                        if value & (1 << bit):
+                            yield ((start + i) << 3) + bit
+
+
+def verify_index(type_class, es=None, repair=False, stale=False, slices=1, sample_size=10):
+    # compares the ids in the type's (aliased) index with the pks of its
+    # `get_queryset()`, returning how many documents are `missing` (not
+    # indexed, although `should_index` allows it), `extra` (no longer in the
+    # database) and, with `stale`,
+    # `stale` (indexed document differs from `get_document`), with `samples`
+    # of up to `sample_size` of their ids; with `repair` only those documents
+    # are indexed or deleted, a chunk at a time as they're found. The index is
+    # read with `slices` concurrent scrolls. This assumes document ids are the
+    # objects' integer pks (see `get_document_id`).
+    bulk_es = es or type_class.get_es('bulk')
+    es = es or get_connection('search')
+    index_alias = type_class.get_index_name()
+    type_name = type_class.get_type_name()
+    chunksize = type_class.get_query_limit()
+
+    result = {'missing': 0, 'extra': 0, 'stale': 0, 'samples': {'missing': [], 'extra': [], 'stale': []}}
+    # repaired documents must be written even if their fingerprints match
+    cache = type_class.get_fingerprint_cache() if repair else None
+
+    def delete_extra(ids):
+        # the extra documents' concrete indices (the alias may cover several
+        # partitions) and routing are looked up first
+        response = es.search(index=index_alias, doc_type=type_name, body={
+            'query': {'ids': {'values': [str(id) for id in ids]}},
+            '_source': False,
+            'size': len(ids),
+        })
+        actions = []
+        for hit in response['hits']['hits']:
+            action = {'_index': hit['_index'], '_type': type_name, '_id': hit['_id']}
+            if hit.get('_routing'):
+                action['routing'] = hit['_routing']
+            actions.append({'delete': action})
+        if actions:
+            bulk_es.bulk(actions)
+
+    def found(key, ids):
+        result[key] += len(ids)
+        samples = result['samples'][key]
+        samples.extend(ids[:sample_size - len(samples)])
+        if not repair or not ids:
+            return
+
+        if key == 'extra':
+            for chunk in chunked(ids, type_class.get_bulk_index_limit()):
+                delete_extra(chunk)
+        else:
+            if cache:
+                generation = get_fingerprint_generation(index_alias)
+                cache.delete_many([type_class.get_fingerprint_key(id, generation) for id in ids])
+            type_class.bulk_index(bulk_es, queryset=type_class.get_queryset().filter(pk__in=ids))
+
+    def check_stale(hits):
+        # objects `should_index` leaves out count as stale, so that a repair deletes them
+        objs = type_class.get_queryset().in_bulk([int(hit['_id']) for hit in hits])
+        stale_ids = []
+        for hit in hits:
+            obj = objs.get(int(hit['_id']))
+            if obj is None:
+                continue
+            if not type_class.should_index(obj) or \
+                    type_class.get_document_fingerprint(type_class.get_document(obj)) != \
+                    type_class.get_document_fingerprint(hit.get('_source', {})):
+                stale_ids.append(obj.pk)
+        found('stale', stale_ids)
+
+    indexed = IdBitmap()
+    # `_source` is only fetched when documents are compared
+    hits = scan_index(index_alias, es=es, doc_type=type_name, source=stale, size=chunksize, slices=slices)
+    for chunk in chunked(hits, chunksize):
+        for hit in chunk:
+            indexed.add(hit['_id'])
+        if stale:
+            check_stale(chunk)
+
+    expected = IdBitmap()
+    pks = type_class.get_queryset().order_by('pk').values_list('pk', flat=True)
+    for pk in queryset_iterator(pks, chunksize):
+        expected.add(pk)
+
+    result['indexed'] = len(indexed)
+    result['expected'] = len(expected)
+    for ids in chunked(expected.difference(indexed), chunksize):
+        # objects `should_index` leaves out aren't supposed to be indexed
+        objs = type_class.get_queryset().filter(pk__in=ids)
+        found('missing', sorted(obj.pk for obj in objs if type_class.should_index(obj)))
+    for ids in chunked(indexed.difference(expected), chunksize):
+        found('extra', ids)
+
+    return result
+
+
+class AdaptiveBulkController(object):
+    """
+    Sizes `bulk_index` batches from cluster feedback, AIMD style: the batch size
+    grows by `increase` documents after every bulk request that completes within
+    `max_latency` seconds (client round trip or server `took`, whichever is
+    longer), and is multiplied by `decrease` after a slower one or one the
+    cluster rejects with a 429 - rejections also back off, for `backoff` seconds
+    doubling on consecutive ones, before being retried. Batches are paced to
+    stay under `max_docs_per_second`, if given.
+    """
+    def __init__(self, batch_size=100, min_batch_size=10, max_batch_size=5000, increase=50, decrease=0.5,
+                 max_latency=1.0, max_docs_per_second=None, backoff=1.0, max_retries=5):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.increase = increase
+        self.decrease = decrease
+        self.max_latency = max_latency
+        self.max_docs_per_second = max_docs_per_second
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.rejections = 0
+        self.batch_sizes = []
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def record(self, docs, seconds, response=None, rejected=False):
+        took = (response or {}).get('took', 0) / 1000.0
+        rejected = rejected or any(
+            list(item.values())[0].get('status') == 429 for item in (response or {}).get('items', [])
+        )
+
+        pause = 0
+        if rejected:
+            pause = self.backoff * 2 ** self.rejections
+            self.rejections += 1
+        else:
+            self.rejections = 0
+
+        if rejected or max(seconds, took) > self.max_latency:
+            self.batch_size = max(self.min_batch_size, int(self.batch_size * self.decrease))
+        else:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.increase)
+
+        if self.max_docs_per_second:
+            pause = max(pause, float(docs) / self.max_docs_per_second - seconds)
+
+        if pause > 0:
+            self.sleep(pause)
+
+    def send(self, es, body, docs):
+        # sends a bulk request, retrying it while the whole request is rejected
+        retries = 0
+        while True:
+            self.batch_sizes.append(docs)
+            start = time.time()
+            try:
+                response = es.bulk(body)
+            except TransportError as e:
+                if e.status_code != 429 or retries >= self.max_retries:
+                    raise
+                self.record(docs, time.time() - start, rejected=True)
+                retries += 1
+                continue
+
+            self.record(docs, time.time() - start, response)
+            return response
+
+    def get_stats(self):
+        sizes = self.batch_sizes
+        return {
+            'batches': len(sizes),
+            'min': min(sizes) if sizes else 0,
+            'max': max(sizes) if sizes else 0,
+            'mean': sum(sizes) / float(len(sizes)) if sizes else 0,
+            'last': sizes[-1] if sizes else 0,
+        }
+
+
+def chunked(items, chunksize):
+    # yields lists of up to `chunksize` items from any iterable
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_after_commit(func):
+    # Django 1.9+ defers `func` until the current transaction (if any) commits
+    try:
+        from django.db.transaction import on_commit
+    except ImportError:
+        return func()
+    return on_commit(func)
+
+
+class BackgroundWorker(object):
+    """
+    Runs queued callables one at a time, in order, in a daemon thread that's
+    started on first use. Exceptions are written to stderr and don't stop it.
+    """
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, func, *args, **kwargs):
+        self.start()
+        self.queue.put((func, args, kwargs))
+
+    def put_nowait(self, func, *args, **kwargs):
+        # returns False instead of waiting when the queue is full
+        self.start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                sys.stderr.write('Background Elasticsearch task failed: {0!r}\n'.format(e))
+            finally:
+                db.connection.close()
+                self.queue.task_done()
+
+    def join(self):
+        # blocks until everything queued so far has run
+        self.queue.join()
+
+
+background = BackgroundWorker()
+
+
+def run_concurrently(func, items, workers=1):
+    # calls `func` for every item using at most `workers` threads; the first
+    # exception raised by any of the calls is re-raised once all have finished
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pending = queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    results = [None] * len(items)
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                try:
+                    i, item = pending.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    results[i] = func(item)
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            # threads get their own database connections; don't leak them
+            db.connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        six.reraise(*errors[0])
+
+    return results
+
+
 def recursive_dict_update(d, u):
     for k, v in u.items():
         if isinstance(v, collections.Mapping):
@@ -215,19 +1251,153 @@ def recursive_dict_update(d, u):
     return d
 
 
-def queryset_iterator(queryset, chunksize=1000):
+def get_rss():
+    # current resident memory of this process in bytes, or None if unknown
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # not the current value but the peak; reported in bytes on OS X, kilobytes elsewhere
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def collect_garbage(threshold=None):
+    # runs a full garbage collection if the process' memory is above `threshold`
+    # megabytes (see `ELASTICSEARCH_GC_RSS_THRESHOLD`); returns whether it ran
+    if threshold is None:
+        return False
+
+    if threshold:
+        rss = get_rss()
+        if rss is not None and rss < threshold * 1024 * 1024:
+            return False
+
+    gc.collect()
+    return True
+
+
+def queryset_iterator(queryset, chunksize=1000, streaming=None):
+    if streaming is None:
+        streaming = es_settings.ELASTICSEARCH_QUERYSET_STREAMING
+    threshold = es_settings.ELASTICSEARCH_GC_RSS_THRESHOLD
+
+    if streaming:
+        try:
+            rows = queryset.iterator(chunk_size=chunksize)
+        except TypeError:
+            # Django < 2.0 has no `chunk_size`; backends with server-side
+            # cursor support still stream the results
+            rows = queryset.iterator()
+
+        for i, row in enumerate(rows, 1):
+            yield row
+            if not i % chunksize:
+                collect_garbage(threshold)
+        return
+
     total = queryset.count()
     row_ptr = 0
 
     while row_ptr < total:
         for row in queryset[row_ptr:(row_ptr+chunksize)]:
             yield row
-        gc.collect()
+        collect_garbage(threshold)
         row_ptr += chunksize
 
 
+def measure_queryset_iterator(queryset, chunksize=1000, streaming=None):
+    # iterates the whole queryset, returning throughput and the peak resident
+    # memory (sampled once per chunk) so both iteration modes can be compared
+    start = time.time()
+    start_rss = peak_rss = get_rss()
+
+    rows = 0
+    for rows, row in enumerate(queryset_iterator(queryset, chunksize, streaming), 1):
+        if not rows % chunksize:
+            rss = get_rss()
+            if rss is not None:
+                peak_rss = max(peak_rss, rss)
+
+    seconds = time.time() - start
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else 0,
+        'start_rss': start_rss,
+        'peak_rss': peak_rss,
+    }
+
+
+def normalize_query(query):
+    # replaces the values in a query with '?', so that searches only differing
+    # in their input can be grouped together (eg. in the slow search log)
+    if isinstance(query, dict):
+        return dict((k, normalize_query(v)) for k, v in query.items())
+    if isinstance(query, (list, tuple)):
+        return [normalize_query(v) for v in query]
+    return '?'
+
+
+def get_django_cache(alias):
+    try:
+        from django.core.cache import caches
+    except ImportError:
+        # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+def get_document_fingerprint(document):
+    # a hash of the serialized document; keys are sorted so that equal
+    # documents always serialize, and hash, the same
+    data = json.dumps(document, sort_keys=True, default=JSONSerializer().default)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_bulk_body(operations):
+    # the NDJSON body of a `_bulk` request, so it can be serialized once and
+    # sent to several clusters
+    serializer = JSONSerializer()
+    return ''.join(serializer.dumps(line) + '\n' for line in operations)
+
+
+def get_fingerprint_generation_key(index_alias):
+    return 'simple_elasticsearch:fingerprint-generation:{0}'.format(index_alias)
+
+
+def get_fingerprint_generation(index_alias):
+    # fingerprints are kept per generation of an index alias, so that they're
+    # all forgotten at once when the alias gets a new (empty) index
+    cache = get_django_cache(es_settings.ELASTICSEARCH_FINGERPRINT_CACHE)
+    key = get_fingerprint_generation_key(index_alias)
+    generation = cache.get(key)
+    if generation is None:
+        # the first process to get here decides; if the generation was evicted
+        # from the cache, that merely forgets all fingerprints
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def reset_fingerprints(index_alias):
+    # starts a new fingerprint generation for `index_alias`, eg. after it was
+    # switched to another index
+    if es_settings.ELASTICSEARCH_FINGERPRINT_CACHE:
+        cache = get_django_cache(es_settings.ELASTICSEARCH_FINGERPRINT_CACHE)
+        cache.set(get_fingerprint_generation_key(index_alias), uuid.uuid4().hex, None)
+
+
 def get_from_es_or_None(index, type, id, **kwargs):
-    es = kwargs.pop('es', Elasticsearch(es_settings.ELASTICSEARCH_SERVER))
+    es = kwargs.pop('es', None) or get_connection('get')
     try:
         return es.get(index, id, type, **kwargs)
     except ElasticsearchException: